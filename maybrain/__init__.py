@@ -2,7 +2,43 @@
 """
 Initialisation file for Maybrain
 
+The other subpackages, like `maybrain.plotting`, are only imported when first used
+
 """
+import importlib
+import types
 
 from . import brain
 from . import utils
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Placeholder of a submodule which imports it when one of its attributes is first used.
+    Once imported, the package attribute is replaced by the module itself, and placeholders kept elsewhere (like
+    with `from maybrain import algorithms`) keep forwarding to it, also when setting attributes
+    """
+
+    def __getattr__(self, name):
+        """ It imports the module and returns its attribute """
+        return getattr(importlib.import_module(self.__name__), name)
+
+    def __setattr__(self, name, value):
+        """ It imports the module and sets its attribute """
+        setattr(importlib.import_module(self.__name__), name, value)
+
+    def __delattr__(self, name):
+        """ It imports the module and deletes its attribute """
+        delattr(importlib.import_module(self.__name__), name)
+
+    def __dir__(self):
+        """ It imports the module and returns its attributes """
+        return dir(importlib.import_module(self.__name__))
+
+
+algorithms = _LazyModule(__name__ + '.algorithms')
+plotting = _LazyModule(__name__ + '.plotting')
+resources = _LazyModule(__name__ + '.resources')
+metrics = _LazyModule(__name__ + '.metrics')
+cohort = _LazyModule(__name__ + '.cohort')
+pipeline = _LazyModule(__name__ + '.pipeline')
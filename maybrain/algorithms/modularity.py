@@ -1,7 +1,22 @@
 import numpy as np
 import random
 
+from maybrain.utils.cache import cached
 
+
+def _get_modules(brain):
+    """ Private helper which returns the module of each node and brain.Q, to be kept in the cache """
+    return {node: data.get('module') for node, data in brain.G.nodes(data=True)}, brain.Q
+
+
+def _set_modules(brain, state):
+    """ Private helper which sets the module of each node and brain.Q from the cache """
+    modules, brain.Q = state
+    for node, module in modules.items():
+        brain.G.nodes[node]['module'] = module
+
+
+@cached("modularity", state=_get_modules, restore=_set_modules)
 def modularity(brain, hierarchy=False, diag_val=0., nodes_to_exclude=None):
     """
     Modularity function borrowed (after asking nicely!) from
@@ -14,6 +29,9 @@ def modularity(brain, hierarchy=False, diag_val=0., nodes_to_exclude=None):
     The function only returns a hierarchical dictionary of matrices and
     modularities if hierarchy is True. Otherwise, labels are added to
     individual nodes and the modularity is assigned as 'Q', eg brain.Q
+
+    When the on-disk cache is enabled (see `utils.enable_cache()`), the result for the same adjacency matrix and
+    parameters is taken from there. Note that the algorithm is stochastic, so the first result found is reused
     """
 
     w = brain.adjMat.copy()
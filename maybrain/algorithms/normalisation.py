@@ -1,13 +1,16 @@
 """
 Module for normalisation of the graphs representing the brain and respective measures
 """
+import multiprocessing
 import numbers
+import random
 
 from random import shuffle
 import numpy as np
 import networkx as nx
 
 from maybrain import constants as ct
+from maybrain.utils.cache import cached
 
 
 class RandomGenerationError(Exception):
@@ -132,8 +135,329 @@ def generate_rand_from_degree(brain, throw_exception=False, node_attrs=None, edg
     return new_g
 
 
+def _edge_arrays(graph, weight=ct.WEIGHT):
+    """
+    Private helper which returns the nodes of `graph` together with its edges as arrays of node positions (following
+    the order of the returned nodes) and an array with the respective weights
+    """
+    nodes = list(graph.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+    edges = list(graph.edges(data=weight, default=np.nan))
+
+    src = np.fromiter((index[e[0]] for e in edges), dtype=int, count=len(edges))
+    dst = np.fromiter((index[e[1]] for e in edges), dtype=int, count=len(edges))
+    weights = np.fromiter((e[2] for e in edges), dtype=float, count=len(edges))
+
+    return nodes, src, dst, weights
+
+
+def _swap_edges(src, dst, n_nodes, n_swaps, criterion=None):
+    """
+    Private helper which rewires, in place, the edges defined by the arrays `src` and `dst` with degree-preserving
+    double edge swaps: (a, b), (c, d) -> (a, d), (c, b). Each edge is involved on average in `n_swaps` attempts.
+
+    Swaps creating selfloops or parallel edges are rejected. `criterion(a, b, c, d)` can be given to further
+    decide whether a swap (a, b), (c, d) -> (a, d), (c, b) is accepted.
+
+    It returns the number of accepted swaps.
+    """
+    n_edges = len(src)
+    if n_edges < 2:
+        return 0
+
+    existing = set(np.minimum(src, dst) * n_nodes + np.maximum(src, dst))
+    n_attempts = int(n_swaps * n_edges)
+    # Drawing all the random numbers at once is much faster than drawing them in the loop
+    first = np.random.randint(n_edges, size=n_attempts)
+    second = np.random.randint(n_edges, size=n_attempts)
+    flip = np.random.randint(2, size=n_attempts).astype(bool)
+
+    accepted = 0
+    for i, j, flp in zip(first.tolist(), second.tolist(), flip.tolist()):
+        a, b = src[i], dst[i]
+        c, d = (dst[j], src[j]) if flp else (src[j], dst[j])
+        if i == j or a == d or c == b:
+            continue
+
+        new1 = min(a, d) * n_nodes + max(a, d)
+        new2 = min(c, b) * n_nodes + max(c, b)
+        if new1 in existing or new2 in existing:
+            continue
+        if criterion is not None and not criterion(a, b, c, d):
+            continue
+
+        existing.discard(min(a, b) * n_nodes + max(a, b))
+        existing.discard(min(c, d) * n_nodes + max(c, d))
+        existing.add(new1)
+        existing.add(new2)
+        src[i], dst[i] = a, d
+        src[j], dst[j] = c, b
+        accepted += 1
+
+    return accepted
+
+
+def _graph_from_arrays(brain, nodes, src, dst, weights, node_attrs):
+    """
+    Private helper which creates a nx.Graph with all the `nodes` and the edges defined in the arrays, copying the
+    node attributes `node_attrs` from `brain.G`
+    """
+    new_g = nx.Graph()
+    new_g.add_nodes_from(nodes)
+    new_g.add_weighted_edges_from(zip([nodes[i] for i in src], [nodes[i] for i in dst], weights.tolist()),
+                                  weight=ct.WEIGHT)
+
+    for attr in node_attrs:
+        for node in nodes:
+            new_g.nodes[node][attr] = brain.G.nodes[node][attr]
+
+    return new_g
+
+
+def generate_rand_from_strength(brain, n_swaps=10, sort_freq=0.1, node_attrs=None):
+    """
+    It returns a weighted graph with the same degree sequence as the brain specified as argument, and with a strength
+    sequence (sum of the weights around each node) approximately preserved.
+
+    The topology is randomised with `n_swaps` degree-preserving double edge swaps per edge. Afterwards, the original
+    weights are reassigned to the random edges following Rubinov and Sporns (2011) "Weight-conserving
+    characterization of complex functional brain networks", NeuroImage 56(4): the edges are ranked according to the
+    product of the strengths still missing in their nodes, and the sorted original weights are given to them by rank.
+    The missing strengths are updated and edges are ranked again until all of them have a weight.
+
+    Everything is done on arrays, so this is suitable for weighted normalisation of big graphs. It assumes positive
+    weights in `constants.WEIGHT`.
+
+    Parameters
+    ----------
+    brain: maybrain.brain.Brain
+        An instance of the `Brain` class
+    n_swaps: int
+        Number of swap attempts for each edge in the randomisation of the topology
+    sort_freq: float
+        Fraction (between 0 and 1) of the unassigned edges which get a weight between two consecutive rankings.
+        Lower values give a better preservation of the strengths, at the cost of more rankings
+    node_attrs: list of str
+        If the node attributes of brain.G are necessary for a correct calculation of func()
+        in the random graph, just pass the attributes as a list of strings in this parameter.
+        This way, these node attributes from the original brain will be presented in the random graph's nodes.
+
+    Returns
+    -------
+    new_g: nx.Graph
+        A graph with the same degree sequence and approximately the same strength sequence of original `brain`
+
+    Raises
+    ------
+    TypeError: Exception
+        If `sort_freq` is not in the interval (0, 1]
+    """
+    if not 0 < sort_freq <= 1:
+        raise TypeError("generate_rand_from_strength() expects sort_freq to be in the interval (0, 1]")
+    if node_attrs is None:
+        node_attrs = []
+
+    nodes, src, dst, weights = _edge_arrays(brain.G)
+    strengths = np.bincount(src, weights=weights, minlength=len(nodes)) + \
+        np.bincount(dst, weights=weights, minlength=len(nodes))
+
+    _swap_edges(src, dst, len(nodes), n_swaps)
+
+    new_weights = np.empty(len(weights))
+    sorted_weights = np.sort(weights)
+    remaining = np.arange(len(weights))
+    while remaining.size:
+        # Ranking the edges left according to the strengths their nodes are still missing
+        expected = strengths[src[remaining]] * strengths[dst[remaining]]
+        ranks = np.empty(remaining.size, dtype=int)
+        ranks[np.argsort(expected, kind='mergesort')] = np.arange(remaining.size)
+
+        chosen = np.random.choice(remaining.size, int(np.ceil(sort_freq * remaining.size)), replace=False)
+        assigned = sorted_weights[ranks[chosen]]
+        new_weights[remaining[chosen]] = assigned
+        np.subtract.at(strengths, src[remaining[chosen]], assigned)
+        np.subtract.at(strengths, dst[remaining[chosen]], assigned)
+
+        # sorted_weights keeps being sorted after removing the assigned weights
+        sorted_weights = np.delete(sorted_weights, ranks[chosen])
+        remaining = np.delete(remaining, chosen)
+
+    return _graph_from_arrays(brain, nodes, src, dst, new_weights, node_attrs)
+
+
+def generate_spatial_rand(brain, n_bins=10, n_swaps=10, node_attrs=None):
+    """
+    It returns a graph with the same degree sequence as the brain specified as argument, and approximately the same
+    distribution of edge lengths. Thus, the random graph keeps the wiring cost of the original brain.
+
+    The pairwise euclidean distances between the nodes (from `Brain.node_coords()`) are split in `n_bins` bins with
+    the same number of original edges each. The original edges are then randomised with degree-preserving double edge
+    swaps which are only accepted when each new edge falls in the same distance bin as the edge it replaces. Each
+    edge keeps its `constants.WEIGHT`, so weights also keep their relation with the edge lengths.
+
+    Parameters
+    ----------
+    brain: maybrain.brain.Brain
+        An instance of the `Brain` class, whose nodes have the `constants.XYZ` property
+    n_bins: int
+        Number of bins in which the edge lengths are grouped. More bins preserve the edge length distribution
+        more closely, but accept less swaps
+    n_swaps: int
+        Number of swap attempts for each edge
+    node_attrs: list of str
+        If the node attributes of brain.G are necessary for a correct calculation of func()
+        in the random graph, just pass the attributes as a list of strings in this parameter.
+        This way, these node attributes from the original brain will be presented in the random graph's nodes.
+
+    Returns
+    -------
+    new_g: nx.Graph
+        A graph with the same degree sequence and edge length distribution of original `brain`
+
+    Raises
+    ------
+    KeyError: Exception
+        If the nodes don't have constants.XYZ property
+    """
+    if node_attrs is None:
+        node_attrs = []
+
+    nodes, src, dst, weights = _edge_arrays(brain.G)
+    try:
+        coords = brain.node_coords(nodes)
+    except KeyError as error:
+        import sys
+        _, _, tbb = sys.exc_info()
+        raise KeyError(error, "Node doesn't have constants.XYZ property").with_traceback(tbb)
+
+    # Precomputing the distance bin of every possible pair of nodes
+    dists = np.sqrt(((coords[:, np.newaxis, :] - coords[np.newaxis, :, :]) ** 2).sum(axis=2))
+    limits = np.percentile(dists[src, dst], np.linspace(0, 100, n_bins + 1)[1:-1])
+    bins = np.digitize(dists, limits)
+
+    def same_bins(a, b, c, d):
+        """ (a, d) must replace (a, b) and (c, b) must replace (c, d) in the same distance bins """
+        return bins[a, d] == bins[a, b] and bins[c, b] == bins[c, d]
+
+    _swap_edges(src, dst, len(nodes), n_swaps, criterion=same_bins)
+
+    return _graph_from_arrays(brain, nodes, src, dst, weights, node_attrs)
+
+
+def generate_lattice(brain, n_swaps=10, order=None, node_attrs=None):
+    """
+    It returns a lattice-like graph with the same degree sequence as the brain specified as argument, to be used as
+    the lattice reference in small-world measures.
+
+    The edges are rewired with degree-preserving double edge swaps which are only accepted when they bring the edges
+    closer to the diagonal of the adjacency matrix sorted by `order`. As in Sporns and Zwi (2004) and
+    `nx.lattice_reference`, the distance to the diagonal is taken in a ring, i.e., the first and last nodes of the
+    ordering are neighbours. Each edge keeps its `constants.WEIGHT`.
+
+    Parameters
+    ----------
+    brain: maybrain.brain.Brain
+        An instance of the `Brain` class
+    n_swaps: int
+        Number of swap attempts for each edge
+    order: list or "anatomical"
+        The ordering of the nodes defining the diagonal. If None, the order of the nodes in brain.G is used.
+        If "anatomical", the nodes are sorted by hemisphere, lobe and anatomical label of the default resources of
+        500 nodes, as in `plotting.plot_strength_matrix()`. Nodes of brain.G not in `order` are put at the end
+    node_attrs: list of str
+        If the node attributes of brain.G are necessary for a correct calculation of func()
+        in the random graph, just pass the attributes as a list of strings in this parameter.
+        This way, these node attributes from the original brain will be presented in the random graph's nodes.
+
+    Returns
+    -------
+    new_g: nx.Graph
+        A lattice-like graph with the same degree sequence of original `brain`
+    """
+    if node_attrs is None:
+        node_attrs = []
+
+    nodes, src, dst, weights = _edge_arrays(brain.G)
+
+    if isinstance(order, str) and order == "anatomical":
+        from maybrain import resources as rr
+        from maybrain.plotting.matrices import _get_anatomical_order
+        order, _ = _get_anatomical_order(None,
+                                         hemi_prop=rr.PROPERTIES_HEMISPHERES_500, hemi_name=ct.HEMISPHERE,
+                                         lobes_prop=rr.PROPERTIES_LOBES_500, lobes_name=ct.LOBE,
+                                         anat_prop=rr.PROPERTIES_ANATLABEL_500, anat_name=ct.ANAT_LABEL)
+    if order is None:
+        order = nodes
+
+    # Position of each node (by its index in nodes) along the diagonal
+    index = {n: i for i, n in enumerate(nodes)}
+    ordered = [index[n] for n in order if n in index]
+    in_order = set(ordered)
+    ordered.extend(i for i in range(len(nodes)) if i not in in_order)
+    pos = np.empty(len(nodes), dtype=int)
+    pos[ordered] = np.arange(len(nodes))
+    pos = pos.tolist()
+    n_nodes = len(nodes)
+
+    def ring_dist(x, y):
+        """ distance to the diagonal of an edge between nodes x and y """
+        dist = abs(pos[x] - pos[y])
+        return min(dist, n_nodes - dist)
+
+    def closer(a, b, c, d):
+        """ (a, d) and (c, b) must be closer to the diagonal than (a, b) and (c, d) """
+        return ring_dist(a, d) + ring_dist(c, b) < ring_dist(a, b) + ring_dist(c, d)
+
+    _swap_edges(src, dst, n_nodes, n_swaps, criterion=closer)
+
+    return _graph_from_arrays(brain, nodes, src, dst, weights, node_attrs)
+
+
+def _generate_random(brain, generator, generator_kwargs):
+    """ Private helper which calls the generator until it doesn't throw RandomGenerationError """
+    while True:
+        try:
+            return generator(brain, **generator_kwargs)
+        except RandomGenerationError:
+            pass
+
+
+_WORKER_ARGS = None  # (brain, generator, generator_kwargs) in each worker process of normalise()
+
+
+def _init_worker(brain, generator, generator_kwargs):
+    """ Private helper to set up each worker process of normalise() """
+    global _WORKER_ARGS
+    _WORKER_ARGS = (brain, generator, generator_kwargs)
+    # Forked processes inherit the random state, so it needs to be different in each worker
+    random.seed()
+    np.random.seed()
+
+
+def _generate_in_worker(_):
+    """ Private helper to generate a random graph in a worker process of normalise() """
+    return _generate_random(*_WORKER_ARGS)
+
+
+def _random_graphs(brain, n_iter, random_location, generator, generator_kwargs, n_jobs):
+    """ Private helper which yields the n_iter random graphs used in normalise() """
+    if random_location is not None:
+        for i in range(n_iter):
+            yield nx.read_gpickle(random_location + str(i))
+    elif n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                  initargs=(brain, generator, generator_kwargs)) as pool:
+            chunksize = max(1, n_iter // (4 * n_jobs))
+            for rand in pool.imap_unordered(_generate_in_worker, range(n_iter), chunksize=chunksize):
+                yield rand
+    else:
+        for _ in range(n_iter):
+            yield _generate_random(brain, generator, generator_kwargs)
+
+
 def normalise_single(brain, func, init_val=None, n_iter=500, ret_normalised=True, exact_random=False,
-                     node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+                     node_attrs=None, edge_attrs=None, random_location=None, generator=None,
+                     generator_kwargs=None, n_jobs=1, **kwargs):
     """
     See `normalise()` method's documentation for explanation. This method just expects a single
     initial measure (init_val) to be averaged, instead of a dictionary
@@ -145,11 +469,13 @@ def normalise_single(brain, func, init_val=None, n_iter=500, ret_normalised=True
 
     return normalise(brain, func, init_vals=init_val, n_iter=n_iter,
                      ret_normalised=ret_normalised, exact_random=exact_random,
-                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location, **kwargs)
+                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location,
+                     generator=generator, generator_kwargs=generator_kwargs, n_jobs=n_jobs, **kwargs)
 
 
 def normalise_node_wise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exact_random=False,
-                        node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+                        node_attrs=None, edge_attrs=None, random_location=None, generator=None,
+                        generator_kwargs=None, n_jobs=1, **kwargs):
     """
     See `normalise()` method's documentation for explanation. This method just expects init_vals
     to be a dictionary with the measures, for each node, that will be averaged
@@ -161,15 +487,20 @@ def normalise_node_wise(brain, func, init_vals=None, n_iter=500, ret_normalised=
 
     return normalise(brain, func, init_vals=init_vals, n_iter=n_iter,
                      ret_normalised=ret_normalised, exact_random=exact_random,
-                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location, **kwargs)
+                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location,
+                     generator=generator, generator_kwargs=generator_kwargs, n_jobs=n_jobs, **kwargs)
 
 
+@cached("normalise", uses_graph=True, ignore=("n_jobs",))
 def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exact_random=False,
-              node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+              node_attrs=None, edge_attrs=None, random_location=None, generator=None, generator_kwargs=None,
+              n_jobs=1, **kwargs):
     """
     It normalises measures taken from a brain by generating a series of n random graphs and averaging them.
 
-    Previously generated random graphs can be specified using parameter `random_location`
+    Previously generated random graphs can be specified using parameter `random_location`.
+    When the on-disk cache is enabled (see `utils.enable_cache()`), the result for the same graph and parameters
+    is taken from there, with func and generator identified by their names and code
 
     Parameters
     ----------
@@ -203,8 +534,17 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     random_location: str
         If the random graphs were previously generated, put here the location of them.
         Consider that for each iteration `i = 0...n_iter`, "i" will be added at the end of this path to get
-        each random graph. Otherwise, `algorithms.generate_rand_from_degree()` will be used to
-        create the random graphs
+        each random graph. Otherwise, `generator` will be used to create the random graphs
+    generator
+        The function used to create the random graphs, called as `generator(brain, node_attrs=node_attrs,
+        **generator_kwargs)`, like `algorithms.generate_rand_from_strength()`. If None,
+        `algorithms.generate_rand_from_degree()` is used, receiving `exact_random` and `edge_attrs`.
+        This is only used if random_location is None
+    generator_kwargs: dict
+        Keyword arguments if you need to pass them to generator()
+    n_jobs: int
+        Number of processes generating the random graphs in parallel. `brain`, `generator` and `generator_kwargs`
+        need to be picklable when this is bigger than 1. func() is always applied in the calling process
     kwargs
         Keyword arguments if you need to pass them to func()
 
@@ -244,19 +584,13 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     else:
         vals = []
 
-    for i in range(n_iter):
-        if random_location is not None:
-            rand = nx.read_gpickle(random_location + str(i))
-        else:
-            edge_attrs.append(ct.WEIGHT)
-            while True:
-                try:
-                    rand = generate_rand_from_degree(brain, throw_exception=exact_random,
-                                                     node_attrs=node_attrs, edge_attrs=edge_attrs)
-                    break  # if it reaches here, means randomiser didn't throw any exception, so break While
-                except RandomGenerationError:
-                    pass
+    generator_kwargs = dict(generator_kwargs or {}, node_attrs=node_attrs)
+    if generator is None:
+        generator = generate_rand_from_degree
+        generator_kwargs['throw_exception'] = exact_random
+        generator_kwargs['edge_attrs'] = edge_attrs + [ct.WEIGHT]
 
+    for rand in _random_graphs(brain, n_iter, random_location, generator, generator_kwargs, n_jobs):
         # Applying func() to the random graph
         res = func(rand, **kwargs)
 
@@ -5,7 +5,10 @@ import random
 import networkx as nx
 import numpy as np
 
+from maybrain.utils.cache import cached
 
+
+@cached("robustness", uses_graph=True)
 def robustness(brain, iter_len=500, window_size=50):
     """
     A function to calculate robustness based on "Error and attack
@@ -17,7 +20,8 @@ def robustness(brain, iter_len=500, window_size=50):
     a more accurate measure by a sliding window.
 
     Note, this function is relatively slow compared to other metrics due to
-    the multiple iterations.
+    the multiple iterations. Enable the on-disk cache (see `utils.enable_cache()`)
+    to reuse the result for the same graph and parameters.
 
     Parameters
     ----------
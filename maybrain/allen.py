@@ -5,15 +5,450 @@ Module for linking with the Allen brain atlas
 @author: tim
 """
 
-import maybrain.brainObj as mbo
-
 import csv
-from os import path,rename,remove
+import hashlib
+import multiprocessing
+import tempfile
+from os import path,rename,getpid,remove
 import numpy as np
 from scipy import stats
+from scipy.spatial import cKDTree
 from matplotlib import pyplot as plt
 from glob import glob
 
+from maybrain import brain as mbt
+from maybrain import constants as ct
+
+def _cacheBase(fileName, cacheDir=None):
+    """
+    Private helper which returns the base name of the cache files of fileName: the file itself, or a name in
+    cacheDir made unique by a hash of the absolute path of the file
+    """
+    if cacheDir is None:
+        return fileName
+    fileName = path.abspath(fileName)
+    digest = hashlib.md5(fileName.encode("utf-8")).hexdigest()[:16]
+    return path.join(cacheDir, digest + "_" + path.basename(fileName))
+
+def _readExpression(csvFile, chunkRows, exprFile=None):
+    """
+    Private helper which parses the expression csv file, a block of rows at a time so the whole file is never
+    held in memory as float64. The matrix is written to the .npy file exprFile if given, or kept in memory
+    """
+    f = open(csvFile, "r")
+    nProbes = sum(1 for line in f if line.strip())
+    f.seek(0)
+    nSamples = len(f.readline().split(',')) - 1
+    f.seek(0)
+
+    if exprFile is None:
+        expr = np.empty((nProbes, nSamples), dtype="float32")
+    else:
+        expr = np.lib.format.open_memmap(exprFile, mode="w+", dtype="float32", shape=(nProbes, nSamples))
+    probes = np.empty(nProbes, dtype="int64")
+
+    start = 0
+    while start < nProbes:
+        block = np.loadtxt(f, delimiter=",", max_rows=chunkRows, ndmin=2)
+        probes[start:start+len(block)] = block[:,0]
+        expr[start:start+len(block)] = block[:,1:]
+        start += len(block)
+    f.close()
+    return probes, expr
+
+def loadExpression(subj, maFile="MicroarrayExpression.csv", chunkRows=2000, cacheDir=None):
+    """
+    Loads the microarray expression of a donor as a float32 (probes x samples) matrix, whose columns are in the
+    same order as the samples in SampleAnnot.csv, together with the array of probe ids of its rows.
+
+    The csv file is only parsed the first time: the matrix is cached as a .npy file (and the probe ids in a
+    second one), which is memory-mapped afterwards. The cache is rebuilt if the csv file is newer. It is written
+    next to the csv file, or in cacheDir if given; if it can't be written, the matrix is parsed into memory.
+    """
+    csvFile = path.join(subj, maFile)
+    cacheBase = _cacheBase(csvFile, cacheDir)
+    exprCache = cacheBase + ".npy"
+    probeCache = cacheBase + ".probes.npy"
+
+    if not (path.exists(exprCache) and path.exists(probeCache) and
+            path.getmtime(exprCache) >= path.getmtime(csvFile)):
+        # written with temporary names and renamed, so other processes never pick up a partial cache
+        tmpExpr = "%s.%d.tmp" % (exprCache, getpid())
+        tmpProbes = "%s.%d.tmp" % (probeCache, getpid())
+        try:
+            probes, expr = _readExpression(csvFile, chunkRows, tmpExpr)
+            expr.flush()
+            del(expr)
+            with open(tmpProbes, "wb") as pf:
+                np.save(pf, probes)
+            rename(tmpProbes, probeCache)
+            rename(tmpExpr, exprCache)
+        except OSError:
+            if not path.exists(csvFile):
+                raise
+            # e.g. a read-only directory
+            for tmp in [tmpExpr, tmpProbes]:
+                if path.exists(tmp):
+                    remove(tmp)
+            return _readExpression(csvFile, chunkRows)
+
+    return np.load(probeCache), np.load(exprCache, mmap_mode="r")
+
+def _probeRows(probeIDs, probeNumbers, order=None):
+    """
+    Private helper which returns the rows of the expression matrix with the probes in probeNumbers, in the same
+    order, and -1 for the probes which are not found. order is np.argsort(probeIDs), if already known
+    """
+    probeNumbers = np.asarray(probeNumbers, dtype="int64")
+    if not len(probeIDs):
+        return np.full(len(probeNumbers), -1)
+    if order is None:
+        order = np.argsort(probeIDs, kind="mergesort")
+    rows = order[np.clip(np.searchsorted(probeIDs, probeNumbers, sorter=order), 0, len(order)-1)]
+    rows[probeIDs[rows] != probeNumbers] = -1
+    return rows
+
+def _nodesXYZ(G, nodes):
+    """
+    Private helper which returns an array with the 'xyz' coordinates of the nodes
+    """
+    return np.array([G.nodes[n][ct.XYZ] for n in nodes], dtype="float64").reshape((len(nodes), 3))
+
+def _closest(xyz, otherNodes, otherXYZ, excludeSelf=False):
+    """
+    Private helper which returns, for each point in xyz, a tuple (n,d) with the closest node of otherNodes and
+    the distance to it, using a KD-tree. As in the former pairwise loops, ties go to the first node in otherNodes
+    and (None, 999.) is returned if no node is closer than 999. If excludeSelf, xyz are the coordinates of
+    otherNodes and each node is not matched to itself
+    """
+    closest = [(None, 999.)] * len(xyz)
+    if len(otherXYZ) < (2 if excludeSelf else 1):
+        return closest
+
+    tree = cKDTree(otherXYZ)
+    dists = tree.query(xyz, k=2 if excludeSelf else 1)[0]
+    if excludeSelf:
+        dists = dists[:,1] # the first one is the node itself, or another one at the same distance
+
+    # all the nodes at the minimum distance (with a margin for rounding), to break ties as before
+    candidates = tree.query_ball_point(xyz, r=dists * (1 + 1e-9) + 1e-12)
+    for i,cands in enumerate(candidates):
+        cands = np.sort(cands)
+        if excludeSelf:
+            cands = cands[cands != i]
+        d = np.array([np.linalg.norm(xyz[i] - otherXYZ[c]) for c in cands]) # as the loops did, to keep exact ties
+        if len(d) and d.min() < 999.:
+            j = np.argmin(d)
+            closest[i] = (otherNodes[cands[j]], d[j])
+    return closest
+
+def probeCorrelations(expr, metric):
+    """
+    Calculates the Pearson correlation of the expression of each probe (the rows of expr, with a column for each
+    node) with metric (a value for each node), with one matrix product for all the probes. The two-sided p values
+    come from the t distribution with n-2 degrees of freedom, as in stats.pearsonr(). The nodes with NaN in a
+    probe are left out of its correlation.
+    Returns the arrays with the correlation coefficients and the p values
+    """
+    expr = np.asarray(expr, dtype="float64")
+    metric = np.asarray(metric, dtype="float64")
+    metric = metric - metric.mean()
+    valid = ~np.isnan(expr)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = valid.sum(axis=1)
+        dev = np.where(valid, expr - (np.where(valid, expr, 0.).sum(axis=1) / n)[:,np.newaxis], 0.)
+        metricMean = valid.dot(metric) / n
+        metricSS = valid.dot(metric**2) - n * metricMean**2 # sum of squares of metric around its mean in each probe
+        r = dev.dot(metric) / np.sqrt((dev**2).sum(axis=1) * metricSS)
+        r = np.clip(r, -1., 1.)
+
+        df = n - 2
+        t = r * np.sqrt(df / ((1. - r) * (1. + r)))
+        p = 2 * stats.t.sf(np.abs(t), df)
+    p[df < 1] = np.nan
+    return r, p
+
+def fdrCorrection(p):
+    """
+    Returns the p values adjusted with the Benjamini-Hochberg procedure, to control the false discovery rate.
+    NaN values are ignored
+    """
+    p = np.asarray(p, dtype="float64")
+    adjusted = np.full(p.shape, np.nan)
+    valid = np.nonzero(~np.isnan(p))[0]
+    order = valid[np.argsort(p[valid], kind="mergesort")]
+    ranked = p[order] * len(order) / np.arange(1, len(order)+1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.)
+    return adjusted
+
+def _imap(func, args, nJobs):
+    """
+    Private helper which yields func applied to each element of args, in order, running them in a pool of
+    nJobs processes if nJobs > 1
+    """
+    if nJobs > 1 and len(args) > 1:
+        with multiprocessing.Pool(min(nJobs, len(args))) as pool:
+            for v in pool.imap(func, args):
+                yield v
+    else:
+        for v in args:
+            yield func(v)
+
+def _loadDonor(args):
+    """
+    Private helper which reads the samples of a donor, as a dictionary of arrays: 'sID' with the structure ID
+    (sLab) of each sample, 'xyz' with their coordinates (converted from MNI space if convertMNI) and 'annot'
+    with all the columns of the file. If maFile is given, the expression matrix is also cached, so it can run in
+    a worker process
+    """
+    subj, fName, sLab, convertMNI, maFile = args
+    f = open(path.join(subj, fName), "r", newline="")
+    reader = csv.reader(f, delimiter=",", quotechar='"')
+    headers = next(reader)
+    rows = [l for l in reader if l]
+    f.close()
+
+    annot = {h:np.array([l[c] for l in rows], dtype=str) for c,h in enumerate(headers)}
+    xyz = np.column_stack([annot[v].astype("float64") for v in ['mni_x', 'mni_y', 'mni_z']]).reshape((len(rows), 3))
+    if convertMNI:
+        # convert location data for Allen brain from MNI space
+        xyz = np.array([45., 63., 36.]) + xyz * np.array([-0.5, 0.5, 0.5])
+
+    if maFile:
+        loadExpression(subj, maFile)
+    return {'sID':annot[sLab], 'xyz':xyz, 'annot':annot}
+
+def _donorExpression(probeIDs, expr, probeNumbers):
+    """
+    Private helper which returns the rows of expr with the probes in probeNumbers, NaN for those not found
+    """
+    rows = _probeRows(probeIDs, probeNumbers)
+    values = np.full((len(rows), expr.shape[1]), np.nan, dtype="float32")
+    values[rows >= 0] = expr[rows[rows >= 0]]
+    return values
+
+def _donorSums(args):
+    """
+    Private helper which returns _nodeSums() for the probes in probeNumbers of a donor, in a worker process
+    """
+    subj, maFile, probeNumbers, sampleIDs, acronyms = args
+    probeIDs, expr = loadExpression(subj, maFile)
+    values = np.asarray(_donorExpression(probeIDs, expr, probeNumbers), dtype="float64")
+    return _nodeSums(values, _nodeSamples(sampleIDs, acronyms))
+
+def _nodeSamples(sampleIDs, acronyms):
+    """
+    Private helper which returns a (samples x nodes) matrix, with 1 where the sample is in the structure of the
+    allen node matched to the MRI node
+    """
+    return (np.asarray(sampleIDs)[:,np.newaxis] == np.asarray(acronyms)[np.newaxis,:]).astype("float64")
+
+def _nodeSums(values, nodeSamples):
+    """
+    Private helper which z-scores the expression levels of each probe (rows of values) within a subject, across
+    the samples matched to all the MRI nodes. It returns the sum, the sum of squares and the number of the
+    normalised values in each (probe, node), ignoring NaNs
+    """
+    weights = nodeSamples.sum(axis=1) # a sample counts once for each MRI node it is matched to
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = valid.dot(weights)
+        mean = np.where(valid, values, 0.).dot(weights) / n
+        dev = np.where(valid, values - mean[:,np.newaxis], 0.)
+        std = np.sqrt((dev**2).dot(weights) / n)
+        z = dev / std[:,np.newaxis]
+    valid &= (std > 0.)[:,np.newaxis]
+    z[~valid] = 0.
+    return z.dot(nodeSamples), (z**2).dot(nodeSamples), valid.dot(nodeSamples)
+
+def _meanSd(sums, sumSq, counts):
+    """
+    Private helper which returns the mean and the standard deviation from the sums of _nodeSums()
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        return mean, np.sqrt(np.maximum(sumSq / counts - mean**2, 0.))
+
+def _probeGeneMeans(donors, probeNumbers, genes, acronyms, nodes, sdFile=None, blockSize=2000, scratchDir=None,
+                    nJobs=1):
+    """
+    Private helper which calculates the mean across donors of the normalised expression of each probe in the
+    samples of each node, and collapses them by gene (genes are the genes of probeNumbers). donors is a list of
+    (subj, maFile, sampleIDs). If sdFile is given, the standard deviation of each probe in each node is written
+    there.
+
+    The probes are processed blockSize at a time, with the donors of each block in a pool of nJobs processes, so
+    the memory used is bounded by the block size. It returns the sorted names of the genes, the (genes x nodes)
+    means and the (probes x nodes) means, memory-mapped to an anonymous temporary file in scratchDir
+    """
+    geneNames, codes = np.unique(np.asarray(genes, dtype=str), return_inverse=True)
+    geneSums = np.zeros((len(geneNames), len(nodes)))
+    geneCounts = np.zeros((len(geneNames), len(nodes)))
+
+    shape = (len(probeNumbers), len(nodes))
+    if shape[0] * shape[1]:
+        probeMat = np.memmap(tempfile.TemporaryFile(dir=scratchDir, prefix="probeMat"), dtype="float64",
+                             mode="w+", shape=shape)
+    else:
+        probeMat = np.zeros(shape)
+
+    if sdFile:
+        sdOut = open(sdFile, "w")
+        sdOut.writelines("Probe Node sd\n")
+        sdNodes = [str(v) for v in nodes]
+
+    # tasks ordered by block and then by donor
+    starts = range(0, len(probeNumbers), blockSize)
+    args = [(subj, maFile, probeNumbers[start:start+blockSize], sampleIDs, acronyms)
+            for start in starts for subj,maFile,sampleIDs in donors]
+    results = _imap(_donorSums, args, nJobs)
+
+    for start in starts:
+        # add up the donors of the block, and collapse across nodes within regions
+        sums, sumSq, counts = 0., 0., 0.
+        for _ in donors:
+            subjSums = next(results)
+            sums, sumSq, counts = sums + subjSums[0], sumSq + subjSums[1], counts + subjSums[2]
+        blockMeans, blockSd = _meanSd(sums, sumSq, counts)
+        probeMat[start:start+len(blockMeans)] = blockMeans
+
+        if sdFile:
+            for probe,row in zip(probeNumbers[start:start+blockSize], blockSd):
+                sdOut.writelines(' '.join([probe, n, "{:2.5f}".format(v)])+'\n' for n,v in zip(sdNodes, row))
+
+        # collapse across probes by gene, ignoring NaNs
+        valid = ~np.isnan(blockMeans)
+        np.add.at(geneSums, codes[start:start+blockSize], np.where(valid, blockMeans, 0.))
+        np.add.at(geneCounts, codes[start:start+blockSize], valid)
+
+    if sdFile:
+        sdOut.close()
+    if isinstance(probeMat, np.memmap):
+        probeMat.flush()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return list(geneNames), geneSums / geneCounts, probeMat
+
+def _writeX(outFile, geneNames, geneMat, nodes):
+    """
+    Private helper which writes the X matrix, with a row for each gene and a column for each node
+    """
+    out = open(outFile, "w", newline="")
+    writer = csv.writer(out, delimiter=" ")
+    writer.writerow(["Gene"] + [str(v) for v in nodes])
+    writer.writerows([gene] + ["{:10.20f}".format(v) for v in row] for gene,row in zip(geneNames, geneMat))
+    out.close()
+
+def _sampleColumns(sampleIDs):
+    """
+    Private helper which returns a dictionary with the column of the expression matrix for each structure ID.
+    As with csv.DictReader, the last sample is taken for repeated structures
+    """
+    return {sID:c for c,sID in enumerate(sampleIDs)}
+
+class probeIndex:
+    """
+    Index of the probes in Probes.csv and their genes, for lookups of probes by gene
+    without parsing the csv file again. The probes are kept in the order of the file.
+    """
+    _loaded = {} # indexes already loaded in this process, by file
+
+    def __init__(self, probeIDs, geneSymbols, geneNames):
+        self.probeIDs = np.asarray(probeIDs, dtype="int64")
+        self.geneSymbols = np.asarray(geneSymbols, dtype=str)
+        self.geneNames = np.asarray(geneNames, dtype=str)
+
+        self._byID = np.argsort(self.probeIDs, kind="mergesort")
+        # positions of the probes sorted by gene symbol, and where each gene starts
+        self._bySymbol = np.argsort(self.geneSymbols, kind="mergesort")
+        self._symbols = self.geneSymbols[self._bySymbol]
+        self.genes, starts = np.unique(self._symbols, return_index=True)
+        self._geneStarts = np.append(starts, len(self._symbols))
+
+    @classmethod
+    def load(cls, subj, probeFile="Probes.csv", cacheDir=None):
+        """
+        Returns the index of <subj>/<probeFile>. The csv file is only parsed the first time: the
+        index is cached as a .npz file, next to it or in cacheDir if given, and kept in memory for
+        the rest of the session. If the cache can't be written, the index is only kept in memory.
+        """
+        csvFile = path.abspath(path.join(subj, probeFile))
+        key = (csvFile, path.getmtime(csvFile))
+        if key in cls._loaded:
+            return cls._loaded[key]
+
+        cache = _cacheBase(csvFile, cacheDir) + ".index.npz"
+        if path.exists(cache) and path.getmtime(cache) >= key[1]:
+            data = np.load(cache)
+            index = cls(data['probeIDs'], data['geneSymbols'], data['geneNames'])
+        else:
+            f = open(csvFile, "r", newline="")
+            rows = [(l['probe_id'], l['gene_symbol'], l['gene_name'])
+                    for l in csv.DictReader(f, delimiter=",", quotechar='"')]
+            f.close()
+            probeIDs, geneSymbols, geneNames = zip(*rows) if rows else ([], [], [])
+            index = cls(probeIDs, geneSymbols, geneNames)
+
+            # written with a temporary name and renamed, so other processes never pick up a partial cache
+            tmpCache = "%s.%d.tmp" % (cache, getpid())
+            try:
+                with open(tmpCache, "wb") as cf:
+                    np.savez(cf, probeIDs=index.probeIDs, geneSymbols=index.geneSymbols, geneNames=index.geneNames)
+                rename(tmpCache, cache)
+            except OSError: # e.g. a read-only directory
+                if path.exists(tmpCache):
+                    remove(tmpCache)
+
+        cls._loaded[key] = index
+        return index
+
+    def rows(self, probeNumbers):
+        """
+        Returns the positions of the probes in the index, -1 for those not found
+        """
+        return _probeRows(self.probeIDs, probeNumbers, self._byID)
+
+    def geneRows(self, gene):
+        """
+        Returns the positions of the probes of a gene (by gene symbol), in the order of the file
+        """
+        i = np.searchsorted(self.genes, gene)
+        if i == len(self.genes) or self.genes[i] != gene:
+            return np.array([], dtype="int64")
+        return np.sort(self._bySymbol[self._geneStarts[i]:self._geneStarts[i+1]])
+
+    def search(self, terms, match="substring"):
+        """
+        Returns the ids (as strings) of the probes of the genes matching any of the terms:
+        "exact" for the gene symbol, "prefix" for gene symbols starting with the term, or
+        "substring" for gene symbols or names containing the term
+        """
+        if match not in ["exact", "prefix", "substring"]:
+            raise TypeError("Not a valid match for search()")
+
+        rows = []
+        for t in terms:
+            if match == "exact":
+                rows.append(self.geneRows(t))
+            elif match == "prefix":
+                lo = np.searchsorted(self._symbols, t, side="left")
+                hi = np.searchsorted(self._symbols, t + chr(0x10FFFF), side="left")
+                rows.append(np.sort(self._bySymbol[lo:hi]))
+            else:
+                rows.append(np.nonzero((np.char.find(self.geneNames, t) >= 0) |
+                                       (np.char.find(self.geneSymbols, t) >= 0))[0])
+        rows = np.concatenate(rows) if rows else np.array([], dtype="int64")
+        return [str(v) for v in self.probeIDs[rows]]
+
+    def genesOf(self, probeNumbers):
+        """
+        Returns the gene symbols of the probes, an empty string for those not found
+        """
+        rows = self.rows(probeNumbers)
+        if not len(self.geneSymbols):
+            return np.full(len(rows), "")
+        return np.where(rows >= 0, self.geneSymbols[rows], "")
+
 class allenBrain:
     """
     
@@ -31,6 +466,8 @@ class allenBrain:
         self.fName = "SampleAnnot.csv"
         self.maFile = "MicroarrayExpression.csv"
         self.probeFile = "Probes.csv"
+        self.probeIDs = None # probe ids and expression matrix, loaded the first time they are needed
+        self.expr = None
 
         # if symmetrise is true then regions are identified by the structure name,
         # if symmetrise is false, then regions are identified by the structural acronym
@@ -46,63 +483,29 @@ class allenBrain:
             self.mirror = False
             
         # set up brain for expression data
-        self.a = mbo.brainObj()
-        
-        node_counter = 0
-      
-        # import probe data
-        f = open(path.join(self.subj, self.fName), "rb")        
-        reader = csv.DictReader(f, delimiter=",", quotechar='"')
+        self.a = mbt.Brain()
+
+        # import sample data
+        donor = _loadDonor((self.subj, self.fName, self.sLab, convertMNI, None))
       
         self.headers = ['probe']
         self.sIDDict = {}
-        
-        ### deprecated code for removal ####
-#        for l in reader:
-#            n = int(l[self.sLab])
-#            self.a.G.add_node(n)
-#            self.a.G.node[n] = l
-#            self.headers.append(l["structure_id"])
-#        f.close()
-        
-        for l in reader:
-           # n = int(l["structure_id"])
-           sID = l[self.sLab]
-           n = node_counter # GIVE NODES UNIQUE INCREMENTAL ID (across all subjects)
-           if not self.a.G.has_node(n):
-               self.a.G.add_node(n)
-               self.a.G.node[n] = l
-               self.a.G.node[n]['sID'] = sID # store the structure_acronym/structure_name for the node
-               node_counter += 1
-               # self.headers[subj].append(l["structure_id"])
-               self.headers.append(sID) #STORE structure_acronym or structure_name depending on symmetrise
-               
-               if not sID in list(self.sIDDict.keys()):
-                   self.sIDDict[sID] = [n]
-               else:
-                   self.sIDDict[sID].append(n)
-        f.close()
-      
-        if convertMNI:
-            # convert location data for Allen brain from MNI space
-             for n in self.a.G.nodes():
-                 x = 45 - (float(self.a.G.node[n]['mni_x'])/2)
-                 y = 63 + (float(self.a.G.node[n]['mni_y'])/2)
-                 z = 36 + (float(self.a.G.node[n]['mni_z'])/2)
-                 self.a.G.node[n]['xyz'] = (x,y,z)
-        else:
-            for n in self.a.G.nodes():
-                x = float(self.a.G.node[n]['mni_x'])
-                y = float(self.a.G.node[n]['mni_y'])
-                z = float(self.a.G.node[n]['mni_z'])
-                self.a.G.node[n]['xyz'] = (x,y,z)
+        annot = {h:v.tolist() for h,v in donor['annot'].items()}
+        for n,sID in enumerate(donor['sID'].tolist()):
+            # GIVE NODES UNIQUE INCREMENTAL ID
+            self.a.G.add_node(n)
+            self.a.G.nodes[n].update({h:annot[h][n] for h in annot})
+            self.a.G.nodes[n]['sID'] = sID # store the structure_acronym/structure_name for the node
+            self.a.G.nodes[n][ct.XYZ] = tuple(donor['xyz'][n].tolist())
+            self.headers.append(sID) #STORE structure_acronym or structure_name depending on symmetrise
+            self.sIDDict.setdefault(sID, []).append(n)
         
         # copy hemisphere if required
         if self.mirror and len(self.a.G.nodes()) < 600:
             self.a.copy_hemisphere()
             
         # set up brain with graph properties
-        self.c = mbo.brainObj()
+        self.c = mbt.Brain()
         self.c.import_adj_file(assocMat, delimiter=delim,
                                nodes_to_exclude=nodesToExclude)
         self.c.import_spatial_info(spatialFile)
@@ -112,56 +515,35 @@ class allenBrain:
         # keys are the mri nodes and values are disctionaries containing two keys: 
         # key 1= allen, value= (n=id of closest allen node, d=distance to closest allen node)
         # key 2= mri, value= (n=id of closest other mri node, d=distance to closest mri node)
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        cXYZ = _nodesXYZ(self.c.G, cNodes)
+        aXYZ = _nodesXYZ(self.a.G, aNodes)
 
-        nodeDictMRIs = {}
-      
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-            dOwn = (None, 999.)
-      
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-          
-            for n in [v for v in self.c.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
-            nodeDictMRIs[node] = {"allen":dOther, "MRIs":dOwn}
+        dOther = _closest(cXYZ, aNodes, aXYZ)
+        dOwn = _closest(cXYZ, cNodes, cXYZ, excludeSelf=True)
+        nodeDictMRIs = {node:{"allen":dOther[i], "MRIs":dOwn[i]} for i,node in enumerate(cNodes)}
       
         # set up dictionary to link nodes from probe data and graph
-        nodeDictAllen = {}
-        for node in self.a.G.nodes():
-            dOther = (None, 999.)
-            dOwn = (None, 999.)
-          
-            for n in self.c.G.nodes():
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-          
-            for n in [v for v in self.a.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
-            nodeDictAllen[node] = {"allen":dOwn, "MRIs":dOther}
+        dOther = _closest(aXYZ, cNodes, cXYZ)
+        dOwn = _closest(aXYZ, aNodes, aXYZ, excludeSelf=True)
+        nodeDictAllen = {node:{"allen":dOwn[i], "MRIs":dOther[i]} for i,node in enumerate(aNodes)}
       
         nodePairs = []
         # for each MRI node
         for node in list(nodeDictMRIs.keys()):
             # find closest allen node 'n'
             n = nodeDictMRIs[node]['allen'][0]
-            self.c.G.node[node]['pair'] = n
-            self.a.G.node[n]['pair'] = node
+            self.c.G.nodes[node]['pair'] = n
+            self.a.G.nodes[n]['pair'] = node
             nodePairs.append((node,n))
             # if there is no other MRI node closer to the current MRI region 
             # if nodeDictMRIs[node]['allen'][1] < nodeDictMRIs[node]['MRIs'][1]:
             # if there is also no other MRI node closer to this allen region then match
             #     n = nodeDictMRIs[node]['allen'][0]
             #     if nodeDictAllen[n]['MRIs'][0] == node:
-            #         self.c.G.node[node]['pair'] = n
-            #         self.a.G.node[n]['pair'] = node
+            #         self.c.G.nodes[node]['pair'] = n
+            #         self.a.G.nodes[n]['pair'] = node
             #         nodePairs.append((node,n))
             #     else:
             # if there is another MRI node closer to this allen region then delete current regions (and do not match it)
@@ -169,310 +551,200 @@ class allenBrain:
             # else:
             #     self.c.G.remove_node(node)
       
-        for node in self.a.G.nodes():
-            if not 'pair' in list(self.a.G.node[node].keys()):
+        for node in list(self.a.G.nodes()):
+            if not 'pair' in self.a.G.nodes[node]:
                 self.a.G.remove_node(node)             
                   
     def doPlot(self):
-        self.a.importSkull("/usr/share/data/fsl-mni152-templates/MNI152_T1_2mm_brain.nii.gz")
-        p = mbo.plotObj()
-        p.plot_skull(self.a, contourVals = [3000, 9000])
-        p.plot_brain_coords(self.c, nodes =  self.c.G.nodes(),
-                            col=(1,0,0), sizeList=5)
-        p.plotBrainCoord(self.a, nodes = self.a.G.nodes(),
-                                     col=(0,0,1), sizeList=5)
-        self.saveFig()
+        from maybrain.plotting.mayavi_wrapper import MayaviWrapper
+        self.a.import_background("/usr/share/data/fsl-mni152-templates/MNI152_T1_2mm_brain.nii.gz")
+        p = MayaviWrapper()
+        p.plot_skull(self.a, contour_vals=[3000, 9000])
+        p.plot_brain_coords(self.c, nodes=list(self.c.G.nodes()), col=(1,0,0), size_list=5)
+        p.plot_brain_coords(self.a, nodes=list(self.a.G.nodes()), col=(0,0,1), size_list=5)
+        p.show()
+
+    def expression(self):
+        """
+        Returns the probe ids and the (probes x samples) expression matrix of the donor, see loadExpression()
+        """
+        if self.expr is None:
+            self.probeIDs, self.expr = loadExpression(self.subj, self.maFile)
+        return self.probeIDs, self.expr
                                     
     def probeData(self, propDict, graphMetric="gm", nodeList=None, plot=False,
-                  probeList=[], probeNumbers=[], sigVal=1.0, T=False):
+                  probeList=[], probeNumbers=[], sigVal=1.0, T=False, fdr=False, match="substring"):
         '''
-        
+        Correlates the graph metric in propDict (a value for each MRI node) with the expression
+        of each probe in the matched allen nodes. The probes are those of the genes matching
+        any string in probeList (see probeIndex.search() for match), or else probeNumbers, or
+        else all of them.
+        The probes with p < sigVal (the Benjamini-Hochberg adjusted p if fdr) are written in
+        <subj>/<graphMetric>.txt, and the results of all of them kept in self.probeResults
         '''
         self.gm=graphMetric
         self.sigVal=sigVal
       
-        probes = open(path.join(self.subj,"Probes.csv"), "rb")
-        probeReader = csv.DictReader(probes, delimiter=",",
-                                     quotechar='"')
-        self.probeDict = {l['probe_id']:[l['gene_symbol'], l['gene_name']] for l in probeReader}
+        self.probes = probeIndex.load(self.subj, self.probeFile)
         if probeList:
-            probeNumbers = []
-            for p in probeList:
-                probeNumbers.extend([v for v in list(self.probeDict.keys()) if any([p in self.probeDict[v][1], p in self.probeDict[v][0]])])
+            probeNumbers = self.probes.search(probeList, match)
             print((" ".join(["Probe numbers:", ' '.join(probeNumbers)])))
       
-        else:
-            probeNumbers = None
-      
         self.outFile = path.join(self.subj, self.gm+'.txt')
         print(("Saving data in:"+self.outFile))
         if path.exists(self.outFile):
             rename(self.outFile, self.outFile+'.old')
-        f = open(self.outFile,"w")
-        f.writelines(','.join(['probe_id', 'gene_name', 'r','p\n']))
-        f.close()
 
         self.propDict = propDict
                               
         if nodeList:
-            for node in self.c.G.nodes():
+            for node in list(self.c.G.nodes()):
                 if not node in nodeList:
-                    self.a.G.remove_node(self.c.G.node[node]['pair'])
+                    self.a.G.remove_node(self.c.G.nodes[node]['pair'])
                     self.c.G.remove_node(node)
       
-        # import probe data
-        f = open(path.join(self.subj, self.maFile), "rb")
-        reader = csv.DictReader(f, delimiter=",",
-                                fieldnames=self.headers,
-                                quotechar='"')
-      
-        for l in reader:
-            if T:
-                self.probeSubT(l, plot, probeNumbers)
-            else:
-                self.probeSub(l, plot, probeNumbers)
-        f.close()
-       
-    def writeXMatrix(self, outFile="Xmatrix.csv", probeNumbers=None, tempMatName="tempMat.txt", sd=False, sdFile="NodesSd.txt"):
-       # get all probes if otherwise unspecified
-       if not probeNumbers:
-           f = open(path.join(self.subj, self.probeFile))
-           reader = csv.DictReader(f, delimiter=",", quotechar='"')
-           probeNumbers = [l['probe_id'] for l in reader]
-           del(reader)
-           f.close()  
-  
-       # set up out file
-       out = open(self.subj+outFile, "wb")
-       headers = ["Gene"]
-       headers.extend([str(v) for v in self.c.G.nodes()])
-       writer = csv.DictWriter(out, fieldnames = headers, delimiter=" ")
-       writer.writeheader()
-      
-       # set up matrix
-       y = len(probeNumbers)
-       z = len(self.c.G.nodes())
-       sT = np.max([len(list(self.sIDDict.values()))]) # max numbers of nodes for any region
-       
-       probeMat = np.memmap(tempMatName,
-                            dtype="float64",
-                            mode="w+",
-                            shape=(y,z,sT))
-                           
-       # set up gene list
-       geneFlag = True
-       pFile = open(path.join(self.subj, self.probeFile))
-       pReader = csv.DictReader(pFile, delimiter=",", quotechar='"')
-       pDict = {l['probe_id']:l['gene_symbol'] for l in pReader}
-       geneList = list(pDict.values())
-       set(geneList)
-       geneList = {gene:[] for gene in geneList}
-       
-       sIDList = [v for v in self.headers if not v=='probe']
-       sIDList = set(sIDList)
-       
-       # get the corresponding node names in the MRI graph
-       # cNodes is a dict whose keys are all the MRI nodes and values are the matched alen nodes
-       #### PV modified line below which constructed cNodes by looping through allen nodes
-       # but with PV's lax matching criteria several mri nodes can be matched to same allen node
-       # the mri pair of these allen nodes gets overwritten in self.a.G.nodes and so not all mri nodes will appear 
-       # as pairs of allen nodes in this dict... need to look up pairs in self.c.G.nodes instead, where
-       # each mri node is matched to an allen region
-       # cNodes = {str(self.a.G.node[v]['pair']):v for v in self.a.G.nodes()}
-       
-       cNodes = {str(v):self.c.G.node[v]['pair'] for v in self.c.G.nodes()}
-       
-       # assign values to matrix
-       print((str(self.subj)))
-       print('\n')
-       # Generate custom fieldnames list for DictReader which doesn't rely on structure_id
-       # *************************************
-       fieldnames_pv = ['probe']
-       myNodeDict = {}
-       tempHeaders = self.headers
-       tempHeaders.remove('probe')
-
-       for p,q in enumerate(self.headers):
-           myNodeDict[p] = q
-           fieldnames_pv.append(str(p))   #####
-       # *************************************
-
-       # import probe data
-       f = open(path.join(self.subj, self.maFile), "rb")
-       reader = csv.DictReader(f, delimiter=",",
-                               fieldnames=fieldnames_pv,
-                               quotechar='"')
-       y = 0
-       for l in reader:
-           probe = l['probe']
-           if probe in probeNumbers:
-               # assign probe values to sample numbers
-               for z,cNode in enumerate(self.c.G.nodes()):
-                   aNode = cNodes[str(cNode)]
-                   # *************************************
-                   # Find structure_acronym corresponding to the matched allen node
-                   acronym = self.a.G.node[aNode][self.sLab]
-                   # Initialise list for summing expression values for allen nodes with same structure_acronym
-                   totalExpression = []
-                   # Loop over allen nodes to find all those with the correct acronym for the current MRI node
-                   # and add their expression values to the list for averaging
-                   s=0
-                   for ID, struct_ac in list(myNodeDict.items()):
-                       if struct_ac == acronym:
-                           # print(ID, struct_ac, l[str(ID)])
-                           # print('\n')
-                           # if l[str(ID)]:
-                           totalExpression.append(float(l[str(ID)]))
-                           probeMat[y,z,s] = float(l[str(ID)])
-                           s+=1
-                           
-               if geneFlag:
-                   geneList[pDict[probe]].append(y)  # records the position of the probe in a dictionary with genes as a key
-               y+=1
-       f.close()
-       del(reader)
-
-       # get values to normalise expression levels for each probe within subject
-       for y in range(probeMat.shape[0]):
-           # create a masked array removing the 0. values
-           subjMat = np.ma.array(probeMat[y,:,sT:sT],
-                                 mask=probeMat[y,:,sT:sT]==0.,
-                                 dtype="float64")
-
-           subjMat = (subjMat - np.mean(np.ma.array(subjMat, mask=subjMat==0.))) / np.std(np.ma.array(subjMat, mask=subjMat==0.))
-           probeMat[y,:,sT:sT] = subjMat
-
-       geneFlag=False
-      
-       # collapse across subjects and probes by gene
-       geneNames = list(geneList.keys())
-       geneNames.sort() # sort in to alphabetical order
-       
-       # collapse across nodes within regions (averaging across all subjects)
-       # probeMat = np.mean(np.ma.array(probeMat, mask=probeMat==0.), axis=3) # this would work, but runs in to memory problems
-       sh = probeMat.shape
-       probeMatTemp = np.memmap("probeMatTemp.txt", mode="w+", dtype="float64", shape=sh[:2])
-
-       # write out the standard deviation for each probe if specified
-       if sd:
-           sdOut = open(sdFile, "wb")
-           sdOut.writelines("Probe Node sd\n")
-       for y in range(sh[0]):
-           for z in range(sh[1]):
-               probeMatTemp[y,z] = np.mean(np.ma.array(probeMat[y,z], mask=probeMat[y,z]==0.)) # mask out unused values, ie where there are less than the maximum number of homolous nodes in a structural region
-               if sd:
-                   std = np.std(np.ma.array(probeMat[y,z], mask=probeMat[y,z]==0.))
-                   sdOut.writelines(' '.join([str(int(probeNumbers[y])), str(self.c.G.nodes()[z]), "{:2.5f}".format(std)])+'\n')
-       if sd:
-           sdOut.close()
-       
-       # reassign the probe matrix and delete temporary memory-mapped file
-       probeMat = probeMatTemp
-       del(probeMatTemp)
-       remove(tempMatName)
-       
-       for g,gene in enumerate(geneNames):
-           if (geneList[gene]):
-               x = probeMat.shape[1] # number of nodes
-               y = len(geneList[gene]) # number of probes
-                              
-               geneMat = np.zeros(shape=(x,y), dtype="float64")
-              
-               for n,p in enumerate(geneList[gene]): # nb: p is the position of the probe recorded above
-                   geneMat[:,n] = probeMat[p,:]
-                              
-               self.geneMat = geneMat
-               meanGene = np.mean(np.ma.array(geneMat, mask=np.isnan(geneMat)), axis=1) # collapse values across probes for each gene
-              
-               outDict = dict(list(zip([str(v) for v in self.c.G.nodes()], ["{:10.20f}".format(v) for v in meanGene])))
-               outDict["Gene"] = gene
-               writer.writerow(outDict)
-      
-       self.geneList = geneList
-       self.probeMat = probeMat
-       out.close()
-       remove("probeMatTemp.txt") # delete memory map file
-       
-    def probeSub(self, l, plot, probeNumbers=None):
-        probe = l['probe']
-        if probeNumbers:
-            if probe in probeNumbers:
-                # assign probe values to sample numbers
-                for node in self.a.G.nodes():
-                    sID = self.a.G.node[node][self.sLab]
-                    if l[sID]:
-                        self.a.G.node[node][probe] = l[sID]
-                    else:
-                        self.a.G.node[node][probe] = None
-              
-                aa = np.zeros((len(self.c.G.nodes()),3))
-                
-                for n,cnode in enumerate(self.c.G.nodes()):
-                    node = self.c.G.node[cnode]['pair']
-                    if self.propDict[self.a.G.node[node]['pair']]:
-                        aa[n,0] = self.a.G.node[node][probe]
-                        aa[n,1] = self.propDict[cnode]
-                        aa[n,2] = cnode
-                    else:
-                        aa[n,:] = [np.nan, np.nan, np.nan]
-              
-                aa = aa[~np.isnan(aa)]
-                aa.shape = (len(aa)/3,3)
-                
-                r,p = stats.pearsonr(aa[:,0], aa[:,1])
-              
-                if p < self.sigVal:
-                    print(probe)
-                    # plot graph
-                    out = open(self.outFile, "a")
-                    out.writelines(','.join([str(v) for v in [probe, '"'+self.probeDict[probe][1]+'"', r, p]])+'\n')
-                    out.close()
-                    if plot:
-                        plt.scatter(aa[:,1], aa[:,0])
-                        plt.savefig(self.outFile.replace('.txt',probe+'.png'), dpi=300)
-                        plt.close()
-                  
-                    # save data
-                    print(("Saving data in :"+self.outFile.replace('.txt', probe+self.gm+'.txt')))
-                    datFile = open(self.outFile.replace('.txt', probe+self.gm+'.txt'), "wb")
-                    datFile.writelines(' '.join([probe, self.gm, "node", "subj"])+'\n')
-                    datFile.writelines('\n'.join([' '.join([str(aa[n,0]), str(aa[n,1]), str(aa[n,2]), self.subj]) for n in range(len(aa[:,1]))]))
-                    datFile.close()
+        # select the rows of the probes, in the order of the expression file
+        probeIDs, expr = self.expression()
+        if probeList or probeNumbers:
+            rows = _probeRows(probeIDs, probeNumbers)
+            rows = np.sort(rows[rows >= 0])
+        else:
+            rows = np.arange(len(probeIDs))
+        columns = _sampleColumns(self.headers[1:])
+
+        if T:
+            for row in rows:
+                self.probeSubT(str(probeIDs[row]), expr[row], plot, columns)
         else:
-            pass
+            self.probeSub([str(v) for v in probeIDs[rows]], expr[rows], plot, columns, fdr)
+       
+    def writeXMatrix(self, outFile="Xmatrix.csv", probeNumbers=None, tempMatName="tempMat.txt", sd=False, sdFile="NodesSd.txt",
+                     blockSize=2000, scratchDir=None):
+        """
+        Writes the expression of each gene in each MRI node: the mean of the normalised expression levels of the
+        samples in the structure of the matched allen node, averaged across the probes of the gene.
+        If sd, the standard deviation for each probe and node is written in sdFile.
+        The probes are processed blockSize at a time, and the (probes x nodes) means kept in self.probeMat are
+        memory-mapped to a temporary file in scratchDir (the system default if None).
+        tempMatName is no longer used
+        """
+        # set up gene list
+        probes = probeIndex.load(self.subj, self.probeFile)
+
+        # get all probes if otherwise unspecified
+        if probeNumbers is None or not len(probeNumbers):
+            probeNumbers = probes.probeIDs
+
+        # select the rows of the probes in the expression matrix
+        probeIDs, expr = self.expression()
+        rows = _probeRows(probeIDs, probeNumbers)
+        rows = rows[rows >= 0]
+        probeNumbers = [str(v) for v in probeIDs[rows]]
+
+        # get the corresponding node names in the MRI graph
+        # cNodes is a dict whose keys are all the MRI nodes and values are the matched alen nodes
+        #### PV modified line below which constructed cNodes by looping through allen nodes
+        # but with PV's lax matching criteria several mri nodes can be matched to same allen node
+        # the mri pair of these allen nodes gets overwritten in self.a.G.nodes and so not all mri nodes will appear 
+        # as pairs of allen nodes in this dict... need to look up pairs in self.c.G.nodes instead, where
+        # each mri node is matched to an allen region
+        # cNodes = {str(self.a.G.nodes[v]['pair']):v for v in self.a.G.nodes()}
+        
+        nodes = list(self.c.G.nodes())
+        cNodes = {str(v):self.c.G.nodes[v]['pair'] for v in nodes}
+        acronyms = [self.a.G.nodes[cNodes[str(cNode)]][self.sLab] for cNode in nodes]
+        print((str(self.subj)))
+        print('\n')
+
+        # normalise expression levels for each probe, and collapse across the samples of each node and by gene
+        genes = probes.genesOf(probeNumbers)
+        geneNames, geneMat, probeMat = _probeGeneMeans([(self.subj, self.maFile, self.headers[1:])], probeNumbers,
+                                                       genes, acronyms, nodes, sdFile if sd else None, blockSize,
+                                                       scratchDir)
+        _writeX(self.subj+outFile, geneNames, geneMat, nodes)
+
+        geneList = {gene:[] for gene in probes.genes.tolist()}
+        for y,gene in enumerate(genes.tolist()):
+            geneList[gene].append(y)  # records the position of the probe in a dictionary with genes as a key
+        self.geneList = geneList
+        self.probeMat = probeMat
+
+    def probeSub(self, probes, values, plot, columns, fdr=False):
+        '''
+        values are the expression levels of the probes (rows) in each sample, and columns
+        the position of each structure ID in values. All the probes are correlated at once
+        '''
+        # expression of the allen node paired with each MRI node
+        cNodes = [cnode for cnode in self.c.G.nodes()
+                  if self.propDict[self.a.G.nodes[self.c.G.nodes[cnode]['pair']]['pair']]]
+        cols = [columns[self.a.G.nodes[self.c.G.nodes[cnode]['pair']][self.sLab]] for cnode in cNodes]
+        aa = np.asarray(values, dtype="float64")[:,cols]
+        metric = np.array([self.propDict[cnode] for cnode in cNodes], dtype="float64")
+
+        r,p = probeCorrelations(aa, metric)
+        q = fdrCorrection(p) if fdr else p
+        with np.errstate(invalid="ignore"):
+            sig = np.nonzero(q < self.sigVal)[0]
+        self.probeResults = {'probe_id':np.array(probes), 'r':r, 'p':p}
+        if fdr:
+            self.probeResults['p_fdr'] = q
+        print(("%d probes with p < %s" % (len(sig), self.sigVal)))
+
+        # write the table of significant probes in one go
+        headers = ['probe_id', 'gene_name', 'r', 'p'] + (['p_fdr'] if fdr else [])
+        names = self.probes.geneNames[self.probes.rows([probes[i] for i in sig])]
+        rows = [[probes[i], '"'+name+'"', r[i], p[i]] + ([q[i]] if fdr else []) for i,name in zip(sig, names)]
+        out = open(self.outFile, "w")
+        out.writelines(','.join(headers)+'\n')
+        out.writelines(','.join([str(v) for v in row])+'\n' for row in rows)
+        out.close()
+
+        for i in sig:
+            probe = probes[i]
+            if plot:
+                plt.scatter(metric, aa[i])
+                plt.savefig(self.outFile.replace('.txt',probe+'.png'), dpi=300)
+                plt.close()
+
+            # save data
+            datFile = open(self.outFile.replace('.txt', probe+self.gm+'.txt'), "w")
+            datFile.writelines(' '.join([probe, self.gm, "node", "subj"])+'\n')
+            datFile.writelines('\n'.join([' '.join([str(aa[i,n]), str(metric[n]), str(float(cnode)), self.subj]) for n,cnode in enumerate(cNodes)]))
+            datFile.close()
   
-    def probeSubT(self, l, plot, probeNumbers=None):
+    def probeSubT(self, probe, values, plot, columns):
         '''
-        l is a line from the probe file.
+        values are the expression levels of the probe in each sample, and columns
+        the position of each structure ID in values.
         The purpose of this function is to write thresholded data to a datafile
         eg for use in ANOVA
         '''
-        probe = l['probe']
         datFile = None
-        if probeNumbers:
-            if probe in probeNumbers:
-                # assign probe values to sample numbers
-                for node in self.a.G.nodes():
-                    if l[str(node)]:
-                        self.a.G.node[node][probe] = l[str(node)]
-                    else:
-                        self.a.G.node[node][probe] = None
-                                    
-                    outDict = {probe:probe, 'subj':self.subj}
-                    for p in list(self.propDict.keys()):
-                        outDict[p] = self.propDict[p]
-                  
-                    if not datFile:
-                        headers = [probe, "subj"]
-                        gmSubjs = list(self.propDict[list(self.probeDict.keys())[0]].keys())
-                        gmSubjs.sort()
-                        headers.extend(gmSubjs)
-
-                        datFile = open(self.outFile.replace('.txt', probe+self.gm+'.txt'), "wb")
-                        writer = csv.DictWriter(datFile, fieldnames=headers, delimiter=" ")
-                        writer.writeheader()
-                      
-                    writer.writerow(outDict)
+        # assign probe values to sample numbers
+        for node in self.a.G.nodes():
+            sID = self.a.G.nodes[node][self.sLab]
+            if sID in columns:
+                self.a.G.nodes[node][probe] = float(values[columns[sID]])
+            else:
+                self.a.G.nodes[node][probe] = None
+                            
+            outDict = {probe:probe, 'subj':self.subj}
+            for p in list(self.propDict.keys()):
+                outDict[p] = self.propDict[p]
+          
+            if not datFile:
+                headers = [probe, "subj"]
+                gmSubjs = list(self.propDict[str(self.probes.probeIDs[0])].keys())
+                gmSubjs.sort()
+                headers.extend(gmSubjs)
+
+                datFile = open(self.outFile.replace('.txt', probe+self.gm+'.txt'), "w")
+                writer = csv.DictWriter(datFile, fieldnames=headers, delimiter=" ")
+                writer.writeheader()
+              
+            writer.writerow(outDict)
+        if datFile:
+            datFile.close()
       
     def norm(self,x):
         xMin = np.min(x)
@@ -490,7 +762,11 @@ class multiSubj:
     """
     def __init__(self, assocMat, nodesToExclude=[], delim=" ",
                  subjList=None, spatialFile="parcel_500.txt", symmetrise=False,
-                 convertMNI=False, mirror=True):
+                 convertMNI=False, mirror=True, nJobs=1):
+        """
+        The subjects are loaded in a pool of nJobs processes, which also cache
+        their expression matrices (see loadExpression()).
+        """
         if subjList:
             self.subjList = subjList
         else:
@@ -499,6 +775,7 @@ class multiSubj:
         self.fName = "SampleAnnot.csv"
         self.maFile = "MicroarrayExpression.csv"
         self.probeFile = "Probes.csv"
+        self.expr = {} # probe ids and expression matrix of each subject, loaded the first time they are needed
         self.mirror=mirror
         
         # if symmetrise is true then regions are identified by the structure name,
@@ -509,61 +786,40 @@ class multiSubj:
         else:
             self.sLab = "structure_name"
         
+        self.nJobs = nJobs
+        
         # set up brain for expression data
-        self.a = mbo.brainObj()
-       
-        node_counter = 0
+        self.a = mbt.Brain()
+
+        # import sample data of all the subjects in parallel, merged in one table
+        donors = list(_imap(_loadDonor, [(subj, self.fName, self.sLab, convertMNI, self.maFile) for subj in self.subjList],
+                            self.nJobs))
+        self.samples = {'donor':np.concatenate([[subj]*len(d['sID']) for subj,d in zip(self.subjList, donors)]),
+                        'sID':np.concatenate([d['sID'] for d in donors]),
+                        'xyz':np.concatenate([d['xyz'] for d in donors])}
+        self.samples['node'] = np.arange(len(self.samples['sID'])) # GIVE NODES UNIQUE INCREMENTAL ID (across all subjects)
 
         self.headers={}
         self.sIDDict = {} # dictionary storing the list of nodes for each structural ID by subject - for use later in averaging across all subjects
-        for subj in self.subjList:
+        n = 0
+        for subj,donor in zip(self.subjList, donors):
             self.sIDDict[subj] = {}
-            # import probe data
-            f = open(path.join(subj, self.fName), "rb")        
-            reader = csv.DictReader(f, delimiter=",", quotechar='"')
-           
             self.headers[subj] = ['probe']
-            for l in reader:
-                # n = int(l["structure_id"])
-                sID = l[self.sLab]
-                n = node_counter # GIVE NODES UNIQUE INCREMENTAL ID (across all subjects)
-                if not self.a.G.has_node(n):
-                    self.a.G.add_node(n)
-                    self.a.G.node[n] = l
-                    self.a.G.node[n]['sID'] = sID # store the structure_acronym/structure_name for the node
-                    node_counter += 1
-                    # self.headers[subj].append(l["structure_id"])
-                    self.headers[subj].append(sID) #STORE structure_acronym or structure_name depending on symmetrise
-                    
-                    if not sID in list(self.sIDDict[subj].keys()):
-                        self.sIDDict[subj][sID] = [n]
-                    else:
-                        self.sIDDict[subj][sID].append(n)
-
-            f.close()
-            
-            if convertMNI:
-                # convert location data for Allen brain from MNI space
-                 for n in self.a.G.nodes():
-                     x = 45 - (float(self.a.G.node[n]['mni_x'])/2)
-                     y = 63 + (float(self.a.G.node[n]['mni_y'])/2)
-                     z = 36 + (float(self.a.G.node[n]['mni_z'])/2)
-                     self.a.G.node[n]['xyz'] = (x,y,z)
-            else:
-                for n in self.a.G.nodes():
-                    x = float(self.a.G.node[n]['mni_x'])
-                    y = float(self.a.G.node[n]['mni_y'])
-                    z = float(self.a.G.node[n]['mni_z'])
-                    self.a.G.node[n]['xyz'] = (x,y,z)
+            annot = {h:v.tolist() for h,v in donor['annot'].items()}
+            for i,sID in enumerate(donor['sID'].tolist()):
+                self.a.G.add_node(n)
+                self.a.G.nodes[n].update({h:annot[h][i] for h in annot})
+                self.a.G.nodes[n]['sID'] = sID # store the structure_acronym/structure_name for the node
+                self.a.G.nodes[n][ct.XYZ] = tuple(donor['xyz'][i].tolist())
+                self.headers[subj].append(sID) #STORE structure_acronym or structure_name depending on symmetrise
+                self.sIDDict[subj].setdefault(sID, []).append(n)
+                n += 1
             
-            if self.mirror and len(self.a.G.nodes()) < 600:
-                self.a.copy_hemisphere()
-
-        #    f.write('%s, %s, %s, %s \n' % (str(n), str(self.a.G.node[n]['xyz'][0]),str(self.a.G.node[n]['xyz'][1]),str(self.a.G.node[n]['xyz'][2])))
-        #f.close()
+        if self.mirror and len(self.a.G.nodes()) < 600:
+            self.a.copy_hemisphere()
        
         # set up brain with graph properties
-        self.c = mbo.brainObj()
+        self.c = mbt.Brain()
         self.c.import_adj_file(assocMat, delimiter=delim, nodes_to_exclude=nodesToExclude)
         self.c.import_spatial_info(spatialFile)
 
@@ -574,55 +830,35 @@ class multiSubj:
         key 1= allen, value= (n=id of closest allen node, d=distance to closest allen node)
         key 2= mri, value= (n=id of closest other mri node, d=distance to closest mri node)
         """
-        nodeDictMRIs = {}
-       
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-            dOwn = (None, 999.)
-       
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-           
-            for n in [v for v in self.c.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
-            nodeDictMRIs[node] = {"allen":dOther, "MRIs":dOwn}
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        cXYZ = _nodesXYZ(self.c.G, cNodes)
+        aXYZ = _nodesXYZ(self.a.G, aNodes)
+
+        dOther = _closest(cXYZ, aNodes, aXYZ)
+        dOwn = _closest(cXYZ, cNodes, cXYZ, excludeSelf=True)
+        nodeDictMRIs = {node:{"allen":dOther[i], "MRIs":dOwn[i]} for i,node in enumerate(cNodes)}
        
         # set up dictionary to link nodes from probe data and graph
-        nodeDictAllen = {}
-        for node in self.a.G.nodes():
-            dOther = (None, 999.)
-            dOwn = (None, 999.)
-           
-            for n in self.c.G.nodes():
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-           
-            for n in [v for v in self.a.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
-            nodeDictAllen[node] = {"allen":dOwn, "MRIs":dOther}
+        dOther = _closest(aXYZ, cNodes, cXYZ)
+        dOwn = _closest(aXYZ, aNodes, aXYZ, excludeSelf=True)
+        nodeDictAllen = {node:{"allen":dOwn[i], "MRIs":dOther[i]} for i,node in enumerate(aNodes)}
        
         nodePairs = []
         # for each MRI node
         for node in list(nodeDictMRIs.keys()):
             # find closest allen node 'n'
             n = nodeDictMRIs[node]['allen'][0]
-            self.c.G.node[node]['pair'] = n
-            self.a.G.node[n]['pair'] = node
+            self.c.G.nodes[node]['pair'] = n
+            self.a.G.nodes[n]['pair'] = node
             nodePairs.append((node,n))
             # if there is no other MRI node closer to the current MRI region 
             # if nodeDictMRIs[node]['allen'][1] < nodeDictMRIs[node]['MRIs'][1]:
             # if there is also no other MRI node closer to this allen region then match
             #     n = nodeDictMRIs[node]['allen'][0]
             #     if nodeDictAllen[n]['MRIs'][0] == node:
-            #         self.c.G.node[node]['pair'] = n
-            #         self.a.G.node[n]['pair'] = node
+            #         self.c.G.nodes[node]['pair'] = n
+            #         self.a.G.nodes[n]['pair'] = node
             #         nodePairs.append((node,n))
             #     else:
             # if there is another MRI node closer to this allen region then delete current regions (and do not match it)
@@ -630,8 +866,8 @@ class multiSubj:
             # else:
             #     self.c.G.remove_node(node)
        
-        for node in self.a.G.nodes():
-            if not 'pair' in list(self.a.G.node[node].keys()):
+        for node in list(self.a.G.nodes()):
+            if not 'pair' in self.a.G.nodes[node]:
                 self.a.G.remove_node(node)
 
     def comparisonAveraged(self):
@@ -641,94 +877,91 @@ class multiSubj:
         be associated with any specific Allen node.
         """
         for n in self.a.G.nodes():
-            self.a.G.node[n]['pairNodes'] = []
+            self.a.G.nodes[n]['pairNodes'] = []
         
-        # iterate through imaging nodes to find closes Allen node
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-       
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-                    
-            self.a.G.node[dOther[0]]['pairNodes'].append(node)
+        # find the closest Allen node to each imaging node
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        closest = _closest(_nodesXYZ(self.c.G, cNodes), aNodes, _nodesXYZ(self.a.G, aNodes))
+
+        for node,dOther in zip(cNodes, closest):
+            self.a.G.nodes[dOther[0]]['pairNodes'].append(node)
        
-        for node in self.a.G.nodes():
-            if not self.a.G.node[node]['pairNodes']:
+        for node in list(self.a.G.nodes()):
+            if not self.a.G.nodes[node]['pairNodes']:
                 self.a.G.remove_node(node)
 
-    def probeData(self, probeNumbers=[], meanVals=True):
+    def expression(self, subj):
         """
-        If meanVals is specified, this takes the mean probe value across subjects
+        Returns the probe ids and the (probes x samples) expression matrix of a subject, see loadExpression()
         """
+        if subj not in self.expr:
+            self.expr[subj] = loadExpression(subj, self.maFile)
+        return self.expr[subj]
+
+    def expressionMatrix(self, probeNumbers):
+        """
+        Returns the expression levels of the probes (rows, NaN for the subjects without the probe)
+        in the samples of all the subjects (columns, in the same order as self.samples)
+        """
+        blocks = []
         for subj in self.subjList:
-            # import probe data
-            f = open(path.join(subj, self.maFile), "rb")
-            reader = csv.DictReader(f, delimiter=",",
-                                    fieldnames=self.headers[subj],
-                                    quotechar='"')
-            for l in reader:
-                probe = l['probe']
-                if probe in probeNumbers:
-                    # assign probe values to sample numbers
-                    for cnode in self.c.G.nodes():
-                        node = self.c.G.node[cnode]['pair']
-                        sID = self.a.G.node[node][self.sLab]
-                        if not probe in list(self.a.G.node[node].keys()):
-                            self.a.G.node[node][probe] = {}
-                           
-                        if sID in list(l.keys()):
-                            self.a.G.node[node][probe][subj] = l[sID]
-            f.close()
-            del(reader)
+            probeIDs, expr = self.expression(subj)
+            blocks.append(_donorExpression(probeIDs, expr, probeNumbers))
+        return np.hstack(blocks)
+
+    def probeData(self, probeNumbers=[], meanVals=True, probeList=[], match="substring"):
+        """
+        If meanVals is specified, this takes the mean probe value across subjects.
+        If probeList is given, the probes are those of the genes matching any string
+        in it (see probeIndex.search() for match)
+        """
+        if probeList:
+            probeNumbers = probeIndex.load(self.subjList[0], self.probeFile).search(probeList, match)
+        allValues = self.expressionMatrix(probeNumbers)
+        for subj in self.subjList:
+            # select the columns of the subject and of the structures
+            subjValues = allValues[:,self.samples['donor'] == subj]
+            columns = _sampleColumns(self.headers[subj][1:])
+
+            for probe,values in zip(probeNumbers, subjValues):
+                if np.isnan(values).all(): # the subject doesn't have the probe
+                    continue
+                probe = str(probe)
+                # assign probe values to sample numbers
+                for cnode in self.c.G.nodes():
+                    node = self.c.G.nodes[cnode]['pair']
+                    sID = self.a.G.nodes[node][self.sLab]
+                    if not probe in self.a.G.nodes[node]:
+                        self.a.G.nodes[node][probe] = {}
+                       
+                    if sID in columns:
+                        self.a.G.nodes[node][probe][subj] = float(values[columns[sID]])
         # self.a.G.nodes is a dict containing every UNIQUE structure id (across all subjects)
         if meanVals:
             for n in self.a.G.nodes():
-                for probe in probeNumbers:
-                    self.a.G.node[n][probe] = np.mean([float(v) for v in list(self.a.G.node[n][probe].values())])
+                for probe in map(str, probeNumbers):
+                    if probe in self.a.G.nodes[n]:
+                        self.a.G.nodes[n][probe] = np.mean([float(v) for v in self.a.G.nodes[n][probe].values()])
                
-    def writeXMatrix(self, outFile="Xmatrix.csv", probeNumbers=None, tempMatName="tempMat.txt", sd=False, sdFile="NodesSd.txt"):
-        # get all probes if otherwise unspecified
-        if not probeNumbers:
-            f = open(path.join(self.subjList[0], self.probeFile))
-            reader = csv.DictReader(f, delimiter=",", quotechar='"')
-            probeNumbers = [l['probe_id'] for l in reader]
-            del(reader)
-            f.close()  
-   
-        # set up out file
-        out = open(outFile, "wb")
-        headers = ["Gene"]
-        headers.extend([str(v) for v in self.c.G.nodes()])
-        writer = csv.DictWriter(out, fieldnames = headers, delimiter=" ")
-        writer.writeheader()
-       
-        # set up matrix
-        x = len(self.subjList)
-        y = len(probeNumbers)
-        z = len(self.c.G.nodes())
-        sT = np.max([np.max([len(v) for v in list(self.sIDDict[subj].values())]) for subj in list(self.sIDDict.keys())]) # max numbers of nodes for any region
-        
-        probeMat = np.memmap(tempMatName,
-                             dtype="float64",
-                             mode="w+",
-                             shape=(y,z,sT*x))
-                            
+    def writeXMatrix(self, outFile="Xmatrix.csv", probeNumbers=None, tempMatName="tempMat.txt", sd=False, sdFile="NodesSd.txt",
+                     blockSize=2000, scratchDir=None):
+        """
+        Writes the expression of each gene in each MRI node: the mean of the expression levels of the samples in
+        the structure of the matched allen node, normalised within each subject and averaged across all subjects
+        and across the probes of the gene.
+        If sd, the standard deviation for each probe and node is written in sdFile.
+        The probes are processed blockSize at a time (with the subjects in parallel), and the (probes x nodes)
+        means kept in self.probeMat are memory-mapped to a temporary file in scratchDir (the system default if
+        None). tempMatName is no longer used
+        """
         # set up gene list
-        geneFlag = True
-        pFile = open(path.join(self.subjList[0], self.probeFile))
-        pReader = csv.DictReader(pFile, delimiter=",", quotechar='"')
-        pDict = {l['probe_id']:l['gene_symbol'] for l in pReader}
-        geneList = list(pDict.values())
-        set(geneList)
-        geneList = {gene:[] for gene in geneList}
-        
-        sIDList = []
-        for subj in self.subjList:
-            sIDList.extend([v for v in self.headers[subj] if not v=='probe'])
-        sIDList = set(sIDList)
-        
+        probes = probeIndex.load(self.subjList[0], self.probeFile)
+
+        # get all probes if otherwise unspecified
+        if probeNumbers is None or not len(probeNumbers):
+            probeNumbers = probes.probeIDs
+
         # get the corresponding node names in the MRI graph
         # cNodes is a dict whose keys are all the MRI nodes and values are the matched alen nodes
         #### PV modified line below which constructed cNodes by looping through allen nodes
@@ -736,124 +969,31 @@ class multiSubj:
         # the mri pair of these allen nodes gets overwritten in self.a.G.nodes and so not all mri nodes will appear 
         # as pairs of allen nodes in this dict... need to look up pairs in self.c.G.nodes instead, where
         # each mri node is matched to an allen region
-        # cNodes = {str(self.a.G.node[v]['pair']):v for v in self.a.G.nodes()}
+        # cNodes = {str(self.a.G.nodes[v]['pair']):v for v in self.a.G.nodes()}
         
-        cNodes = {str(v):self.c.G.node[v]['pair'] for v in self.c.G.nodes()}
-        
-        # assign values to matrix
-        for x,subj in enumerate(self.subjList):
-            print((str(subj)))
-            print('\n')
-            # Generate custom fieldnames list for DictReader which doesn't rely on structure_id
-            # *************************************
-            fieldnames_pv = ['probe']
-            myNodeDict = {}
-            tempHeaders = self.headers[subj]
-            tempHeaders.remove('probe')
-
-            for p,q in enumerate(self.headers[subj]):
-                myNodeDict[p] = q
-                fieldnames_pv.append(str(p))   #####
-            # *************************************
-
-            # import probe data
-            f = open(path.join(subj, self.maFile), "rb")
-            reader = csv.DictReader(f, delimiter=",",
-                                    fieldnames=fieldnames_pv,
-                                    quotechar='"')
-            y = 0
-            for l in reader:
-                probe = l['probe']
-                if probe in probeNumbers:
-                    # assign probe values to sample numbers
-                    for z,cNode in enumerate(self.c.G.nodes()):
-                        aNode = cNodes[str(cNode)]
-                        # *************************************
-                        # Find structure_acronym corresponding to the matched allen node
-                        acronym = self.a.G.node[aNode][self.sLab]
-                        # Initialise list for summing expression values for allen nodes with same structure_acronym
-                        totalExpression = []
-                        # Loop over allen nodes to find all those with the correct acronym for the current MRI node
-                        # and add their expression values to the list for averaging
-                        s=0
-                        for ID, struct_ac in list(myNodeDict.items()):
-                            if struct_ac == acronym:
-                                # print(ID, struct_ac, l[str(ID)])
-                                # print('\n')
-                                # if l[str(ID)]:
-                                totalExpression.append(float(l[str(ID)]))
-                                probeMat[y,z,sT*x + s] = float(l[str(ID)])
-                                s+=1
-                                
-                    if geneFlag:
-                        geneList[pDict[probe]].append(y)  # records the position of the probe in a dictionary with genes as a key
-                    y+=1
-            f.close()
-            del(reader)
+        nodes = list(self.c.G.nodes())
+        cNodes = {str(v):self.c.G.nodes[v]['pair'] for v in nodes}
+        acronyms = [self.a.G.nodes[cNodes[str(cNode)]][self.sLab] for cNode in nodes]
 
-            # get values to normalise expression levels for each probe within subject
-            for y in range(probeMat.shape[0]):
-                # create a masked array removing the 0. values
-                subjMat = np.ma.array(probeMat[y,:,sT*x:sT*x+sT],
-                                      mask=probeMat[y,:,sT*x:sT*x+sT]==0.,
-                                      dtype="float64")
+        # rows of the probes in the expression matrix of each subject, in the order of the first subject
+        probeIDs, expr = self.expression(self.subjList[0])
+        rows = _probeRows(probeIDs, probeNumbers)
+        probeNumbers = [str(v) for v in probeIDs[rows[rows >= 0]]]
 
-                subjMat = (subjMat - np.mean(np.ma.array(subjMat, mask=subjMat==0.))) / np.std(np.ma.array(subjMat, mask=subjMat==0.))
-                probeMat[y,:,sT*x:sT*x+sT] = subjMat
+        # normalise expression levels for each probe within subject in parallel, collapse across the samples of
+        # each node (averaging across all subjects) and by gene
+        genes = probes.genesOf(probeNumbers)
+        donors = [(subj, self.maFile, self.headers[subj][1:]) for subj in self.subjList]
+        geneNames, geneMat, probeMat = _probeGeneMeans(donors, probeNumbers, genes, acronyms, nodes,
+                                                       sdFile if sd else None, blockSize, scratchDir, self.nJobs)
+        _writeX(outFile, geneNames, geneMat, nodes)
 
-            geneFlag=False
-       
-        # collapse across subjects and probes by gene
-        geneNames = list(geneList.keys())
-        geneNames.sort() # sort in to alphabetical order
-        
-        # collapse across nodes within regions (averaging across all subjects)
-#        probeMat = np.mean(np.ma.array(probeMat, mask=probeMat==0.), axis=3) # this would work, but runs in to memory problems
-        sh = probeMat.shape
-        probeMatTemp = np.memmap("probeMatTemp.txt", mode="w+", dtype="float64", shape=sh[:2])
-
-        # write out the standard deviation for each probe if specified
-        if sd:
-            sdOut = open(sdFile, "wb")
-            sdOut.writelines("Probe Node sd\n")
-            
-        for y in range(sh[0]):
-            for z in range(sh[1]):
-                probeMatTemp[y,z] = np.mean(np.ma.array(probeMat[y,z], mask=probeMat[y,z]==0.)) # mask out unused values, ie where there are less than the maximum number of homolous nodes in a structural region
-                if sd:
-                    std = np.std(np.ma.array(probeMat[y,z], mask=probeMat[y,z]==0.))
-                    sdOut.writelines(' '.join([str(int(probeNumbers[y])), str(self.c.G.nodes()[z]), "{:2.5f}".format(float(std))])+'\n')
-
-                        
-        if sd:
-            sdOut.close()
-                
-        # reassign the probe matrix and delete temporary memory-mapped file
-        probeMat = probeMatTemp
-        del(probeMatTemp)
-        remove(tempMatName)
-        
-        for g,gene in enumerate(geneNames):
-            if (geneList[gene]):
-                x = probeMat.shape[1] # number of nodes
-                y = len(geneList[gene]) # number of probes
-                               
-                geneMat = np.zeros(shape=(x,y), dtype="float64")
-               
-                for n,p in enumerate(geneList[gene]): # nb: p is the position of the probe recorded above
-                    geneMat[:,n] = probeMat[p,:]
-                               
-                self.geneMat = geneMat
-                meanGene = np.mean(np.ma.array(geneMat, mask=np.isnan(geneMat)), axis=1) # collapse values across probes for each gene
-               
-                outDict = dict(list(zip([str(v) for v in self.c.G.nodes()], ["{:10.20f}".format(v) for v in meanGene])))
-                outDict["Gene"] = gene
-                writer.writerow(outDict)
-       
+        geneList = {gene:[] for gene in probes.genes.tolist()}
+        for y,gene in enumerate(genes.tolist()):
+            geneList[gene].append(y)  # records the position of the probe in a dictionary with genes as a key
         self.geneList = geneList
         self.probeMat = probeMat
-        out.close()
-        remove("probeMatTemp.txt") # delete memory map file
+
    
     def writeYMatrixGroup(self, metricDict, subj="Control", outFile="YmatrixGroup.csv"):
         '''
@@ -861,7 +1001,7 @@ class multiSubj:
         Note, the metricDict contains the metric name as a key and filename as
         the value. Takes group level measures
         '''
-        out = open(outFile, "wb")
+        out = open(outFile, "w", newline="")
         headers = ["Metric"]
         headers.extend([str(v) for v in self.c.G.nodes()])
         writer = csv.DictWriter(out, fieldnames=headers)
@@ -892,6 +1032,7 @@ class multiSubj:
             mDict["Metric"] = m
            
             writer.writerow(mDict)
+        out.close()
            
     def writeYMatrixIndividuals(self, metricDict, subjList, outFile="YmatrixInd.csv"):
         '''
@@ -899,7 +1040,7 @@ class multiSubj:
         Note, the metricDict contains the metric name as a key and filename as
         the value. Takes metrics for individual subjects defined in the subject list.
         '''
-        out = open(outFile, "wb")
+        out = open(outFile, "w", newline="")
         headers = ["Metric", "Subject"]
         headers.extend([str(v) for v in self.c.G.nodes()])
         writer = csv.DictWriter(out, fieldnames=headers)
@@ -932,3 +1073,4 @@ class multiSubj:
                 mDict["Subject"] = subj
                
                 writer.writerow(mDict)
+        out.close()
@@ -2,12 +2,18 @@
 """
 Module which contains the definition of Brain class.
 """
+import json
+import multiprocessing
 import random
+import struct
+import warnings
+import zipfile
 
 import networkx as nx
 import numpy as np
 
 from maybrain import constants as ct
+from maybrain.utils.cache import cached
 
 
 class Brain:
@@ -44,13 +50,22 @@ class Brain:
         self.iso_header = None  # header information
         self.parcel_list = None
 
+        # (n x 3) array with the coordinates from import_spatial_info(), by position in the adjacency matrix.
+        # It is where node_coords() takes the coordinates from, and it is kept in sync with the constants.XYZ
+        # properties imported afterwards
+        self.coords = None
+
         self.risk_edges = None
 
-        # For the properties features
-        self.node_properties = []
-        self.edge_properties = []
+        # For the properties features. Tables with all the imported properties, for each property name:
+        # {name: {node: value}} and {name: {(node1, node2): value}}
+        self._node_props = {}
+        self._edge_props = {}
         self.update_props_after_threshold = False
 
+        # Cache of shortest_paths(), for each weight: (nodes, sparse matrix of G, distance matrix)
+        self._paths_cache = {}
+
         # create a new networkX graph object
         if self.directed:
             self.G = nx.DiGraph()
@@ -102,7 +117,11 @@ class Brain:
     def import_spatial_info(self, fname, delimiter=None, convert_mni=False):
         """
         Add 3D coordinate information for each node from a given file. It needs to be called after
-        import_adj_file()
+        import_adj_file(). Each line has the label and the x, y, z coordinates of the node in the same
+        position of the adjacency matrix.
+
+        Besides the node properties, all the coordinates are kept in the (n x 3) array `coords`, where row i
+        has the coordinates of the node in position i
 
         Parameters
         ----------
@@ -113,32 +132,61 @@ class Brain:
         convert_mni: bool
             Whether you want to convert coordinates from voxel-wise (2 mm) to MNI space
         """
-        # open file
         try:
-            file = open(fname, "r")
+            with open(fname, "r") as file:
+                info = np.loadtxt(file, dtype=str, delimiter=delimiter, usecols=range(4), ndmin=2)
         except IOError as error:
             error.strerror = 'Problem with opening 3D position file "' \
                              + fname + '": ' + error.strerror
             raise error
 
-        # get data from file
-        lines = file.readlines()
-        node_count = 0
-        for line in lines:
-            line = line.strip().split(sep=delimiter)
+        coords = info[:, 1:].astype(float)
+        if convert_mni:
+            coords = np.array([45., 63., 36.]) + coords * np.array([-0.5, 0.5, 0.5])
+        self.coords = coords
 
-            if convert_mni:
-                line[1] = 45 - (float(line[1]) / 2)
-                line[2] = 63 + (float(line[2]) / 2)
-                line[3] = 36 + (float(line[3]) / 2)
+        nodes = [n for n in range(len(info)) if self.G.has_node(n)]
+        nx.set_node_attributes(self.G, dict(zip(nodes, map(tuple, coords[nodes].tolist()))), ct.XYZ)
+        nx.set_node_attributes(self.G, dict(zip(nodes, info[nodes, 0].tolist())), ct.ANAT_LABEL)
 
-            if node_count in self.G.nodes():
-                self.G.nodes[node_count][ct.XYZ] = (float(line[1]), float(line[2]), float(line[3]))
-                self.G.nodes[node_count][ct.ANAT_LABEL] = line[0]
+    def node_coords(self, nodes=None):
+        """
+        It returns the array with the 3D coordinates of the nodes. They are taken by position from `coords` when it
+        is defined (see `import_spatial_info()`), so removing nodes from G doesn't affect the others, and from the
+        `constants.XYZ` property for the nodes not there, like the ones added by `copy_hemisphere()`.
+        Coordinates changed with `import_node_props_from_dict()` or `import_properties()` update `coords`, but not
+        the ones written directly in `G`
+
+        Parameters
+        ----------
+        nodes: list
+            The nodes of G. If None, all the nodes of G, in the same order as G.nodes()
 
-            node_count += 1
+        Returns
+        -------
+        coords: np.array
+            A (len(nodes) x 3) array, where row i has the coordinates of nodes[i]
 
-        file.close()
+        Raises
+        ------
+        KeyError: Exception
+            If a node doesn't have coordinates
+        """
+        if nodes is None:
+            nodes = list(self.G.nodes())
+        in_coords = self._in_coords(nodes)
+        coords = np.empty((len(nodes), 3))
+        if in_coords.any():
+            coords[in_coords] = self.coords[np.array(nodes, dtype=object)[in_coords].astype(int)]
+        for i in np.flatnonzero(~in_coords):
+            coords[i] = self.G.nodes[nodes[i]][ct.XYZ]
+        return coords
+
+    def _in_coords(self, nodes):
+        """ Private method which returns a boolean array telling which nodes have a row in `coords` """
+        n_coords = 0 if self.coords is None else len(self.coords)
+        return np.array([isinstance(n, (int, np.integer)) and not isinstance(n, bool) and 0 <= n < n_coords
+                         for n in nodes], dtype=bool)
 
     def import_node_props_from_dict(self, prop_name, props):
         """
@@ -152,6 +200,11 @@ class Brain:
             Dictionary where the keys are the nodes' identification, and the value is the value of
             the property to add
 
+        Returns
+        -------
+        failures: int
+            Number of properties which couldn't be added because their node doesn't exist
+
         Raises
         ------
         TypeError: Exception
@@ -159,12 +212,10 @@ class Brain:
         """
         if not isinstance(props, dict):
             raise TypeError("import_node_props_from_dict() expects props to be a dict")
-        nodes_p = []
-        for prop in props.items():
-            nodes_p.append([prop_name, prop[0], prop[1]])
+        nodes_p = [[prop_name, node, value] for node, value in props.items()]
 
-        self._add_properties(nodes_p)
-        self.node_properties.extend(nodes_p)
+        failures = self._add_properties(nodes_p)
+        return failures
 
     def import_edge_props_from_dict(self, prop_name, props):
         """
@@ -178,6 +229,11 @@ class Brain:
             Dictionary where the keys are the edges' identification (tuple), and the value is the
             value of the property to add
 
+        Returns
+        -------
+        failures: int
+            Number of properties which couldn't be added because their edge doesn't exist
+
         Raises
         ------
         TypeError: Exception
@@ -185,12 +241,10 @@ class Brain:
         """
         if not isinstance(props, dict):
             raise TypeError("import_edge_props_from_dict() expects props to be a dict")
-        edges_p = []
-        for prop in props.items():
-            edges_p.append([prop_name, prop[0][0], prop[0][1], prop[1]])
+        edges_p = [[prop_name, edge[0], edge[1], value] for edge, value in props.items()]
 
-        self._add_properties(edges_p)
-        self.edge_properties.extend(edges_p)
+        failures = self._add_properties(edges_p)
+        return failures
 
     def import_properties(self, filename):
         """
@@ -211,37 +265,100 @@ class Brain:
         filename: str
             Filepath to properties
 
+        Returns
+        -------
+        failures: int
+            Number of properties which couldn't be added because their node or edge doesn't exist
+
         Raises
         ------
         ValueError : Exception
             If the file has some invalid structure
         """
-        edges_p = []
-        nodes_p = []
         with open(filename, 'r') as file:
             prop = file.readline().strip()
-            for line in file:
-                info = line.strip().split(' ')
-
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")  # a file without properties just gives an empty array
+                    info = np.loadtxt(file, dtype=str, comments=None, ndmin=2)
+            except ValueError:  # lines with different number of columns
+                info = None
+
+        # Making the array (node1, node2, value), with an empty node2 for node properties
+        if info is not None and info.size == 0:
+            info = np.empty((0, 3), dtype=str)
+        elif info is not None and info.shape[1] == 2:
+            info = np.insert(info, 1, '', axis=1)
+        elif info is None or info.shape[1] != 3:
+            info = self._parse_mixed_properties(filename)
+
+        is_node = info[:, 1] == ''
+        nodes_p = [[prop, node, val] for node, val in
+                   zip(info[is_node, 0].astype(int).tolist(), info[is_node, 2].tolist())]
+        edges_p = [[prop, n1, n2, val] for n1, n2, val in
+                   zip(info[~is_node, 0].astype(int).tolist(), info[~is_node, 1].astype(int).tolist(),
+                       info[~is_node, 2].tolist())]
+
+        return self._add_properties(edges_p) + self._add_properties(nodes_p)
+
+    @staticmethod
+    def _parse_mixed_properties(filename):
+        """
+        Private method which parses a properties file mixing nodes and edges, returning an array with 3 columns in
+        which node properties have an empty second column
+        """
+        rows = []
+        with open(filename, 'r') as file:
+            file.readline()
+            for num, line in enumerate(file, start=2):
+                info = line.split()
                 if len(info) == 2:
-                    nodes_p.append([prop, int(info[0]), info[1]])
+                    rows.append([info[0], '', info[1]])
                 elif len(info) == 3:
-                    edges_p.append([prop, int(info[0]), int(info[1]), info[2]])
-                else:
-                    raise ValueError(
-                        'Problem in parsing %s, it has an invalid structure at line %d'
-                        % (filename, file.tell()))
+                    rows.append(info)
+                elif info:
+                    raise ValueError('Problem in parsing %s, it has an invalid structure at line %d' % (filename, num))
+        return np.array(rows, dtype=str).reshape(-1, 3)
 
-        self._add_properties(edges_p)
-        self._add_properties(nodes_p)
+    @property
+    def node_properties(self):
+        """
+        List with all the imported properties of nodes, in the format [property_name, node_id, property_value].
+        Assigning a list replaces all the properties kept, without changing the nodes of G
+        """
+        return [[name, node, val] for name, table in self._node_props.items() for node, val in table.items()]
+
+    @node_properties.setter
+    def node_properties(self, properties):
+        self._node_props.clear()
+        for prop in properties:
+            self._node_props.setdefault(prop[0], {})[prop[1]] = prop[2]
+
+    @property
+    def edge_properties(self):
+        """
+        List with all the imported properties of edges, in the format [property_name, edge1, edge2, property_value].
+        Assigning a list replaces all the properties kept, which the edges of G get after the next threshold when
+        `update_props_after_threshold` is set
+        """
+        return [[name, edge[0], edge[1], val] for name, table in self._edge_props.items()
+                for edge, val in table.items()]
 
-        self.node_properties.extend(nodes_p)
-        self.edge_properties.extend(edges_p)
+    @edge_properties.setter
+    def edge_properties(self, properties):
+        self._edge_props.clear()
+        for prop in properties:
+            table = self._edge_props.setdefault(prop[0], {})
+            edge = (prop[1], prop[2])
+            if not self.directed and edge[::-1] in table:
+                edge = edge[::-1]
+            table[edge] = prop[3]
 
     def _add_properties(self, properties):
         """
-        It receives a list with properties and add them to either the nodes or edges according to
-        the structure.
+        It receives a list with properties, keeps them in the properties tables and adds them to either the nodes
+        or edges according to the structure, in bulk for each property name. A repeated property of the same
+        node or edge replaces the previous one.
         For nodes properties, the format is:
             [ [property_name_1, node_id_1, property_value_1],
               [property_name_2, node_id_2, property_value_2], ...]
@@ -249,15 +366,85 @@ class Brain:
         For edges properties, the format is:
             [ [property_name_1, edge1, edge2, property_value_3],
               [property_name_2, edge1, edge2, property_value_4], ...]
+
+        It returns the number of properties which couldn't be added because their node or edge doesn't exist
+        (they are still kept, in case the edge is created by a later threshold)
         """
+        nodes_p = {}
+        edges_p = {}
+        failures = 0
         for prop in properties:
-            try:
-                if len(prop) == 3:  # nodes
-                    self.G.nodes[prop[1]][prop[0]] = prop[2]
-                elif len(prop) == 4:  # edges
-                    self.G.edges[prop[1], prop[2]][prop[0]] = prop[3]
-            except BaseException:
-                print('Warning! Unable to process property %s' % prop)
+            if len(prop) == 3:
+                self._node_props.setdefault(prop[0], {})[prop[1]] = prop[2]
+                if self.G.has_node(prop[1]):
+                    nodes_p.setdefault(prop[0], {})[prop[1]] = prop[2]
+                    continue
+            elif len(prop) == 4:
+                table = self._edge_props.setdefault(prop[0], {})
+                edge = (prop[1], prop[2])
+                if not self.directed and edge[::-1] in table:
+                    edge = edge[::-1]
+                table[edge] = prop[3]
+                if self.G.has_edge(prop[1], prop[2]):
+                    edges_p.setdefault(prop[0], {})[edge] = prop[3]
+                    continue
+            failures += 1
+
+        for name, values in nodes_p.items():
+            if name == ct.XYZ:
+                nodes = [n for n, in_coords in zip(values, self._in_coords(values)) if in_coords]
+                if nodes:
+                    self.coords[nodes] = np.array([values[n] for n in nodes], dtype=float)
+            nx.set_node_attributes(self.G, values, name)
+        for name, values in edges_p.items():
+            nx.set_edge_attributes(self.G, values, name)
+        return failures
+
+    def edge_property(self, name, node1, node2, default=None):
+        """
+        It returns the value of an imported property of an edge from the properties table, whether or not the edge
+        is currently in G
+
+        Parameters
+        ----------
+        name: str
+            The name of the property
+        node1: int
+            The first node of the edge
+        node2: int
+            The second node of the edge
+        default: object
+            The value returned if the edge doesn't have the property
+
+        Returns
+        -------
+        value: object
+            The value of the property, or `default`
+        """
+        table = self._edge_props.get(name, {})
+        if (node1, node2) in table:
+            return table[(node1, node2)]
+        if not self.directed:
+            return table.get((node2, node1), default)
+        return default
+
+    def _apply_edge_properties(self):
+        """
+        Private method which sets the properties in the table to the current edges of G, after a threshold, looking
+        up either the table entries in G or the edges of G in the table, whichever is smaller.
+        Nodes are never removed by thresholding, so they keep their properties
+        """
+        for name, table in self._edge_props.items():
+            if len(table) < self.G.number_of_edges():
+                values = {edge: val for edge, val in table.items() if self.G.has_edge(*edge)}
+            else:
+                values = {}
+                for edge in self.G.edges():
+                    if edge in table:
+                        values[edge] = table[edge]
+                    elif not self.directed and edge[::-1] in table:
+                        values[edge] = table[edge[::-1]]
+            nx.set_edge_attributes(self.G, values, name)
 
     def import_background(self, fname):
         """
@@ -269,8 +456,8 @@ class Brain:
         import nibabel as nb
 
         self.nbbackground = nb.load(fname)
-        self.background = self.nbbackground.get_data()
-        self.background_header = self.nbbackground.get_header()
+        self.background = np.asanyarray(self.nbbackground.dataobj)
+        self.background_header = self.nbbackground.header
 
     def import_iso(self, fname):
         """
@@ -282,8 +469,8 @@ class Brain:
         """
         import nibabel as nb
         self.nbiso = nb.load(fname)
-        self.iso = self.nbiso.get_data()
-        self.iso_header = self.nbiso.get_header()
+        self.iso = np.asanyarray(self.nbiso.dataobj)
+        self.iso_header = self.nbiso.header
 
     def parcels(self, node_list):
         """
@@ -293,15 +480,9 @@ class Brain:
         iso image, not necessarily the node values.
         """
 
-        zero_arr = np.zeros(self.iso.shape)
-
-        for n in node_list:
-            n = float(n)
-            # parcel files start from 1, zero is for background
-            n_arr = np.ma.masked_where(self.iso != (n + 1), self.iso)
-            n_arr.fill_value = 0.0
-            zero_arr = zero_arr + n_arr
-            zero_arr.mask = None
+        # parcel files start from 1, zero is for background
+        labels = np.asarray(list(node_list), dtype="float64") + 1
+        zero_arr = np.where(np.isin(self.iso, labels), self.iso, 0.0).astype("float64")
 
         self.parcel_list = np.ma.masked_values(zero_arr, 0.0)
 
@@ -312,13 +493,14 @@ class Brain:
         """
         import nibabel as nb
         if value_dict:  # creates a numpy array based on the dictionary provided
-            out_mat = np.zeros(self.nbiso.get_data().shape, dtype="float64")
-            for n in list(value_dict.keys()):
-                out_mat[np.where(self.nbiso.get_data() == n + 1)] = value_dict[n]
+            # value of each label of the iso image, indexed by the whole volume at once
+            labels, inverse = np.unique(self.iso, return_inverse=True)
+            lut = np.array([value_dict.get(l - 1, 0.0) for l in labels.tolist()], dtype="float64")
+            out_mat = lut[inverse].reshape(self.iso.shape)
         else:
             out_mat = self.parcel_list
 
-        n = nb.Nifti1Image(out_mat, self.nbiso.get_affine(), header=self.iso_header)
+        n = nb.Nifti1Image(out_mat, self.nbiso.affine, header=self.iso_header)
 
         nb.save(n, outname + '.nii')
 
@@ -356,6 +538,26 @@ class Brain:
         if threshold_type == "edgePC" and (value < 0 or value > 100):
             raise TypeError("Invalid value for edgePC in apply_threshold()")
 
+        weights = self._threshold_edges(threshold_type, value, use_absolute)
+
+        # remove previous edges
+        self.G.remove_edges_from(list(self.G.edges()))
+        self._invalidate_paths()
+
+        # Adding the edges
+        for e in weights:
+            self.G.add_edge(e[0], e[1], weight=e[2])
+
+        # Apply existing properties
+        if self.update_props_after_threshold:
+            self._apply_edge_properties()
+
+    @cached("apply_threshold")
+    def _threshold_edges(self, threshold_type, value, use_absolute):
+        """
+        Private method which returns the list of edges (node1, node2, weight) retained by `apply_threshold()`.
+        Only depending on adjMat, it is kept in the on-disk cache when enabled (see `utils.enable_cache()`)
+        """
         # Creating the array with weights and edges
         upper_values = np.triu_indices(np.shape(self.adjMat)[0], k=1)
         weights = []
@@ -397,25 +599,12 @@ class Brain:
                 pass  # include all weights
             else:
                 weights = weights[-edgenum:]
+        elif threshold_type == 'tVal' and use_absolute:
+            weights = [e for e in weights if e[2] >= abs(value) or e[2] <= -abs(value)]
+        elif threshold_type == 'tVal':
+            weights = [e for e in weights if e[2] >= value]
 
-        # remove previous edges
-        self.G.remove_edges_from(list(self.G.edges()))
-
-        # Adding the edges
-        for e in weights:
-            if threshold_type == 'tVal' and use_absolute:
-                if e[2] >= abs(value) or e[2] <= -abs(value):
-                    self.G.add_edge(e[0], e[1], weight=e[2])
-            elif threshold_type == 'tVal' and not use_absolute:
-                if e[2] >= value:
-                    self.G.add_edge(e[0], e[1], weight=e[2])
-            else:  # None, edgePC, totalEdges
-                self.G.add_edge(e[0], e[1], weight=e[2])
-
-        # Apply existing properties
-        if self.update_props_after_threshold:
-            self._add_properties(self.node_properties)
-            self._add_properties(self.edge_properties)
+        return weights
 
     def reconstruct_adj_mat(self):
         """
@@ -508,6 +697,7 @@ class Brain:
 
         if not threshold_type:
             self.G = min_t
+            self._invalidate_paths()
             return  # Nothing else to do, just return
         elif threshold_type == 'edgePC':
             # find threshold as a percentage of total possible edges
@@ -559,11 +749,11 @@ class Brain:
             k += 1
 
         self.G = min_t
+        self._invalidate_paths()
 
         # Apply existing properties
         if self.update_props_after_threshold:
-            self._add_properties(self.node_properties)
-            self._add_properties(self.edge_properties)
+            self._apply_edge_properties()
 
     def binarise(self):
         """
@@ -571,6 +761,7 @@ class Brain:
         """
         for edge in self.G.edges(data=True):
             edge[2][ct.WEIGHT] = 1
+        self._invalidate_paths()
 
     def make_edges_absolute(self):
         """
@@ -578,6 +769,7 @@ class Brain:
         """
         for edge in self.G.edges(data=True):
             edge[2][ct.WEIGHT] = abs(edge[2][ct.WEIGHT])
+        self._invalidate_paths()
 
     def remove_unconnected_nodes(self):
         """
@@ -585,6 +777,7 @@ class Brain:
         """
         node_list = [v for v in self.G.nodes() if self.G.degree(v) == 0]
         self.G.remove_nodes_from(node_list)
+        self._invalidate_paths()
 
     def _nng(self, k):
         """ Private method to help local thresholding by creating a k-nearest neighbour graph"""
@@ -700,6 +893,181 @@ class Brain:
         for edge in self.G.edges():
             self.G.edges[edge[0], edge[1]][ct.DISTANCE] = emax - self.G.edges[edge[0], edge[1]][
                 ct.WEIGHT]  # convert weights to a positive distance
+        self._invalidate_paths()
+
+    def shortest_paths(self, weight=ct.DISTANCE, n_jobs=1):
+        """
+        It returns the matrix with the lengths of the shortest paths between all the nodes of G, computed with
+        `scipy.sparse.csgraph` (Dijkstra, or breadth-first search if `weight` is None).
+
+        The matrix is cached, and only computed again if the edges of G (or the attribute `weight` in them) change.
+        Thus, several path-based measures on the same brain (e.g., from `maybrain.metrics`) share a single
+        computation. The returned matrix is read-only.
+
+        Parameters
+        ----------
+        weight: str
+            The edge attribute used as the length of the edges. By default, `constants.DISTANCE`, which can be
+            created with `self.weight_to_distance()`. If None, each edge has length 1
+        n_jobs: int
+            Number of processes computing the paths in parallel, each one from a block of source nodes
+
+        Returns
+        -------
+        dists: np.array
+            Square matrix in which the rows and columns follow the order of `self.G.nodes()`. Unreachable pairs
+            of nodes have np.inf
+
+        Raises
+        ------
+        KeyError: Exception
+            If the edges don't have the `weight` property
+        """
+        if weight is not None and any(weight not in e[2] for e in self.G.edges(data=True)):
+            raise KeyError(weight, "Edge doesn't have the property to use as length")
+
+        # scipy is only imported when needed, to keep the import of maybrain fast
+        from scipy.sparse import csgraph
+        from maybrain import metrics
+
+        nodes, mat = metrics._to_csr(self.G, weight)
+
+        previous = self._paths_cache.get(weight)
+        if previous is not None and previous[0] == nodes and (previous[1] != mat).nnz == 0:
+            return previous[2]
+
+        unweighted = weight is None
+        if n_jobs > 1 and len(nodes) > 1:
+            blocks = np.array_split(np.arange(len(nodes)), min(n_jobs, len(nodes)))
+            with multiprocessing.Pool(n_jobs) as pool:
+                dists = np.vstack(pool.map(_shortest_paths_block,
+                                           [(mat, self.directed, unweighted, b) for b in blocks]))
+        else:
+            dists = csgraph.shortest_path(mat, directed=self.directed, unweighted=unweighted)
+        dists.flags.writeable = False
+
+        self._paths_cache[weight] = (nodes, mat, dists)
+        return dists
+
+    def _invalidate_paths(self):
+        """ Private method to drop the matrices cached by shortest_paths() after changing the edges """
+        self._paths_cache = {}
+
+    def save(self, path):
+        """
+        Saves the brain in a single file: the adjacency matrix, the nodes and edges of G with their attributes,
+        the coordinates and the imported properties. It is a NumPy ".npz" container in which everything is stored
+        as arrays, uncompressed so the adjacency matrix can be memory-mapped by `Brain.load()`
+
+        Parameters
+        ----------
+        path: str
+            The file name, used as is (".npz" is not added)
+        """
+        nodes = list(self.G.nodes())
+        index = {n: i for i, n in enumerate(nodes)}
+        edges = list(self.G.edges(data=True))
+
+        meta = {'version': 2, 'directed': self.directed,
+                'update_props_after_threshold': self.update_props_after_threshold,
+                'node_attrs': [], 'edge_attrs': [], 'node_props': [], 'edge_props': [], 'json_columns': []}
+        arrays = {'edges': np.array([(index[u], index[v]) for u, v, _ in edges], dtype=np.int64).reshape(-1, 2)}
+        if self.adjMat is not None:
+            arrays['adjMat'] = np.asarray(self.adjMat)
+        if self.coords is not None:
+            arrays['coords'] = self.coords
+
+        def pack(name, values):
+            """ It adds the column of values to the arrays, recording the ones encoded as JSON """
+            arrays[name], encoded = _pack_column(values)
+            if encoded:
+                meta['json_columns'].append(name)
+
+        pack('nodes', nodes)
+
+        # Attributes of G, as a column of values with the positions of the nodes/edges which have them
+        for kind, items in [('node_attr', [data for _, data in self.G.nodes(data=True)]),
+                            ('edge_attr', [data for _, _, data in edges])]:
+            columns = {}
+            for pos, data in enumerate(items):
+                for name, val in data.items():
+                    column = columns.setdefault(name, ([], []))
+                    column[0].append(pos)
+                    column[1].append(val)
+            for i, (name, (positions, values)) in enumerate(columns.items()):
+                meta[kind + 's'].append(name)
+                arrays[kind + str(i) + '_pos'] = np.array(positions, dtype=np.int64)
+                pack(kind + str(i), values)
+
+        # Tables of imported properties
+        for i, (name, table) in enumerate(self._node_props.items()):
+            meta['node_props'].append(name)
+            pack('node_prop' + str(i) + '_nodes', list(table.keys()))
+            pack('node_prop' + str(i), list(table.values()))
+        for i, (name, table) in enumerate(self._edge_props.items()):
+            meta['edge_props'].append(name)
+            pack('edge_prop' + str(i) + '_n1', [edge[0] for edge in table])
+            pack('edge_prop' + str(i) + '_n2', [edge[1] for edge in table])
+            pack('edge_prop' + str(i), list(table.values()))
+
+        arrays['meta'] = np.array(json.dumps(meta))
+        with open(path, 'wb') as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """
+        Loads a brain saved with `Brain.save()`. No pickled objects are read from the file, so loading it can't run
+        arbitrary code.
+
+        Parameters
+        ----------
+        path: str
+            The file name
+        mmap_mode: {'c', 'r', None}
+            How the adjacency matrix is memory-mapped from the file, as in `np.load()`: 'c' (copy-on-write, changes
+            are not saved to the file) or 'r' (read-only). If None, it is fully read into memory
+
+        Returns
+        -------
+        brain: Brain
+            A new instance of `Brain`
+        """
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            brain = cls(directed=meta['directed'])
+            brain.update_props_after_threshold = meta['update_props_after_threshold']
+
+            def unpack(name):
+                """ It returns the list of values of a column """
+                return _unpack_column(data[name], name in meta['json_columns'])
+
+            nodes = unpack('nodes')
+            edges = [(nodes[u], nodes[v]) for u, v in data['edges'].tolist()]
+            brain.G.add_nodes_from(nodes)
+            brain.G.add_edges_from(edges)
+
+            for i, name in enumerate(meta['node_attrs']):
+                positions = data['node_attr' + str(i) + '_pos'].tolist()
+                values = unpack('node_attr' + str(i))
+                nx.set_node_attributes(brain.G, {nodes[p]: val for p, val in zip(positions, values)}, name)
+            for i, name in enumerate(meta['edge_attrs']):
+                positions = data['edge_attr' + str(i) + '_pos'].tolist()
+                values = unpack('edge_attr' + str(i))
+                nx.set_edge_attributes(brain.G, {edges[p]: val for p, val in zip(positions, values)}, name)
+
+            for i, name in enumerate(meta['node_props']):
+                brain._node_props[name] = dict(zip(unpack('node_prop' + str(i) + '_nodes'),
+                                                   unpack('node_prop' + str(i))))
+            for i, name in enumerate(meta['edge_props']):
+                keys = zip(unpack('edge_prop' + str(i) + '_n1'), unpack('edge_prop' + str(i) + '_n2'))
+                brain._edge_props[name] = dict(zip(keys, unpack('edge_prop' + str(i))))
+
+            if 'coords' in data.files:
+                brain.coords = data['coords']
+            if 'adjMat' in data.files:
+                brain.adjMat = _mmap_npz_member(path, 'adjMat', mmap_mode) if mmap_mode else data['adjMat']
+        return brain
 
     def copy_hemisphere(self, hsphere="R", midline=0):
         """
@@ -749,3 +1117,99 @@ class Brain:
             self.G.nodes[str(n[0]) + new_name][ct.XYZ] = new_pos
 
         self.G.remove_nodes_from(nodes_to_remove)
+        self._invalidate_paths()
+
+
+def _shortest_paths_block(args):
+    """ Private helper for Brain.shortest_paths() which calculates the paths from a block of source nodes """
+    from scipy.sparse import csgraph
+
+    mat, directed, unweighted, sources = args
+    return csgraph.shortest_path(mat, directed=directed, unweighted=unweighted, indices=sources)
+
+
+def _pack_column(values):
+    """
+    Private helper for Brain.save() which converts a list of values into an array, numeric or of strings when
+    they are all of the same type, or of strings with each value encoded as JSON otherwise.
+    It returns the array and whether it is encoded as JSON
+    """
+    if len({type(v) for v in values}) <= 1:
+        try:
+            arr = np.array(values) if values else np.array([])
+        except ValueError:  # sequences of different lengths
+            arr = None
+        if arr is not None and arr.dtype != object and len(arr) == len(values) and \
+                (arr.ndim == 1 or isinstance(values[0], tuple)):
+            return arr, False
+    return np.array([json.dumps(_to_json(v)) for v in values], dtype=str), True
+
+
+def _unpack_column(arr, encoded=False):
+    """ Private helper for Brain.load() which converts an array from _pack_column() back to a list """
+    if encoded:
+        return [_from_json(json.loads(v)) for v in arr.tolist()]
+    if arr.ndim > 1:
+        return [tuple(v) for v in arr.tolist()]
+    return arr.tolist()
+
+
+def _to_json(value):
+    """
+    Private helper which converts a value into JSON types. Tuples, dictionaries and arrays become objects with
+    a single key identifying them, so _from_json() can restore them
+    """
+    if isinstance(value, np.ndarray):
+        return {'array': value.tolist(), 'dtype': value.dtype.str}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return {'tuple': [_to_json(v) for v in value]}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {'dict': [[_to_json(k), _to_json(v)] for k, v in value.items()]}
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise TypeError("Values of type " + type(value).__name__ + " can't be saved by Brain.save()")
+
+
+def _from_json(value):
+    """ Private helper which converts a value from _to_json() back """
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    if isinstance(value, dict):
+        if 'array' in value:
+            return np.array(value['array'], dtype=value['dtype'])
+        if 'tuple' in value:
+            return tuple(_from_json(v) for v in value['tuple'])
+        return {_from_json(k): _from_json(v) for k, v in value['dict']}
+    return value
+
+
+def _mmap_npz_member(path, name, mmap_mode):
+    """
+    Private helper for Brain.load() which memory-maps an array stored (uncompressed) in a ".npz" file, finding
+    where its data starts inside the zip file
+    """
+    with zipfile.ZipFile(path) as zfile:
+        info = zfile.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(path) as data:
+            return data[name]
+
+    with open(path, 'rb') as file:
+        # The local header has a fixed size of 30 bytes, followed by the file name and an extra field
+        file.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', file.read(30)[26:30])
+        file.seek(info.header_offset + 30 + name_len + extra_len)
+
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+
+    return np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape, order='F' if fortran_order else 'C',
+                     offset=offset)
@@ -7,11 +7,87 @@ It also requires an AAL atlas and AAL regions of interest file (contact me on tr
 @author: tim
 """
 
-import maybrain.brainObj as mbo
-
+import hashlib
 import nibabel as nb
 import numpy as np
-from os import path
+import warnings
+from os import path,rename,getpid,remove
+
+from maybrain import brain as mbt
+from maybrain import constants as ct
+
+def _applyLUT(volume, lut, default=0):
+    """
+    Private helper which returns an array with the value in lut (a dictionary) of each voxel of
+    volume, or default for those not in lut, in a single indexing pass over the volume
+    """
+    labels, inverse = np.unique(volume, return_inverse=True)
+    values = np.array([lut.get(v, default) for v in labels.tolist()])
+    return values[inverse].reshape(np.shape(volume))
+
+def _cacheBase(fileName, cacheDir=None):
+    """
+    Private helper which returns the base name of the cache files of fileName: the file itself, or a name in
+    cacheDir made unique by a hash of the absolute path of the file
+    """
+    if cacheDir is None:
+        return fileName
+    fileName = path.abspath(fileName)
+    digest = hashlib.md5(fileName.encode("utf-8")).hexdigest()[:16]
+    return path.join(cacheDir, digest + "_" + path.basename(fileName))
+
+def loadRegionExpression(fileName, naVal="NA", cacheDir=None):
+    """
+    Loads the expression data of a braineac region (one of the expr_<region>.txt files) as a float32
+    (probes x samples) matrix, with NaN for the missing values (naVal), together with the array of probe ids
+    of its rows. Lines which are not numeric, like a header, are skipped.
+
+    The text file is only parsed the first time: the matrix is cached as a .npy file (and the probe ids in a
+    second one), which is memory-mapped afterwards. The cache is rebuilt if the text file is newer. It is written
+    next to the text file, or in cacheDir if given; if it can't be written, the parsed matrix is returned.
+    """
+    cacheBase = _cacheBase(fileName, cacheDir)
+    exprCache = cacheBase + ".npy"
+    probeCache = cacheBase + ".probes.npy"
+
+    if not (path.exists(exprCache) and path.exists(probeCache) and
+            path.getmtime(exprCache) >= path.getmtime(fileName)):
+        probes = []
+        rows = []
+        f = open(fileName, "r")
+        for line in f:
+            bits = line.split()
+            if not bits:
+                continue
+            try:
+                rows.append([np.nan if v==naVal else float(v) for v in bits[1:]])
+            except ValueError:
+                continue
+            probes.append(bits[0])
+        f.close()
+
+        nSamples = max([len(r) for r in rows]) if rows else 0
+        expr = np.full((len(rows), nSamples), np.nan, dtype="float32")
+        for i,r in enumerate(rows):
+            expr[i,:len(r)] = r
+
+        # written with temporary names and renamed, so other processes never pick up a partial cache
+        tmpExpr = "%s.%d.tmp" % (exprCache, getpid())
+        tmpProbes = "%s.%d.tmp" % (probeCache, getpid())
+        try:
+            with open(tmpProbes, "wb") as pf:
+                np.save(pf, np.array(probes, dtype="U"))
+            with open(tmpExpr, "wb") as ef:
+                np.save(ef, expr)
+            rename(tmpProbes, probeCache)
+            rename(tmpExpr, exprCache)
+        except OSError: # e.g. a read-only directory
+            for tmp in [tmpExpr, tmpProbes]:
+                if path.exists(tmp):
+                    remove(tmp)
+            return np.array(probes, dtype="U"), expr
+
+    return np.load(probeCache), np.load(exprCache, mmap_mode="r")
 
 class braineac:
     """
@@ -55,22 +131,21 @@ class braineac:
         '''
         # load data from aal atlas
         nbaal = nb.load(AAL)
-        aal = nbaal.get_data()
-        self.aff = nbaal.get_affine()
-        self.Header = nbaal.get_header() # get header
-        
-        # Create new template image with new parcel values
-        self.out = np.zeros(aal.shape, dtype="int")  # create output matrix
+        aal = np.asanyarray(nbaal.dataobj)
+        self.aff = nbaal.affine
+        self.Header = nbaal.header # get header
         
         # create dictionary of which the values are parcels in AAL atlas lie within the keys of braineac regions
         # create log file with names and regions
         log = open(logName, "w")
         self.regValDict = {}
+        lut = {} # braineac region of each AAL parcel value
         for n,k in enumerate(self.ROIs.keys()):
             for x in self.ROIs[k]:
-                self.out[np.where(aal==float(x))] = n+1
+                lut[float(x)] = n+1
             log.writelines(' ' .join([str(v) for v in [k,n+1]])+'\n')
             self.regValDict[n+1] = k
+        self.out = _applyLUT(aal, lut).astype("int")
         
         # Save new brain template
         outNii = nb.Nifti1Image(self.out, self.aff, header=self.Header)
@@ -84,37 +159,44 @@ class braineac:
         now let's match up the imaging data to the braineac data        
         to create a brain object and import an association matrix.
         """
-        self.a = mbo.brainObj()
+        self.a = mbt.Brain()
         self.a.import_adj_file(assMat, delimiter=delim)
         
         # get the spatial information and parcellation scheme
         self.a.import_spatial_info(spatialFile)
         self.a.import_iso(parcellation)
-        self.a.parcels(self.a.G.nodes())
+        self.a.parcels(list(self.a.G.nodes()))
         
         # set up output file
         outFile = open(outFile, "w")
         
         for node in self.a.G.nodes():
-            self.a.G.node['braineac'] = None
+            self.a.G.nodes[node]['braineac'] = None
+
+        # joint histogram of the (parcel, braineac region) values of all the voxels, so
+        # overlaps[p,n] is the number of voxels of parcel p in the region n
+        parcels = np.rint(np.ma.filled(self.a.parcel_list, 0)).astype("int").ravel()
+        nRegions = int(self.out.max()) + 1
+        overlaps = np.bincount(parcels * nRegions + self.out.ravel(),
+                               minlength=(parcels.max() + 1) * nRegions).reshape((-1, nRegions))
+        parcelSizes = overlaps.sum(axis=1)
         
         self.nodeDict = {n:{"L":[], "R":[]} for n in range(1,8)}
         for n in list(self.nodeDict.keys()):
-            tmp = self.a.parcelList[np.where(self.out==n)]
-            nodeList = [int(v) for v in np.unique(tmp.data.flatten()) if not v==0]
+            nodeList = [int(v) for v in np.nonzero(overlaps[1:,n])[0] + 1] if n < nRegions else []
             
             # check if 50% of parcel is in the braineac region
             for node in nodeList:
-                rat = float(len(self.a.parcelList[np.where(self.a.parcelList==node) and np.where(self.a.parcelList==n)])) / float(len(self.a.parcelList[np.where(self.a.parcelList==node)]))
+                rat = float(overlaps[node,n]) / float(parcelSizes[node])
                 if rat < 0.5:
                     print(str(node)+" less than 50% in "+str(n))
                     
-                elif self.a.G.node[node-1]["xyz"][0] < midLine:
+                elif self.a.G.nodes[node-1][ct.XYZ][0] < midLine:
                     self.nodeDict[n]["L"].append(node-1)
-                    self.a.G.node[node-1]['braineac'] = self.regValDict[n]+"L"
+                    self.a.G.nodes[node-1]['braineac'] = self.regValDict[n]+"L"
                 else:
                     self.nodeDict[n]["R"].append(node-1)
-                    self.a.G.node[node-1]['braineac'] = self.regValDict[n]+"R"
+                    self.a.G.nodes[node-1]['braineac'] = self.regValDict[n]+"R"
                     
             # write the output in to a file
             outFile.writelines(self.regValDict[n]+"L" + ' ' + ' '.join([str(v) for v in self.nodeDict[n]["L"]])+'\n')
@@ -128,23 +210,24 @@ class braineac:
         they fall in to. The 'comparison' function must have been run first.
         """
         # create parcellation image
-        isoPC = np.zeros(self.a.iso.shape, dtype="int")
+        lut = {} # value in the new parcellation of each parcel in iso
         for pc in list(self.nodeDict.keys()):
             for n,s in enumerate(["L", "R"]):
                 fillVal = float(str(n+1)+str(pc))
                 for ar in self.nodeDict[pc][s]:
-                    isoPC[np.where(self.a.iso==ar+1)] = fillVal
-                    
+                    lut[float(ar+1)] = fillVal
+        isoPC = _applyLUT(self.a.iso, lut).astype("int")
                     
         pcNii = nb.Nifti1Image(isoPC, self.aff, header=self.Header)
         nb.save(pcNii, outFile)
 
-    def braineacData(self, probeList, naVal="NA"):
+    def braineacData(self, probeList, naVal="NA", cacheDir=None):
         """ 
-        Get braineac data for the specified list of probes.
+        Get braineac data for the specified list of probes. The region files are cached as in
+        loadRegionExpression(), in cacheDir if given.
         """
         # create a brain object
-        self.b = mbo.brainObj()
+        self.b = mbt.Brain()
         
         # the list of brineac nodes
         nodeList = [v for v in list(self.regValDict.keys())]
@@ -152,21 +235,16 @@ class braineac:
         
         # iterate through the braineac regions
         for n,k in enumerate(nodeList):
-            # open the data file for the appropriate regions
+            # load the data of the appropriate region, and look up the rows of the probes
             inFile = "expr_"+self.regValDict[k]+'.txt'
-            f = open(path.join(self.braineacDir,inFile), "r")
-            lines = f.readlines()
-            
-            # have a look through each line of the data file to look for the appropriate probe data            
-            for line in lines:
-                bits = line.split()
-                if bits[0] in probeList:
-                    pMean = np.mean([float(v) for v in bits[1:] if not v==naVal])
-                    self.b.G.add_node(n, attr_dict={bits[0]:pMean})
-                
-                
-            
-            
-            
+            probeIDs, expr = loadRegionExpression(path.join(self.braineacDir,inFile), naVal, cacheDir)
+            index = {p:i for i,p in enumerate(probeIDs.tolist())}
+            rows = sorted(set([index[p] for p in probeList if p in index]))
+            if not rows:
+                continue
 
-         
+            # mean of each probe over the samples, ignoring the missing values
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                pMeans = np.nanmean(expr[rows], axis=1, dtype="float64")
+            self.b.G.add_node(n, **dict(zip(probeIDs[rows].tolist(), pMeans.tolist())))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Module which contains the definition of Cohort class.
+"""
+import warnings
+
+import numpy as np
+
+from maybrain import brain as mbt
+
+
+class Cohort:
+    """
+    A class that holds the adjacency matrices of many subjects in a single (subjects x n x n) array, in order to
+    calculate group statistics and threshold all the subjects at once
+    """
+
+    def __init__(self, brains, memmap_file=None):
+        """
+        Initialise the cohort from a group of `Brain`s, all with adjacency matrices of the same size.
+
+        Parameters
+        ----------
+        brains: dict or list
+            A dictionary where the keys identify the subjects and the values are instances of `Brain`, or a list of
+            instances of `Brain` (identified by their position)
+        memmap_file: str
+            If defined, the stacked adjacency matrices are kept in a memory-mapped file in this location instead of
+            in memory
+
+        Raises
+        ------
+        TypeError: Exception
+            If brains is empty, or the brains are not all with the same size
+        """
+        if not isinstance(brains, dict):
+            brains = dict(enumerate(brains))
+        if not brains:
+            raise TypeError("brains is empty, nothing can be done")
+
+        size_brain = None
+        for brn in brains.values():
+            if size_brain is None:
+                size_brain = brn.adjMat.shape[0]
+            if brn.adjMat.shape != (size_brain, size_brain):
+                raise TypeError("The brains are not all with the same size")
+
+        # identification of each subject, in the same order as the first axis of adj
+        self.subjects = list(brains.keys())
+        # the adjacency matrices, shaped (subjects x n x n)
+        self.adj = self._allocate((len(brains), size_brain, size_brain), memmap_file)
+        for i, brn in enumerate(brains.values()):
+            self.adj[i] = brn.adjMat
+
+    @classmethod
+    def from_files(cls, fnames, memmap_file=None, **kwargs):
+        """
+        Creates a cohort from a list of adjacency matrix files, loading one subject at a time so only the stacked
+        array (which can be memory-mapped) is kept.
+
+        Parameters
+        ----------
+        fnames: dict or list
+            A dictionary where the keys identify the subjects and the values are file names, or a list of file names
+            (subjects identified by their position)
+        memmap_file: str
+            If defined, the stacked adjacency matrices are kept in a memory-mapped file in this location
+        kwargs
+            Keyword arguments if you need to pass them to `Brain.import_adj_file()`
+
+        Returns
+        -------
+        cohort: Cohort
+            A new instance of `Cohort`
+        """
+        if not isinstance(fnames, dict):
+            fnames = dict(enumerate(fnames))
+        if not fnames:
+            raise TypeError("fnames is empty, nothing can be done")
+
+        cohort = cls.__new__(cls)
+        cohort.subjects = list(fnames.keys())
+        cohort.adj = None
+        for i, fname in enumerate(fnames.values()):
+            brn = mbt.Brain()
+            brn.import_adj_file(fname, **kwargs)
+            if cohort.adj is None:
+                cohort.adj = cls._allocate((len(fnames),) + brn.adjMat.shape, memmap_file)
+            if brn.adjMat.shape != cohort.adj.shape[1:]:
+                raise TypeError("The brains are not all with the same size")
+            cohort.adj[i] = brn.adjMat
+
+        return cohort
+
+    @staticmethod
+    def _allocate(shape, memmap_file):
+        """ Private method which creates the (subjects x n x n) array, in memory or memory-mapped """
+        if memmap_file is None:
+            return np.empty(shape)
+        return np.memmap(memmap_file, dtype="float64", mode="w+", shape=shape)
+
+    def _reduce(self, func, block_rows=64, **kwargs):
+        """
+        Private method which applies the nan-aware reduction func() over the subjects, a block of rows at a time
+        so a memory-mapped array is never fully loaded
+        """
+        size = self.adj.shape[1]
+        result = np.empty((size, size))
+        with warnings.catch_warnings():
+            # All-NaN cells just give NaN, as for an edge not present in any subject
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            for start in range(0, size, block_rows):
+                result[start:start + block_rows] = func(self.adj[:, start:start + block_rows], axis=0, **kwargs)
+        return result
+
+    def mean(self):
+        """
+        It returns the (n x n) matrix with the mean of each connection across subjects, ignoring NaNs
+        """
+        return self._reduce(np.nanmean)
+
+    def std(self, ddof=0):
+        """
+        It returns the (n x n) matrix with the standard deviation of each connection across subjects, ignoring NaNs
+        """
+        return self._reduce(np.nanstd, ddof=ddof)
+
+    def median(self):
+        """
+        It returns the (n x n) matrix with the median of each connection across subjects, ignoring NaNs
+        """
+        return self._reduce(np.nanmedian)
+
+    def percentile(self, q):
+        """
+        It returns the (n x n) matrix with the q-th percentile (between 0 and 100) of each connection across
+        subjects, ignoring NaNs
+        """
+        return self._reduce(np.nanpercentile, q=q)
+
+    def threshold(self, threshold_type=None, value=0., use_absolute=False, directed=False, block_subjects=16):
+        """
+        Thresholds the adjacency matrices of all the subjects at once, with the same rules as
+        `Brain.apply_threshold()`.
+
+        Parameters
+        ----------
+        threshold_type: {'edgePC', 'totalEdges', 'tVal', None}
+            The type of threshold applied. See `Brain.apply_threshold()`
+        value: float
+            Value according to threshold_type
+        use_absolute: bool
+            Thresholding by absolute value. See `Brain.apply_threshold()`
+        directed: bool
+            If False, only the upper triangle of the matrices is considered and the result is symmetric
+        block_subjects: int
+            Number of subjects thresholded at a time, so a memory-mapped array is never fully loaded
+
+        Returns
+        -------
+        mask: np.array
+            A boolean (subjects x n x n) array, True for the retained edges of each subject
+
+        Raises
+        ------
+        TypeError: Exception
+            If a not valid threshold type is passed
+        """
+        if threshold_type not in ["edgePC", "totalEdges", "tVal", None]:
+            raise TypeError("Not a valid threshold_type for threshold()")
+        if threshold_type == "edgePC" and (value < 0 or value > 100):
+            raise TypeError("Invalid value for edgePC in threshold()")
+
+        n_subjects, size, _ = self.adj.shape
+        if directed:
+            rows, cols = np.nonzero(~np.eye(size, dtype=bool))
+        else:
+            rows, cols = np.triu_indices(size, k=1)
+
+        mask = np.zeros(self.adj.shape, dtype=bool)
+        for start in range(0, n_subjects, block_subjects):
+            block = slice(start, start + block_subjects)
+            mask[block, rows, cols] = self._threshold_block(self.adj[block][:, rows, cols], threshold_type, value,
+                                                            use_absolute)
+            if not directed:
+                mask[block] |= mask[block].transpose((0, 2, 1))
+        return mask
+
+    @staticmethod
+    def _threshold_block(vals, threshold_type, value, use_absolute):
+        """
+        Private method which returns the boolean (subjects x edges) array with the retained edges of each row of
+        vals, the weights of the candidate edges of a block of subjects
+        """
+        valid = ~np.isnan(vals)
+        if threshold_type is None:
+            return valid
+        if threshold_type == 'tVal':
+            with np.errstate(invalid='ignore'):
+                if use_absolute:
+                    return valid & ((vals >= abs(value)) | (vals <= -abs(value)))
+                return valid & (vals >= value)
+
+        # edgePC, totalEdges
+        n_subjects, n_edges = vals.shape
+        key = np.abs(vals) if use_absolute else vals
+        key[~valid] = -np.inf
+        # Stable sort, so ties are broken as in Brain.apply_threshold()
+        order = np.argsort(key, axis=1, kind='mergesort')
+
+        n_valid = valid.sum(axis=1)
+        if threshold_type == 'edgePC':
+            edgenum = ((value / 100.) * n_valid).astype(int)
+        else:
+            edgenum = np.full(n_subjects, int(value))
+        edgenum = np.clip(edgenum, 0, n_valid)
+
+        # Retaining the edgenum strongest edges, at the end of each sorted row
+        keep = np.zeros(vals.shape, dtype=bool)
+        keep[np.arange(n_subjects)[:, np.newaxis], order] = \
+            np.arange(n_edges)[np.newaxis, :] >= (n_edges - edgenum)[:, np.newaxis]
+        return keep
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Module with fast implementations of common graph measures, based on sparse matrices.
+
+All the functions accept either a `nx.Graph` or a `Brain` (in which case `brain.G` is used), and return the same
+kind of result as their networkx counterparts, so they can be passed straight to `algorithms.normalise()`.
+Path-based measures on a `Brain` share the distance matrix cached by `Brain.shortest_paths()`.
+"""
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from maybrain import constants as ct
+
+
+def _get_graph(graph):
+    """ Private helper which returns the nx.Graph of a Brain, or the graph itself """
+    if isinstance(graph, nx.Graph):
+        return graph
+    return graph.G
+
+
+def _to_csr(graph, weight=None):
+    """
+    Private helper which returns the nodes of graph and a sparse matrix in CSR format with the weights in `weight`
+    (or 1 if `weight` is None or the edge doesn't have it, as in networkx) of its edges, ordered as the nodes.
+    Selfloops are ignored.
+    """
+    graph = _get_graph(graph)
+    nodes = list(graph.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+
+    if weight is None:
+        edges = [(index[u], index[v], 1.) for u, v in graph.edges() if u != v]
+    else:
+        edges = [(index[u], index[v], w) for u, v, w in graph.edges(data=weight, default=1.) if u != v]
+    if edges:
+        rows, cols, vals = (np.array(v) for v in zip(*edges))
+        vals = vals.astype(float)
+    else:
+        rows, cols, vals = np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+    if not graph.is_directed():
+        rows, cols = np.concatenate((rows, cols)), np.concatenate((cols, rows))
+        vals = np.concatenate((vals, vals))
+
+    mat = sparse.csr_matrix((vals, (rows, cols)), shape=(len(nodes), len(nodes)))
+    return nodes, mat
+
+
+def _distance_matrix(graph, weight=None):
+    """
+    Private helper which returns the nodes of graph and the matrix with the shortest path lengths between them, using
+    `weight` as the length of the edges (or 1 if `weight` is None). For a Brain, the matrix cached by
+    `Brain.shortest_paths()` is used
+    """
+    if not isinstance(graph, nx.Graph):
+        return list(graph.G.nodes()), graph.shortest_paths(weight)
+    nodes, mat = _to_csr(graph, weight)
+    dists = csgraph.shortest_path(mat, directed=_get_graph(graph).is_directed(), unweighted=weight is None)
+    return nodes, dists
+
+
+def _degrees(graph, weight=None):
+    """
+    Private helper which returns the nodes of graph and an array with the sum of the weights in `weight` (or 1) of
+    the edges of each node. As in networkx, the in and out edges are summed in directed graphs and selfloops count
+    twice
+    """
+    graph = _get_graph(graph)
+    nodes, mat = _to_csr(graph, weight)
+    degs = np.asarray(mat.sum(axis=1)).ravel()
+    if graph.is_directed():
+        degs += np.asarray(mat.sum(axis=0)).ravel()
+
+    if weight is None:
+        loops = [(u, 1.) for u, _ in nx.selfloop_edges(graph)]
+    else:
+        loops = [(u, w) for u, _, w in nx.selfloop_edges(graph, data=weight, default=1.)]
+    index = {n: i for i, n in enumerate(nodes)}
+    for node, wei in loops:
+        degs[index[node]] += 2 * wei
+    return nodes, degs
+
+
+def _efficiency(dists):
+    """ Private helper which returns the global efficiency from a matrix of shortest path lengths """
+    n_nodes = len(dists)
+    if n_nodes < 2:
+        return 0.
+    with np.errstate(divide='ignore'):
+        inv = 1. / dists
+    inv[~np.isfinite(inv)] = 0.  # diagonal and unreachable pairs
+    return inv.sum() / (n_nodes * (n_nodes - 1))
+
+
+def degree(graph):
+    """
+    It returns the number of edges of each node, as `nx.degree()` (in directed graphs, in and out edges are counted,
+    and selfloops count twice)
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+
+    Returns
+    -------
+    degrees: dict
+        A dictionary in which the keys are the nodes and the values are their degree
+    """
+    nodes, degs = _degrees(graph)
+    return dict(zip(nodes, degs.astype(int).tolist()))
+
+
+def strength(graph, weight=ct.WEIGHT):
+    """
+    It returns the sum of the weights of the edges of each node, as `nx.degree()` with `weight`
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute with the weights
+
+    Returns
+    -------
+    strengths: dict
+        A dictionary in which the keys are the nodes and the values are their strength
+    """
+    nodes, degs = _degrees(graph, weight)
+    return dict(zip(nodes, degs.tolist()))
+
+
+def clustering(graph, weight=None):
+    """
+    It returns the clustering coefficient of each node, as `nx.clustering()`.
+
+    For weighted graphs, the geometric average of the subgraph edge weights is used, with the weights normalised by
+    the maximum weight (Onnela et al. (2005) "Intensity and coherence of motifs in weighted complex networks",
+    Physical Review E 71(6)). The triangles are counted with sparse matrix products.
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute with the weights. If None, the binary clustering is calculated
+
+    Returns
+    -------
+    clust: dict
+        A dictionary in which the keys are the nodes and the values are their clustering coefficient
+
+    Raises
+    ------
+    TypeError: Exception
+        If the graph is directed
+    """
+    if _get_graph(graph).is_directed():
+        raise TypeError("clustering() not available for directed graphs")
+
+    nodes, mat = _to_csr(graph, weight)
+    degrees = np.diff(mat.indptr)
+
+    if weight is not None and mat.nnz:
+        mat = mat / np.max(mat.data)
+        mat.data = np.cbrt(mat.data)
+
+    # The diagonal of mat^3 has the (weighted) triangles around each node, counted twice
+    triangles = np.asarray((mat.dot(mat)).multiply(mat).sum(axis=1)).ravel()
+    possible = degrees * (degrees - 1.)
+    clust = np.divide(triangles, possible, out=np.zeros(len(nodes)), where=possible > 0)
+
+    return dict(zip(nodes, clust.tolist()))
+
+
+def average_clustering(graph, weight=None):
+    """
+    It returns the average of the clustering coefficients of all the nodes, as `nx.average_clustering()`.
+    See `clustering()` for more details.
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute with the weights. If None, the binary clustering is calculated
+
+    Returns
+    -------
+    avg: float
+        The average clustering coefficient
+    """
+    clust = list(clustering(graph, weight).values())
+    if not clust:
+        return 0.
+    return float(np.mean(clust))
+
+
+def global_efficiency(graph, weight=None):
+    """
+    It returns the global efficiency of the graph, i.e., the average of the inverse shortest path lengths between
+    all pairs of nodes, as `nx.global_efficiency()`. Paths are calculated with `scipy.sparse.csgraph`.
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute used as the length of the edges, like `constants.DISTANCE`. If None, each edge has
+        length 1
+
+    Returns
+    -------
+    eff: float
+        The global efficiency
+    """
+    _, dists = _distance_matrix(graph, weight)
+    return _efficiency(dists)
+
+
+def local_efficiency(graph, weight=None, nodewise=False):
+    """
+    It returns the local efficiency of the graph, i.e., the average of the global efficiency of the subgraphs
+    induced by the neighbours of each node, as `nx.local_efficiency()`.
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute used as the length of the edges, like `constants.DISTANCE`. If None, each edge has
+        length 1
+    nodewise: bool
+        If True, the local efficiency of each node is returned instead of the average
+
+    Returns
+    -------
+    eff: float or dict
+        The local efficiency, or a dictionary with the local efficiency of each node if `nodewise` is True
+
+    Raises
+    ------
+    TypeError: Exception
+        If the graph is directed
+    """
+    if _get_graph(graph).is_directed():
+        raise TypeError("local_efficiency() not available for directed graphs")
+
+    nodes, mat = _to_csr(graph, weight)
+    effs = np.zeros(len(nodes))
+    for i in range(len(nodes)):
+        neighbours = mat.indices[mat.indptr[i]:mat.indptr[i + 1]]
+        if len(neighbours) < 2:
+            continue
+        sub = mat[neighbours][:, neighbours]
+        effs[i] = _efficiency(csgraph.shortest_path(sub, directed=False, unweighted=weight is None))
+
+    if nodewise:
+        return dict(zip(nodes, effs.tolist()))
+    if not nodes:
+        return 0.
+    return float(np.mean(effs))
+
+
+def characteristic_path_length(graph, weight=None):
+    """
+    It returns the characteristic path length, i.e., the average shortest path length between all pairs of nodes.
+
+    Differently from `nx.average_shortest_path_length()`, disconnected graphs are accepted: pairs of nodes without
+    a path between them are ignored.
+
+    Parameters
+    ----------
+    graph: nx.Graph or maybrain.brain.Brain
+        The graph, or an instance of the `Brain` class
+    weight: str
+        The edge attribute used as the length of the edges, like `constants.DISTANCE`. If None, each edge has
+        length 1
+
+    Returns
+    -------
+    length: float
+        The characteristic path length, or np.nan if there are no paths
+    """
+    _, dists = _distance_matrix(graph, weight)
+    off_diag = ~np.eye(len(dists), dtype=bool)
+    finite = dists[off_diag & np.isfinite(dists)]
+    if not finite.size:
+        return np.nan
+    return float(np.mean(finite))
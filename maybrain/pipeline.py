@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Module to run the same analysis over many subjects, in parallel, collecting the results in a single table
+"""
+import multiprocessing
+import numbers
+
+import numpy as np
+
+from maybrain import brain as mbt
+
+
+def _format_kwargs(kwargs, subject):
+    """ Private helper which fills the string values of kwargs with the fields of the subject """
+    return {k: v.format(**subject) if isinstance(v, str) else v for k, v in kwargs.items()}
+
+
+def _run_subject(args):
+    """
+    Private helper which runs all the steps for a single subject, in a worker process.
+    It returns the position of the subject, the row of results and the error message (None if successful)
+    """
+    pos, subject, steps, directed = args
+    row = {}
+    try:
+        brain = mbt.Brain(directed=directed)
+        brain.subject = subject.get('subject')
+
+        for step in steps:
+            func, kwargs = step[0], _format_kwargs(step[1] if len(step) > 1 else {}, subject)
+            if isinstance(func, str):
+                res = getattr(brain, func)(**kwargs)
+            else:
+                res = func(brain, **kwargs)
+
+            if len(step) > 2:  # the result of this step goes to the table
+                if isinstance(res, dict):
+                    for key, val in res.items():
+                        row[step[2] + '_' + str(key)] = val
+                else:
+                    row[step[2]] = res
+    except Exception as error:
+        return pos, row, type(error).__name__ + ': ' + str(error)
+
+    return pos, row, None
+
+
+def _to_column(values):
+    """ Private helper which converts a list of values into a numeric array if possible """
+    if all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in values if v is not None):
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    return np.array(values, dtype=object)
+
+
+def run(subjects, steps, n_jobs=1, max_tasks_per_child=None, directed=False):
+    """
+    It runs a list of steps over a new `Brain` for each subject, in a pool of processes, and collects the results
+    in a single table.
+
+    Each step is a tuple `(func, kwargs)` or `(func, kwargs, name)`:
+        func -> name of a method of `Brain` (e.g. "import_adj_file"), or a function receiving the brain as
+                first argument (it needs to be picklable, i.e., defined at module level, when `n_jobs` > 1)
+        kwargs -> dictionary with the keyword arguments of func. String values are formatted with the fields of
+                  the subject, so {"fname": "{adj}"} gets the "adj" file of each subject
+        name -> if defined, the return of func goes to the column `name` of the results. If it is a dictionary
+                (e.g., a measure for each node), each key goes to a column `name_key`
+
+    For example:
+        steps = [("import_adj_file", {"fname": "{adj}"}),
+                 ("import_spatial_info", {"fname": "{coords}"}),
+                 ("apply_threshold", {"threshold_type": "edgePC", "value": 5}),
+                 (metrics.global_efficiency, {}, "efficiency")]
+
+    A failure in one subject doesn't stop the others: the row of that subject gets the error message in the column
+    "error", and NaN (or None) in the columns it couldn't calculate.
+
+    Parameters
+    ----------
+    subjects: list
+        List of dictionaries with the fields of each subject, like {"subject": "s01", "adj": "s01/adj.txt"}.
+        A string is taken as {"subject": string}. The field "subject" is stored in `brain.subject`
+    steps: list of tuple
+        The steps to run for each subject, as described above
+    n_jobs: int
+        Number of worker processes. If 1, everything runs in the calling process
+    max_tasks_per_child: int
+        Number of subjects after which each worker process is replaced by a fresh one, to bound memory usage
+    directed: bool
+        Whether the brains are directed
+
+    Returns
+    -------
+    results: dict
+        Columnar table, where the keys are the column names ("subject", "error", and the named steps) and the values
+        are arrays with one element for each subject, in the same order as `subjects`
+    """
+    subjects = [{'subject': s} if isinstance(s, str) else s for s in subjects]
+    tasks = [(pos, subject, steps, directed) for pos, subject in enumerate(subjects)]
+
+    if n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, maxtasksperchild=max_tasks_per_child) as pool:
+            outputs = list(pool.imap_unordered(_run_subject, tasks))
+    else:
+        outputs = [_run_subject(task) for task in tasks]
+    outputs.sort(key=lambda out: out[0])
+
+    columns = {}  # as an ordered set
+    for _, row, _ in outputs:
+        columns.update(dict.fromkeys(row))
+
+    results = {'subject': np.array([s.get('subject') for s in subjects], dtype=object),
+               'error': np.array([out[2] for out in outputs], dtype=object)}
+    for col in columns:
+        results[col] = _to_column([out[1].get(col) for out in outputs])
+    return results
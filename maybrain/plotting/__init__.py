@@ -1,8 +1,43 @@
 """
 Initialisation file for plotting package
 
+The plotting modules are only imported (with matplotlib and nilearn) when one of their functions is first used
+
 """
+from maybrain import _LazyModule
+
+__all__ = ['plot_avg_matrix', 'plot_strength_matrix', 'show', 'plot_weight_distribution', 'plot_connectome']
+
+matrices = _LazyModule(__name__ + '.matrices')
+histograms = _LazyModule(__name__ + '.histograms')
+connectome = _LazyModule(__name__ + '.connectome')
+
+
+def plot_avg_matrix(*args, **kwargs):
+    """ See `maybrain.plotting.matrices.plot_avg_matrix()` """
+    from maybrain.plotting.matrices import plot_avg_matrix as func
+    return func(*args, **kwargs)
+
+
+def plot_strength_matrix(*args, **kwargs):
+    """ See `maybrain.plotting.matrices.plot_strength_matrix()` """
+    from maybrain.plotting.matrices import plot_strength_matrix as func
+    return func(*args, **kwargs)
+
+
+def show(*args, **kwargs):
+    """ See `maybrain.plotting.histograms.show()` """
+    from maybrain.plotting.histograms import show as func
+    return func(*args, **kwargs)
+
+
+def plot_weight_distribution(*args, **kwargs):
+    """ See `maybrain.plotting.histograms.plot_weight_distribution()` """
+    from maybrain.plotting.histograms import plot_weight_distribution as func
+    return func(*args, **kwargs)
+
 
-from .matrices import *
-from .histograms import *
-from .connectome import *
+def plot_connectome(*args, **kwargs):
+    """ See `maybrain.plotting.connectome.plot_connectome()` """
+    from maybrain.plotting.connectome import plot_connectome as func
+    return func(*args, **kwargs)
@@ -8,7 +8,6 @@ import numpy as np
 import networkx as nx
 from nilearn import plotting
 
-from maybrain import constants as ct
 
 
 def plot_connectome(brain,
@@ -67,8 +66,7 @@ def plot_connectome(brain,
         If the edges don't have constants.XYZ property
     """
     try:
-        if list(brain.G.nodes(data=True))[0][1][ct.XYZ]:
-            pass
+        coords = brain.node_coords()
     except KeyError as error:
         import sys
         _, _, tbb = sys.exc_info()
@@ -122,5 +120,5 @@ def plot_connectome(brain,
             kwargs['node_size'] = node_size_min
 
     return plotting.plot_connectome(connection_matrix,
-                                    list(dict(brain.G.nodes(data=ct.XYZ)).values()),
+                                    coords,
                                     **kwargs)
@@ -8,15 +8,26 @@ import matplotlib.ticker as ticker
 import numpy as np
 
 from maybrain import brain as mbt
+from maybrain.cohort import Cohort
 from maybrain import resources as rr
 from maybrain import constants as ct
 
 
-def _get_ordered_array_and_labels(matrix, dummy_adj_file, hemi_prop, lobes_prop, anat_prop,
-                                  hemi_name, lobes_name, anat_name):
+def _get_anatomical_order(dummy_adj_file, hemi_prop, lobes_prop, anat_prop,
+                          hemi_name, lobes_name, anat_name):
+    """
+    Private helper which returns the nodes sorted first by hemisphere, then by lobe,
+    then by anatomical label, and then by node number, together with the respective
+    anatomical labels. If dummy_adj_file is None, the nodes are the ones in anat_prop
+    """
     dummy_brain = mbt.Brain()
-    dummy_brain.import_adj_file(dummy_adj_file)
-    dummy_brain.apply_threshold()
+    if dummy_adj_file is None:
+        with open(anat_prop, 'r') as file:
+            file.readline()
+            dummy_brain.G.add_nodes_from(int(line.split()[0]) for line in file if line.strip())
+    else:
+        dummy_brain.import_adj_file(dummy_adj_file)
+        dummy_brain.apply_threshold()
     dummy_brain.import_properties(anat_prop)
     dummy_brain.import_properties(lobes_prop)
     dummy_brain.import_properties(hemi_prop)
@@ -30,6 +41,14 @@ def _get_ordered_array_and_labels(matrix, dummy_adj_file, hemi_prop, lobes_prop,
     labels = [x[1][anat_name] for x in nodes]
     permutation = [x[0] for x in nodes]
 
+    return permutation, labels
+
+
+def _get_ordered_array_and_labels(matrix, dummy_adj_file, hemi_prop, lobes_prop, anat_prop,
+                                  hemi_name, lobes_name, anat_name):
+    permutation, labels = _get_anatomical_order(dummy_adj_file, hemi_prop, lobes_prop, anat_prop,
+                                                hemi_name, lobes_name, anat_name)
+
     # Copying adjMat, and ordering the rows and columns
     order = np.argsort(permutation)
 
@@ -119,44 +138,7 @@ def plot_avg_matrix(brains, output_file=None, dummy_adj_file=rr.DUMMY_ADJ_FILE_5
     fig, ax : tuple
         if output_file is None, this returns (fig, ax) from the figure created
     """
-    # With empty dictionary, nothing to do
-    if not brains.values():
-        raise TypeError("brains is empty, nothing can be done")
-    # Check correct size of `brains`
-    size_brain = None
-    for brn in brains.values():
-        if not size_brain:
-            size_brain = brn.adjMat.shape[0]
-        elif brn.adjMat.shape != (size_brain, size_brain):
-            raise TypeError("The brains are not all with the same size")
-
-    # The final matrix with the averaged connection strength
-    avg_matrix = np.empty([size_brain, size_brain])
-    # For each edge, it says how many brains contain that edge.
-    # Used to calculate the mean (we have to divide by the total number)
-    elements = np.zeros([size_brain, size_brain], dtype=int)
-
-    avg_matrix[:] = np.nan
-
-    for brn in brains.values():
-        for (x, y), value in np.ndenumerate(brn.adjMat):
-            if np.isnan(value):
-                continue
-
-            if np.isnan(avg_matrix[x][y]):
-                avg_matrix[x][y] = value
-            else:
-                avg_matrix[x][y] += value
-            elements[x][y] += 1
-
-    # Calculating the actual average
-    for x in range(size_brain):
-        for y in range(size_brain):
-            if np.isnan(avg_matrix[x][y]):
-                continue
-            if elements[x][y] == 0:
-                continue
-            avg_matrix[x][y] /= elements[x][y]
+    avg_matrix = Cohort(brains).mean()
 
     arr, labels = _get_ordered_array_and_labels(avg_matrix, dummy_adj_file=dummy_adj_file,
                                                 hemi_prop=hemi_prop, lobes_prop=lobes_prop,
@@ -72,22 +72,19 @@ class MayaviWrapper:
         # select some rows if necessary
         if not node_list:
             node_list = brain.G.nodes()
+        node_list = list(node_list)
 
-            # get coordinates
-            # make into array for easy output
-        #        coords = array([brain.G.nodes[x][ct.XYZ] for x in nodeList])
-
-        #        # get nodes from networkx object
-        #        else:
-        coords = []
-        for x in brain.G.nodes():
-            # put into list
-            try:
-                coords.append(brain.G.nodes[x][ct.XYZ])
-            except KeyError:
-                print(('node ' + str(x) + ' not found in function coords_to_list'))
-
-        coords = array(coords)
+        try:
+            coords = brain.node_coords(node_list)
+        except KeyError:
+            coords = []
+            for x in node_list:
+                # put into list
+                try:
+                    coords.append(brain.node_coords([x])[0])
+                except KeyError:
+                    print(('node ' + str(x) + ' not found in function coords_to_list'))
+            coords = array(coords)
 
         # return x, y and z coordinates
         return coords[:, 0], coords[:, 1], coords[:, 2]
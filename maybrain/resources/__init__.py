@@ -2,12 +2,19 @@
 Initialisation file for resources package
 
 """
-import pkg_resources
+import os
 
-PROPERTIES_ANATLABEL_500 = pkg_resources.resource_filename('maybrain', 'resources/properties_anatlabels_500.txt')
-PROPERTIES_HEMISPHERES_500 = pkg_resources.resource_filename('maybrain', 'resources/properties_hemispheres_500.txt')
-PROPERTIES_LOBES_500 = pkg_resources.resource_filename('maybrain', 'resources/properties_lobes_500.txt')
+try:
+    from importlib.resources import files
 
-DUMMY_ADJ_FILE_500 = pkg_resources.resource_filename('maybrain', 'resources/adj_file_500.txt')
+    _RESOURCES_DIR = str(files(__name__))
+except ImportError:  # Python < 3.9
+    _RESOURCES_DIR = os.path.dirname(os.path.abspath(__file__))
 
-MNI_SPACE_COORDINATES_500 = pkg_resources.resource_filename('maybrain', 'resources/parcel_500.txt')
+PROPERTIES_ANATLABEL_500 = os.path.join(_RESOURCES_DIR, 'properties_anatlabels_500.txt')
+PROPERTIES_HEMISPHERES_500 = os.path.join(_RESOURCES_DIR, 'properties_hemispheres_500.txt')
+PROPERTIES_LOBES_500 = os.path.join(_RESOURCES_DIR, 'properties_lobes_500.txt')
+
+DUMMY_ADJ_FILE_500 = os.path.join(_RESOURCES_DIR, 'adj_file_500.txt')
+
+MNI_SPACE_COORDINATES_500 = os.path.join(_RESOURCES_DIR, 'parcel_500.txt')
@@ -7,3 +7,4 @@ from .brain_utils import *
 from .bct import *
 from .highlights import *
 from .writers import *
+from .cache import *
@@ -2,9 +2,10 @@
 """
 Utility module with recipes to calculate some common measures
 """
-from os import path, rename
 import numpy as np
 
+from .writers import ResultsWriter
+
 
 def threshold_to_percentage(brain, threshold):
     """
@@ -70,55 +71,45 @@ def write_results(results, measure,
                   append=True,
                   propdict=None):
     """
-    Function to write out results
-    """
-    outfile = outfilebase + measure + '.txt'
-    if not path.exists(outfile) or not append:
-        if path.exists(outfile):
-            rename(outfile, outfile + '.old')
-        file = open(outfile, "w")
-        writeheadflag = True
+    Function to write out results, in a space separated file named outfilebase + measure + '.txt'.
 
-    else:
-        file = open(outfile, "a")
-        writeheadflag = False
+    This is kept for compatibility: it writes a single row each time it is called, so use a
+    `utils.ResultsWriter` to write many results efficiently.
 
+    Parameters
+    ----------
+    results: dict, list or value
+        The results to write. The keys of a dictionary, the positions of a list, or the measure itself
+        are the columns of the file
+    measure: str
+        Name of the measure
+    outfilebase: str
+        Start of the file name
+    append: bool
+        If False, an existing file is renamed with the suffix ".old"
+    propdict: dict
+        Extra columns written before the results, like {'subject': 's01'}
+    """
     # check to see what form the results take
-    if isinstance(results, (dict)):
-        headers = [v for v in list(results.keys())]
-        headers.sort()
-
-        out = ' '.join([str(results[v]) if v in list(results.keys()) else 'NA' for v in headers])
-
-    elif isinstance(results, (list)):
-        if writeheadflag:
-            headers = ' '.join([str(v) for v in range(len(results))])
-        out = ' '.join([str(v) for v in results])
-
+    if isinstance(results, dict):
+        columns = [str(k) for k in sorted(results.keys())]
+        row = {str(k): v for k, v in results.items()}
+    elif isinstance(results, list):
+        columns = [str(i) for i in range(len(results))]
+        row = dict(zip(columns, results))
     else:
-        if writeheadflag:
-            headers = [measure]
-        out = str(results)
-
-    # write headers
-    if propdict:
-        propheaders = list(propdict.keys())
-        propheaders.sort()
-
-    if writeheadflag:
-        headers = ' '.join([str(v) for v in headers])
-        if propdict:
-            headers = ' '.join([' '.join(propheaders), headers])
-
-        file.writelines(headers + '\n')
+        columns = [measure]
+        row = {measure: results}
 
     # add on optional extras
     if propdict:
-        outprops = ' '.join([str(propdict[v]) for v in propheaders])
-        out = ' '.join([outprops, out])
+        columns = [str(k) for k in sorted(propdict.keys())] + columns
+        row.update({str(k): v for k, v in propdict.items()})
 
-    file.writelines(out + '\n')
-    file.close()
+    writer = ResultsWriter(outfilebase + measure + '.txt', append=append, buffer_rows=1)
+    if writer.columns is None:  # new file
+        writer.columns = columns
+    writer.write(row)
 
 
 def extract_coordinates(template, outfile="ROI_xyz.txt"):
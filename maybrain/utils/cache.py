@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Module with an opt-in on-disk cache for expensive computations over a brain.
+
+The results are stored in a directory, keyed by a hash of the brain's data (`adjMat` and the edges of `G`), the name
+of the function and its parameters, so re-running the same analysis returns straight away. The cache is bounded in
+size, evicting the least recently used results first. It is disabled until `enable_cache()` is called.
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+_CACHE = None
+
+
+class ResultCache:
+    """
+    A directory of pickled results, bounded in size with least recently used eviction
+    """
+
+    def __init__(self, directory, max_size=2 ** 30):
+        """
+        Parameters
+        ----------
+        directory: str
+            Location of the cache. It is created if it doesn't exist, and it can be shared among processes
+        max_size: int
+            Maximum size in bytes of all the stored results
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        """ Private method which returns the file of a key """
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        """
+        It returns a tuple (found, value) with the value stored under key, marking it as recently used
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        try:
+            os.utime(path)
+        except OSError:  # evicted meanwhile by another process
+            pass
+        return True, value
+
+    def put(self, key, value):
+        """
+        It stores value under key, evicting the least recently used results if max_size is exceeded
+        """
+        # Written to a temporary file and renamed, so other processes never read a partial result
+        fdesc, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fdesc, 'wb') as file:
+                pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        """ Private method which removes the oldest results until the cache fits in max_size """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        It removes all the stored results
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+
+def enable_cache(directory, max_size=2 ** 30):
+    """
+    It enables the on-disk cache of `Brain.apply_threshold()`, `algorithms.modularity()`, `algorithms.robustness()`
+    and `algorithms.normalise()`.
+
+    Parameters
+    ----------
+    directory: str
+        Location of the cache
+    max_size: int
+        Maximum size in bytes of all the stored results
+
+    Returns
+    -------
+    cache: ResultCache
+        The cache in use
+    """
+    global _CACHE
+    _CACHE = ResultCache(directory, max_size)
+    return _CACHE
+
+
+def disable_cache():
+    """
+    It disables the on-disk cache. The stored results are kept in disk
+    """
+    global _CACHE
+    _CACHE = None
+
+
+def _hash_code(code):
+    """ Private helper which returns a stable representation of a code object, including its nested functions """
+    consts = [_hash_code(c) if inspect.iscode(c) else repr(c) for c in code.co_consts]
+    return repr((code.co_code, code.co_names, consts))
+
+
+def _hash_param(value, _seen=frozenset()):
+    """
+    Private helper which returns a stable representation of a parameter. Functions are represented by their name
+    and also their code, defaults and closure, so different lambdas or closures from the same factory get
+    different keys
+    """
+    if isinstance(value, functools.partial):
+        return repr(('partial', _hash_param(value.func, _seen), _hash_param(value.args, _seen),
+                     _hash_param(value.keywords, _seen)))
+    if inspect.isfunction(value):
+        name = value.__module__ + '.' + value.__qualname__
+        if id(value) in _seen:  # a recursive function in its own closure
+            return name
+        _seen = _seen | {id(value)}
+        closure = [cell.cell_contents for cell in value.__closure__ or []]
+        return repr((name, _hash_code(value.__code__), _hash_param(value.__defaults__, _seen),
+                     _hash_param(value.__kwdefaults__, _seen), _hash_param(closure, _seen)))
+    if callable(value) and hasattr(value, '__qualname__'):
+        return getattr(value, '__module__', '') + '.' + value.__qualname__
+    if isinstance(value, dict):
+        return repr(sorted((str(k), _hash_param(v, _seen)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return repr([_hash_param(v, _seen) for v in value])
+    if isinstance(value, np.ndarray):
+        return hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    return repr(value)
+
+
+def _make_key(name, func, brain, args, kwargs, uses_graph, ignore=()):
+    """
+    Private helper which returns the hash of the brain's data, the name of the function and its parameters, except
+    the ones in ignore
+    """
+    digest = hashlib.sha1(name.encode())
+
+    if brain.adjMat is not None:
+        adj = np.ascontiguousarray(brain.adjMat)
+        digest.update(repr((adj.shape, adj.dtype.str)).encode())
+        digest.update(adj.tobytes())
+    digest.update(repr(brain.directed).encode())
+    digest.update(repr(list(brain.G.nodes())).encode())
+    if uses_graph:
+        digest.update(repr(list(brain.G.edges(data=True))).encode())
+
+    bound = inspect.signature(func).bind(brain, *args, **kwargs)
+    bound.apply_defaults()
+    params = [(param, val) for param, val in list(bound.arguments.items())[1:]  # the brain is already in the hash
+              if param not in ignore]
+    digest.update(_hash_param(params).encode())
+
+    # the values of the attributes passed on to the calculation, besides their names
+    node_attrs = bound.arguments.get('node_attrs') or []
+    if node_attrs:
+        digest.update(_hash_param([[data.get(attr) for attr in node_attrs]
+                                   for _, data in brain.G.nodes(data=True)]).encode())
+    edge_attrs = bound.arguments.get('edge_attrs') or []
+    if edge_attrs and not uses_graph:
+        digest.update(_hash_param([[data.get(attr) for attr in edge_attrs]
+                                   for _, _, data in brain.G.edges(data=True)]).encode())
+    return digest.hexdigest()
+
+
+def cached(name, uses_graph=False, state=None, restore=None, ignore=()):
+    """
+    Decorator which caches the return of a function whose first argument is a brain, when the cache is enabled.
+
+    Parameters
+    ----------
+    name: str
+        Name identifying the function in the cache
+    uses_graph: bool
+        Whether the result depends on the edges of `brain.G` (and their attributes), and not only on `brain.adjMat`
+    state
+        For functions changing the brain: state(brain) returns what is changed, to be stored with the result
+    restore
+        restore(brain, value) applies to the brain what was returned by state(), when the result is found in the
+        cache
+    ignore: tuple of str
+        Parameters which don't change the result, like the number of parallel jobs, left out of the key
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(brain, *args, **kwargs):
+            if _CACHE is None:
+                return func(brain, *args, **kwargs)
+
+            key = _make_key(name, func, brain, args, kwargs, uses_graph, ignore)
+            found, value = _CACHE.get(key)
+            if found:
+                result, changes = value
+                if restore is not None:
+                    restore(brain, changes)
+                return result
+
+            result = func(brain, *args, **kwargs)
+            _CACHE.put(key, (result, state(brain) if state is not None else None))
+            return result
+
+        return wrapper
+
+    return decorator
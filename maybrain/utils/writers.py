@@ -1,9 +1,31 @@
 """
 Utility functions for writing maybrain entities to files
 """
-def output_adj_matrix(brain, filename):
+import gzip
+import numbers
+import os
+import uuid
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not available in Windows, where appends of a single write are not interleaved anyway
+    fcntl = None
+
+
+def _float_format(precision):
+    """ Private helper which returns the format of floats with `precision` significant digits, or str() if None """
+    return '%s' if precision is None else '%.' + str(int(precision)) + 'g'
+
+
+def output_adj_matrix(brain, filename, precision=None):
     """
-    Outputs the adjacency matrix to a file
+    Outputs the adjacency matrix to a file.
+
+    The format depends on the extension of filename: ".npy" and ".npz" (compressed, with the matrix in "adjMat")
+    are binary NumPy files. Otherwise, the matrix is written as tab separated text, compressed on the fly if the
+    extension is ".gz"
 
     Parameters
     ----------
@@ -11,55 +33,256 @@ def output_adj_matrix(brain, filename):
         An instance of the `Brain` class
     filename: str
         The filename to which the adjacency matrix will be written
+    precision: int
+        Number of significant digits of the numbers in a text file. If None, they are written as `str()` does
     """
 
     try:
-        with open(filename, "w") as file:
-            for line in brain.adjMat:
-                for num in line[:-1]:
-                    file.write(str(num) + '\t')
-                file.write(str(line[-1]) + '\n')
+        if filename.endswith('.npy'):
+            np.save(filename, brain.adjMat)
+        elif filename.endswith('.npz'):
+            np.savez_compressed(filename, adjMat=brain.adjMat)
+        elif precision is None:
+            # Python floats are formatted faster than numpy's, with the same shortest representation
+            with (gzip.open(filename, 'wt') if filename.endswith('.gz') else open(filename, 'w')) as file:
+                file.writelines('\t'.join(map(repr, row)) + '\n' for row in brain.adjMat.tolist())
+        else:
+            np.savetxt(filename, brain.adjMat, fmt=_float_format(precision), delimiter='\t')
     except IOError as error:
-        error.strerror = 'Problem with opening file "' + filename + '": ' + error.strerror
+        error.strerror = 'Problem with opening file "' + filename + '": ' + str(error.strerror)
         raise error
 
 
-def output_edges(brain, filename, properties=None):
+def _column_array(values):
     """
-    Outputs the edges of a brain to file
+    Private helper which converts a list of values into a numeric array (NaN for missing values) if possible,
+    otherwise into an array of strings ('NA' for missing values)
+    """
+    if all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in values if v is not None):
+        if any(v is None for v in values):
+            return np.array([np.nan if v is None else v for v in values], dtype=float)
+        return np.array(values) if values else np.array([], dtype=float)
+    return np.array(['NA' if v is None else str(v) for v in values])
+
+
+def edges_array(brain, properties=None):
+    """
+    It returns the edges of a brain as a structured array, with the fields "n1" and "n2" for the nodes and one
+    field for each property
 
     Parameters
     ----------
     brain: maybrain.brain.Brain
         An instance of the `Brain` class
-    filename: str
-        The filename to which the edges will be written
     properties: list
-        The list of properties you want to save from each edge
+        The list of properties you want from each edge. An edge without a property gets NaN (or 'NA' for
+        non-numeric properties)
+
+    Returns
+    -------
+    edges: np.array
+        Structured array with one element for each edge
     """
     if properties is None:
         properties = []
+
+    columns = {'n1': [], 'n2': []}
+    columns.update({prop: [] for prop in properties})
+    for n1, n2, data in brain.G.edges(data=True):
+        columns['n1'].append(n1)
+        columns['n2'].append(n2)
+        for prop in properties:
+            columns[prop].append(data.get(prop))
+
+    arrays = [_column_array(values) for values in columns.values()]
+    edges = np.empty(brain.G.number_of_edges(), dtype=[(name, arr.dtype) for name, arr in zip(columns, arrays)])
+    for name, arr in zip(columns, arrays):
+        edges[name] = arr
+    return edges
+
+
+def output_edges(brain, filename, properties=None, precision=None):
+    """
+    Outputs the edges of a brain to file.
+
+    If filename ends in ".npy", the structured array of `edges_array()` is saved. Otherwise, the edges are written
+    as tab separated text with a header, compressed on the fly if the extension is ".gz"
+
+    Parameters
+    ----------
+    brain: maybrain.brain.Brain
+        An instance of the `Brain` class
+    filename: str
+        The filename to which the edges will be written
+    properties: list
+        The list of properties you want to save from each edge. An edge without a property gets NaN (or 'NA' for
+        non-numeric properties)
+    precision: int
+        Number of significant digits of the floats in a text file. If None, they are written as `str()` does
+    """
+    edges = edges_array(brain, properties)
     try:
-        with open(filename, "w") as file:
-            # write column headers
-            line = 'n1' + '\t' + 'n2'
-            for prop in properties:
-                line = line + '\t' + prop
-            line = line + '\n'
-            file.write(line)
-
-            for e in brain.G.edges(data=True):
-                # add coordinates
-                line = str(e[0]) + '\t' + str(e[1])
-                # add other properties
-                for prop in properties:
-                    try:
-                        line = line + '\t' + str(e[2][prop])
-                    except BaseException:
-                        continue  # Property doesn't exist, just continue
-                line = line + '\n'
-                # write out
-                file.write(line)
+        if filename.endswith('.npy'):
+            np.save(filename, edges)
+        else:
+            fmt = [_float_format(precision) if edges.dtype[name].kind == 'f' else '%s' for name in edges.dtype.names]
+            np.savetxt(filename, edges, fmt=fmt, delimiter='\t', header='\t'.join(edges.dtype.names), comments='')
     except IOError as error:
-        error.strerror = 'Problem with opening file "' + filename + '": ' + error.strerror
+        error.strerror = 'Problem with opening file "' + filename + '": ' + str(error.strerror)
         raise error
+
+
+class ResultsWriter:
+    """
+    A buffered sink of results, in which each row is a dictionary of column -> value.
+
+    Rows are kept in memory and written in batches, either as delimited text (header in the first line, 'NA' for
+    missing values) or as Parquet. Many processes can append to the same output at the same time: text batches are
+    written under an exclusive lock of the file, and each Parquet batch goes to a new part file in the output
+    directory (read them together with `pyarrow.parquet.read_table(filename)`).
+
+    It can be used as a context manager, flushing the remaining rows on exit:
+        with ResultsWriter("results.txt") as writer:
+            for brain in brains:
+                writer.write({'subject': brain.subject, 'efficiency': metrics.global_efficiency(brain)})
+    """
+
+    def __init__(self, filename, columns=None, buffer_rows=1000, append=True, delimiter=' ', fmt=None,
+                 float_format=None):
+        """
+        Parameters
+        ----------
+        filename: str
+            The file to write to. For Parquet, the directory where the part files are written
+        columns: list
+            The names of the columns. If None, they are taken from the header of an existing text file, or from the
+            (sorted) keys of the first row
+        buffer_rows: int
+            Number of rows kept in memory before writing them
+        append: bool
+            If False, an existing output is renamed with the suffix ".old" (as `utils.write_results()`). Use True
+            when many processes write to the same output
+        delimiter: str
+            The delimiter of the columns in a text file, like ',' for CSV
+        fmt: {'text', 'parquet', None}
+            The format of the output. If None, it is 'parquet' when filename ends in ".parquet", 'text' otherwise
+        float_format: str
+            Format of the floats in a text file, like '%.6g'. If None, `str()` is used
+
+        Raises
+        ------
+        TypeError: Exception
+            If a not valid fmt is passed
+        """
+        if fmt is None:
+            fmt = 'parquet' if filename.endswith('.parquet') else 'text'
+        if fmt not in ['text', 'parquet']:
+            raise TypeError("Not a valid fmt for ResultsWriter")
+
+        self.filename = filename
+        self.columns = list(columns) if columns is not None else None
+        self.buffer_rows = buffer_rows
+        self.delimiter = delimiter
+        self.fmt = fmt
+        self.float_format = float_format
+        self._rows = []
+
+        if not append and os.path.exists(filename):
+            os.replace(filename, filename + '.old')
+        if self.columns is None and fmt == 'text' and os.path.exists(filename):
+            with open(filename) as file:
+                header = file.readline().rstrip('\n')
+            if header:
+                self.columns = header.split(None if delimiter.isspace() else delimiter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, row):
+        """
+        It adds a row of results, writing the buffered rows if there are `buffer_rows` of them
+
+        Parameters
+        ----------
+        row: dict
+            Dictionary in which the keys are column names
+
+        Raises
+        ------
+        KeyError: Exception
+            If row has a column which is not in the columns of the output
+        """
+        if self.columns is None:
+            self.columns = sorted(row.keys(), key=str)
+        extra = set(row) - set(self.columns)
+        if extra:
+            raise KeyError("Columns " + str(sorted(extra, key=str)) + " are not in the columns of " + self.filename)
+
+        self._rows.append(row)
+        if len(self._rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        It writes the buffered rows
+        """
+        if not self._rows:
+            return
+        columns = {col: [row.get(col) for row in self._rows] for col in self.columns}
+        if self.fmt == 'parquet':
+            self._flush_parquet(columns)
+        else:
+            self._flush_text(columns)
+        self._rows = []
+
+    def close(self):
+        """
+        It writes the remaining buffered rows
+        """
+        self.flush()
+
+    def _format_column(self, values):
+        """ Private method which converts a column to an array of strings, with 'NA' for missing values """
+        if self.float_format is not None and \
+                all(isinstance(v, numbers.Real) and not isinstance(v, bool) for v in values if v is not None):
+            col = np.array([np.nan if v is None else v for v in values], dtype=float)
+            out = np.char.mod(self.float_format, col).astype(object)
+            out[np.isnan(col)] = 'NA'
+            return out
+        return np.array(['NA' if v is None else str(v) for v in values], dtype=object)
+
+    def _flush_text(self, columns):
+        """ Private method which appends the buffered rows to the text file, in a single locked write """
+        str_cols = [self._format_column(values) for values in columns.values()]
+        chunk = '\n'.join(self.delimiter.join(line) for line in zip(*str_cols)) + '\n'
+
+        with open(self.filename, 'a') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(file.fileno()).st_size == 0:  # new file, header needed
+                    chunk = self.delimiter.join(str(col) for col in self.columns) + '\n' + chunk
+                file.write(chunk)
+                file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _flush_parquet(self, columns):
+        """ Private method which writes the buffered rows to a new part file in the output directory """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is needed to write results in Parquet format")
+
+        os.makedirs(self.filename, exist_ok=True)
+        table = pyarrow.table({str(col): values for col, values in columns.items()})
+        part = 'part-' + str(os.getpid()) + '-' + uuid.uuid4().hex + '.parquet'
+        # Written with a temporary name, so readers never see a partial part
+        tmp_path = os.path.join(self.filename, '.' + part)
+        pyarrow.parquet.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(self.filename, part))
@@ -0,0 +1,32 @@
+"""
+Benchmark of the import time of maybrain, each import timed in a fresh interpreter.
+
+It compares the lazy import of the analysis packages with importing also the plotting modules (matplotlib and
+nilearn) and scipy, which is what `import maybrain.brain, maybrain.algorithms` used to load.
+
+Usage:
+    python test/benchmark_imports.py [runs]
+"""
+import subprocess
+import sys
+
+CASES = [("lazy", "import maybrain.brain, maybrain.algorithms"),
+         ("eager", "import maybrain.brain, maybrain.algorithms, maybrain.plotting.matrices, "
+                   "maybrain.plotting.histograms, maybrain.plotting.connectome, scipy.sparse.csgraph")]
+
+
+def time_import(statement, runs):
+    """ It returns the median wall time of running statement in a new interpreter, excluding its startup """
+    times = []
+    for _ in range(runs):
+        code = "import timeit; print(timeit.timeit(%r, number=1))" % statement
+        out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True).stdout
+        times.append(float(out))
+    return sorted(times)[len(times) // 2]
+
+
+if __name__ == '__main__':
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, stmt in CASES:
+        print("%-6s %.3f s  (%s)" % (name, time_import(stmt, n_runs), stmt))
@@ -1,6 +1,14 @@
+import functools
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from maybrain import brain as mbt
+from maybrain import algorithms as mba
+from maybrain import cohort as mbc
+from maybrain import pipeline
 from maybrain import constants as ct
 from maybrain import utils
 import networkx as nx
@@ -71,6 +79,20 @@ class TestBrainObj(unittest.TestCase):
         self.assertEqual(attrs2[0], '0')
         self.assertEqual(attrs2[3], '3')
 
+        # All the coordinates of the file are kept
+        self.assertEqual(self.a.coords.shape, (9, 3))
+        self.assertEqual(list(self.a.coords[8]), [2., 2., 2.])
+        self.assertTrue(np.array_equal(self.a.node_coords(), [attrs[n] for n in self.a.G.nodes()]))
+        # imported coordinates replace the ones kept
+        self.a.import_node_props_from_dict(ct.XYZ, {0: (99., 99., 99.)})
+        self.assertEqual(self.a.node_coords([0]).tolist(), [[99., 99., 99.]])
+        self.assertEqual(list(self.a.coords[0]), [99., 99., 99.])
+        self.a.G.remove_node(1)
+        self.a.copy_hemisphere("R", midline=1)
+        nodes = list(self.a.G.nodes())
+        self.assertTrue(np.array_equal(self.a.node_coords(nodes), [self.a.G.nodes[n][ct.XYZ] for n in nodes]))
+        self.assertRaises(KeyError, self.a.node_coords, ['none'])
+
     def test_apply_threshold(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2, 4])
         self.a.import_spatial_info(self.COORD_FILE)  # making sure this doesn't influence the rest
@@ -287,10 +309,102 @@ class TestBrainObj(unittest.TestCase):
         self.assertTrue(all(emax == e[2][ct.DISTANCE] + e[2][ct.WEIGHT] for e in self.a.G.edges(data=True)))
         self.assertTrue(all(e[2][ct.DISTANCE] > 0 for e in self.a.G.edges(data=True)))
 
+    def test_shortest_paths(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=30)
+        self.assertRaises(KeyError, self.a.shortest_paths)
+        self.a.weight_to_distance()
+
+        dists = self.a.shortest_paths()
+        expected = dict(nx.shortest_path_length(self.a.G, weight=ct.DISTANCE))
+        nodes = list(self.a.G.nodes())
+        for i, j in [(0, 1), (3, 7), (14, 2)]:
+            self.assertAlmostEqual(dists[i, j], expected[nodes[i]][nodes[j]])
+        # Cached until an edge changes
+        self.assertIs(dists, self.a.shortest_paths())
+        edge = list(self.a.G.edges())[0]
+        self.a.G.edges[edge][ct.DISTANCE] = 1e-5
+        self.assertIsNot(dists, self.a.shortest_paths())
+        self.assertAlmostEqual(self.a.shortest_paths()[edge[0], edge[1]], 1e-5)
+
+        self.a.apply_threshold(threshold_type="edgePC", value=30)
+        hops = self.a.shortest_paths(weight=None)
+        self.a._invalidate_paths()
+        self.assertTrue(np.array_equal(hops, self.a.shortest_paths(weight=None, n_jobs=2)))
+
+    def test_save_load(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2])
+        self.a.import_spatial_info(self.COORD_FILE)
+        self.a.apply_threshold("totalEdges", 10)
+        self.a.import_properties(self.PROPS_FILE)
+        # values of mixed types are kept too
+        self.a.G.add_node('extra', **{ct.XYZ: (1., 2., 3.)})
+        self.a.import_node_props_from_dict('mixed', {0: 'a', 1: 3, 3: (1, 'x'), 5: None, 'extra': {'k': [1.5]}})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, "brain.npz")
+            self.a.save(fname)
+            with np.load(fname, allow_pickle=False) as data:
+                self.assertFalse(any(data[name].dtype == object for name in data.files))
+            b = mbt.Brain.load(fname)
+
+            self.assertIsInstance(b.adjMat, np.memmap)
+            self.assertTrue(np.array_equal(b.adjMat, self.a.adjMat, equal_nan=True))
+            self.assertTrue(np.array_equal(b.coords, self.a.coords))
+            self.assertEqual(list(b.G.nodes(data=True)), list(self.a.G.nodes(data=True)))
+            self.assertEqual(list(b.G.edges(data=True)), list(self.a.G.edges(data=True)))
+            self.assertEqual(b.node_properties, self.a.node_properties)
+            self.assertEqual(b.edge_properties, self.a.edge_properties)
+            # and it works as usual
+            b.apply_threshold()
+            self.a.apply_threshold()
+            self.assertEqual(b.G.number_of_edges(), self.a.G.number_of_edges())
+            del b
+
+    def test_parcels(self):
+        import nibabel as nb
+        self.a.iso = np.array([[[0, 1, 2], [3, 1, 0]], [[2, 4, 3], [0, 4, 1]]], dtype=float)
+        self.a.nbiso = nb.Nifti1Image(self.a.iso, np.eye(4))
+        self.a.iso_header = self.a.nbiso.header
+
+        self.a.parcels([0, 2, 7])
+        self.assertTrue(np.array_equal(self.a.parcel_list.filled(0), np.where(np.isin(self.a.iso, [1, 3]),
+                                                                              self.a.iso, 0)))
+        self.assertEqual(self.a.parcel_list.count(), 5)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, "parcels")
+            self.a.export_parcels_nii(fname, value_dict={0: 0.5, 3: 2., 9: 1.})
+            out = np.asanyarray(nb.load(fname + '.nii').dataobj)
+            self.assertTrue(np.array_equal(out, [[[0, .5, 0], [0, .5, 0]], [[0, 2., 0], [0, 2., .5]]]))
+
+    def test_lazy_imports(self):
+        # Heavy dependencies are only imported when plotting or the sparse measures are used
+        code = "import sys, maybrain.brain, maybrain.algorithms, maybrain.plotting; " \
+               "print([m for m in ('matplotlib', 'nilearn', 'pkg_resources', 'scipy') if m in sys.modules])"
+        out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True).stdout
+        self.assertEqual(out.strip(), "[]")
+
+        # and they are available through the packages
+        code = "import maybrain as mb, maybrain.plotting as mpt; " \
+               "print(mb.algorithms.normalise.__module__, mpt.plot_connectome.__module__, mpt.matrices.__name__, " \
+               "'normalise' in dir(mb.algorithms))"
+        out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True).stdout
+        self.assertEqual(out.split(), ["maybrain.algorithms.normalisation", "maybrain.plotting",
+                                       "maybrain.plotting.matrices", "True"])
+
+        # placeholders imported before the module forward to it, also when setting attributes
+        code = "import sys; from maybrain import algorithms as mba; mba.normalise; mba.flag = 1; " \
+               "print(sys.modules['maybrain.algorithms'].flag)"
+        out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True,
+                             check=True).stdout
+        self.assertEqual(out.strip(), "1")
+
     def test_properties(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.apply_threshold()
-        self.a.import_properties(self.PROPS_FILE)
+        self.assertEqual(self.a.import_properties(self.PROPS_FILE), 1)  # node 6 doesn't exist
 
         for e in range(2):
             # 2nd iteration
@@ -312,8 +426,8 @@ class TestBrainObj(unittest.TestCase):
         nodes_props = {0: "val1", 1: 3}
         edges_props = {(0, 1): "edge_val1", (2, 3): 3.4}
 
-        self.a.import_edge_props_from_dict("own_property", edges_props)
-        self.a.import_node_props_from_dict("own_property", nodes_props)
+        self.assertEqual(self.a.import_edge_props_from_dict("own_property", edges_props), 0)
+        self.assertEqual(self.a.import_node_props_from_dict("own_property", nodes_props), 0)
 
         self.assertRaises(KeyError, lambda: self.a.G.nodes[2]['own_property'])
         self.assertRaises(KeyError, lambda: self.a.G.edges[0, 2]['own_property'])
@@ -324,6 +438,31 @@ class TestBrainObj(unittest.TestCase):
         self.assertTrue(self.a.G.edges[0, 1]['own_property'], 'edge_val1')
         self.assertTrue(self.a.G.edges[2, 3]['own_property'], 3.4)
 
+        # Repeated properties are collapsed, and kept for edges created by a later threshold
+        num_props = len(self.a.edge_properties)
+        self.a.apply_threshold(threshold_type="totalEdges", value=0)
+        self.assertEqual(self.a.import_edge_props_from_dict("own_property", {(3, 2): 5}), 1)
+        self.assertEqual(len(self.a.edge_properties), num_props)
+        self.assertEqual(len(self.a.node_properties), 6)
+        self.assertEqual(self.a.edge_property('own_property', 2, 3), 5)
+        self.assertEqual(self.a.edge_property('own_property', 3, 2), 5)
+        self.assertEqual(self.a.edge_property('own_property', 1, 3, default='none'), 'none')
+        self.a.apply_threshold()
+        self.assertEqual(self.a.G.edges[2, 3]['own_property'], 5)
+        self.assertEqual(self.a.G.edges[0, 2]['colour'], 'red')
+        self.assertEqual(nx.get_edge_attributes(self.a.G, 'own_property'), {(0, 1): 'edge_val1', (2, 3): 5})
+        self.assertEqual(self.a.G.copy().edges[2, 3], self.a.G.edges[2, 3])
+
+        # Replacing the properties
+        self.a.edge_properties = [['colour', 2, 0, 'blue']]
+        self.a.node_properties = self.a.node_properties[:2]
+        self.assertEqual(self.a.edge_properties, [['colour', 2, 0, 'blue']])
+        self.assertEqual(len(self.a.node_properties), 2)
+        self.a.apply_threshold()
+        self.assertEqual(self.a.G.edges[0, 2]['colour'], 'blue')
+        self.assertNotIn('own_property', self.a.G.edges[2, 3])
+        self.assertEqual(self.a.G.edges[0, 1].get('colour', 'none'), 'none')
+
     def test_highlights(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.apply_threshold()
@@ -417,5 +556,508 @@ class TestBrainObj(unittest.TestCase):
         self.assertRaises(KeyError, lambda: self.a.G.nodes[3])
 
 
+class TestCohort(unittest.TestCase):
+    """
+    Test Cohort class from maybrain
+    """
+
+    def setUp(self):
+        self.a = mbt.Brain()
+        self.SMALL_FILE = "test/data/3d_grid_adj.txt"
+        self.MODIF_FILE = "test/data/3d_grid_adj2.txt"
+
+    def test_cohort(self):
+        b = mbt.Brain()
+        b.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2])
+        c = mbt.Brain()
+        c.import_adj_file(self.MODIF_FILE, delimiter=",")
+        c.adjMat = c.adjMat * 2
+        self.assertRaises(TypeError, mbc.Cohort, {})
+        self.a.import_adj_file(self.SMALL_FILE)
+        self.assertRaises(TypeError, mbc.Cohort, [b, self.a])
+
+        cohort = mbc.Cohort({'b': b, 'c': c})
+        self.assertEqual(cohort.adj.shape, (2, 15, 15))
+        self.assertEqual(cohort.subjects, ['b', 'c'])
+        mean = cohort.mean()
+        self.assertAlmostEqual(mean[0, 1], 1.5 * b.adjMat[0, 1])
+        self.assertEqual(mean[0, 2], c.adjMat[0, 2])  # NaN in b is ignored
+        self.assertTrue(np.isnan(mean[6, 0]))  # NaN in all the brains
+        self.assertAlmostEqual(cohort.std()[0, 1], 0.5 * b.adjMat[0, 1])
+        self.assertAlmostEqual(cohort.median()[0, 1], mean[0, 1])
+        self.assertAlmostEqual(cohort.percentile(100)[0, 1], c.adjMat[0, 1])
+
+        # Thresholding the same way as Brain.apply_threshold()
+        for args in [("edgePC", 10.5, False), ("totalEdges", 3, True), ("tVal", 0.5, False), (None, 0, False)]:
+            mask = cohort.threshold(*args)
+            for i, brn in enumerate([b, c]):
+                brn.apply_threshold(*args)
+                self.assertEqual(set(zip(*np.nonzero(np.triu(mask[i])))), set(brn.G.edges()))
+            self.assertTrue(np.array_equal(cohort.threshold(*args, block_subjects=1), mask))
+        self.assertRaises(TypeError, cohort.threshold, "edgePC", 101)
+
+
+class TestPipeline(unittest.TestCase):
+    """
+    Test the pipeline of analysis steps over many subjects
+    """
+
+    def setUp(self):
+        self.SMALL_FILE = "test/data/3d_grid_adj.txt"
+        self.MODIF_FILE = "test/data/3d_grid_adj2.txt"
+
+    def test_pipeline(self):
+        subjects = [{'subject': 's1', 'adj': self.SMALL_FILE},
+                    {'subject': 's2', 'adj': "sdfasdf"},
+                    {'subject': 's3', 'adj': self.MODIF_FILE}]
+        steps = [("import_adj_file", {'fname': "{adj}"}),
+                 ("apply_threshold", {'threshold_type': "totalEdges", 'value': 1}),
+                 (utils.percent_connected, {}, "connected"),
+                 (utils.threshold_to_percentage, {'threshold': 0.6}, "above")]
+        for n_jobs in [1, 2]:
+            res = pipeline.run(subjects, steps, n_jobs=n_jobs)
+            self.assertEqual(list(res['subject']), ['s1', 's2', 's3'])
+            self.assertIsNone(res['error'][0])
+            self.assertTrue(res['error'][1].startswith("FileNotFoundError"))
+            self.assertTrue(res['error'][2].startswith("ValueError"))  # file is not space separated
+            self.assertEqual(res['connected'][0], 1 / 6)
+            self.assertEqual(res['above'][0], 3 / 6)
+            self.assertTrue(np.isnan(res['connected'][1]))
+            self.assertTrue(np.isnan(res['above'][2]))
+
+
+class TestCache(unittest.TestCase):
+    """
+    Test the on-disk cache of results
+    """
+
+    def setUp(self):
+        self.a = mbt.Brain()
+        self.SMALL_FILE = "test/data/3d_grid_adj.txt"
+
+    def test_cache(self):
+        self.a.import_adj_file(self.SMALL_FILE)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = utils.enable_cache(tmp_dir)
+            try:
+                self.a.apply_threshold("totalEdges", 3)
+                edges = set(self.a.G.edges())
+                self.assertEqual(len(os.listdir(tmp_dir)), 1)
+                # Same result from the cache, and a new entry for other parameters
+                self.a.apply_threshold()
+                self.a.apply_threshold("totalEdges", 3)
+                self.assertEqual(set(self.a.G.edges()), edges)
+                self.assertEqual(len(os.listdir(tmp_dir)), 2)
+
+                # Different lambdas, closures and partials get different keys
+                norm = [mba.normalise(self.a, func, init_vals=1, n_iter=2, ret_normalised=False)
+                        for func in [lambda g: 1, lambda g: 2, lambda g: len([])]]
+                self.assertEqual(norm, [[1, 1], [2, 2], [0, 0]])
+
+                def constant(value):
+                    return lambda g: value
+                norm = [mba.normalise(self.a, func, init_vals=1, n_iter=2, ret_normalised=False)
+                        for func in [constant(3), constant(4), functools.partial(constant(5)),
+                                     functools.partial(constant(5))]]
+                self.assertEqual(norm, [[3, 3], [4, 4], [5, 5], [5, 5]])
+                self.assertEqual(len([f for f in os.listdir(tmp_dir) if f.endswith('.pkl')]), 8)
+                # The number of jobs is not part of the key
+                self.assertEqual(mba.normalise(self.a, constant(3), init_vals=1, n_iter=2, ret_normalised=False,
+                                               n_jobs=2), [3, 3])
+                self.assertEqual(len([f for f in os.listdir(tmp_dir) if f.endswith('.pkl')]), 8)
+
+                # No temporary file left when the result can't be stored
+                self.assertRaises(Exception, cache.put, 'x', lambda: 0)
+                self.assertFalse([f for f in os.listdir(tmp_dir) if not f.endswith('.pkl')])
+
+                # Evicting the least recently used
+                cache.clear()
+                cache.max_size = 500
+                for key in ['a', 'b']:
+                    cache.put(key, b'0' * 200)
+                    os.utime(os.path.join(tmp_dir, key + '.pkl'), (1, 1))
+                self.assertTrue(cache.get('a')[0])
+                cache.put('c', b'0' * 200)
+                self.assertEqual(sorted(os.listdir(tmp_dir)), ['a.pkl', 'c.pkl'])
+            finally:
+                utils.disable_cache()
+
+
+class TestWriters(unittest.TestCase):
+    """
+    Test the writers of brains and results
+    """
+
+    def setUp(self):
+        self.a = mbt.Brain()
+        self.MODIF_FILE = "test/data/3d_grid_adj2.txt"
+
+    def test_writers(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold("totalEdges", 3)
+        self.a.G.edges[1, 12]['label'] = 'x'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for ext in [".txt", ".txt.gz", ".npy"]:
+                fname = os.path.join(tmp_dir, "adj" + ext)
+                utils.output_adj_matrix(self.a, fname)
+                adj = np.load(fname) if ext == ".npy" else np.loadtxt(fname)
+                self.assertTrue(np.array_equal(adj, self.a.adjMat, equal_nan=True))
+
+            fname = os.path.join(tmp_dir, "edges.txt")
+            utils.output_edges(self.a, fname, [ct.WEIGHT, 'label'], precision=3)
+            with open(fname) as file:
+                self.assertEqual(file.read().splitlines()[:2], ["n1\tn2\tweight\tlabel", "1\t12\t0.696\tx"])
+            edges = utils.edges_array(self.a, [ct.WEIGHT, 'label'])
+            self.assertEqual(len(edges), 3)
+            self.assertEqual(list(edges['label']), ['x', 'NA', 'NA'])
+            self.assertTrue(all(edges[ct.WEIGHT] > 0.5))
+
+    def test_results_writer(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, "res.csv")
+            writers = [utils.ResultsWriter(fname, buffer_rows=2, delimiter=',', float_format='%.2f'),
+                       utils.ResultsWriter(fname, columns=['a', 'b'], delimiter=',')]
+            for i in range(3):
+                for writer in writers:
+                    writer.write({'a': i / 3, 'b': 'x'} if i else {'b': None, 'a': i})
+            for writer in writers:
+                writer.close()
+            self.assertRaises(KeyError, writers[0].write, {'c': 1})
+            with open(fname) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(lines[0], "a,b")
+            self.assertEqual(sorted(lines[1:]), ["0,NA", "0.00,NA", "0.33,x", "0.3333333333333333,x",
+                                                 "0.6666666666666666,x", "0.67,x"])
+
+            # Compatibility with the old space separated format
+            base = os.path.join(tmp_dir, "brain")
+            utils.write_results({2: 0.5, 10: 1}, "deg", outfilebase=base, propdict={'subject': 's1'})
+            utils.write_results({2: 0.25, 10: 2}, "deg", outfilebase=base, propdict={'subject': 's2'})
+            utils.write_results([3, 4], "deg", outfilebase=base, append=False)
+            with open(base + "deg.txt.old") as file:
+                self.assertEqual(file.read(), "subject 2 10\ns1 0.5 1\ns2 0.25 2\n")
+            with open(base + "deg.txt") as file:
+                self.assertEqual(file.read(), "0 1\n3 4\n")
+
+
+def _write_allen_donor(subj, xyz, expression):
+    """ It writes a donor of the Allen Brain Atlas in subj, with a sample in a different structure at each xyz """
+    os.makedirs(subj)
+    with open(os.path.join(subj, "SampleAnnot.csv"), "w") as file:
+        file.write("structure_acronym,structure_name,mni_x,mni_y,mni_z\n")
+        file.writelines('"S%d","struct %d",%s\n' % (i, i, ",".join(str(v) for v in c)) for i, c in enumerate(xyz))
+    with open(os.path.join(subj, "MicroarrayExpression.csv"), "w") as file:
+        file.writelines("%d,%s\n" % (probe, ",".join(str(v) for v in row))
+                        for probe, row in zip([1, 2, 3], expression))
+    with open(os.path.join(subj, "Probes.csv"), "w") as file:
+        file.write('"probe_id","probe_name","gene_id","gene_symbol","gene_name"\n')
+        file.write('1,"P1",1,"G1","gene one"\n2,"P2",1,"G1","gene one"\n3,"P3",2,"G2","gene two"\n')
+
+
+def _zscore(values):
+    return (np.array(values) - np.mean(values)) / np.std(values)
+
+
+class TestAllen(unittest.TestCase):
+    """
+    Test the Allen Brain Atlas module with two small synthetic donors
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.xyz = [(-10, 0, 0), (10, 0, 0), (0, 10, 0), (0, -10, 0)]
+        self.expr = [[[1., 2., 3., 4.], [2., 4., 6., 8.], [4., 3., 2., 1.]],
+                     [[1., 2., 4., 6.], [1., 1., 1., 1.], [2., 3., 1., 4.]]]
+        self.subjs = [os.path.join(self.tmp_dir.name, "d0"), os.path.join(self.tmp_dir.name, "d1")]
+        _write_allen_donor(self.subjs[0], self.xyz, self.expr[0])
+        _write_allen_donor(self.subjs[1], [(2 * x, 2 * y, z + 5) for x, y, z in self.xyz], self.expr[1])
+        # The MRI nodes are each next to a sample of the first donor
+        self.adj_file = os.path.join(self.tmp_dir.name, "adj.txt")
+        np.savetxt(self.adj_file, np.ones((4, 4)) - np.eye(4), delimiter=",")
+        self.spatial_file = os.path.join(self.tmp_dir.name, "xyz.txt")
+        with open(self.spatial_file, "w") as file:
+            file.writelines("%d %g %g %g\n" % ((i,) + tuple(0.9 * np.array(c))) for i, c in enumerate(self.xyz))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_load_expression(self):
+        from maybrain import allen
+        csv_file = os.path.join(self.subjs[0], "MicroarrayExpression.csv")
+        probes, expr = allen.loadExpression(self.subjs[0])
+        self.assertEqual(probes.tolist(), [1, 2, 3])
+        self.assertEqual(expr.dtype, np.float32)
+        self.assertTrue(np.array_equal(expr, self.expr[0]))
+        self.assertTrue(os.path.exists(csv_file + ".npy"))
+
+        # Afterwards it is memory-mapped from the cache
+        probes, expr = allen.loadExpression(self.subjs[0])
+        self.assertIsInstance(expr, np.memmap)
+        self.assertTrue(np.array_equal(expr, self.expr[0]))
+
+        # and the cache is rebuilt when the csv file changes
+        with open(csv_file, "w") as file:
+            file.write("7,1,2,3,4\n")
+        cache_time = os.path.getmtime(csv_file + ".npy")
+        os.utime(csv_file, (cache_time + 1, cache_time + 1))
+        probes, expr = allen.loadExpression(self.subjs[0])
+        self.assertEqual(probes.tolist(), [7])
+        self.assertTrue(np.array_equal(expr, [[1, 2, 3, 4]]))
+
+        # The cache can be kept in another directory, and it is parsed in memory if it can't be written
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        os.makedirs(cache_dir)
+        csv_file = os.path.join(self.subjs[1], "MicroarrayExpression.csv")
+        for _ in range(2):
+            probes, expr = allen.loadExpression(self.subjs[1], cacheDir=cache_dir)
+            self.assertTrue(np.array_equal(expr, self.expr[1]))
+        self.assertIsInstance(expr, np.memmap)
+        self.assertFalse(os.path.exists(csv_file + ".npy"))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        probes, expr = allen.loadExpression(self.subjs[1], cacheDir=os.path.join(self.tmp_dir.name, "none"))
+        self.assertNotIsInstance(expr, np.memmap)
+        self.assertEqual(probes.tolist(), [1, 2, 3])
+        self.assertTrue(np.array_equal(expr, self.expr[1]))
+
+    def test_probe_index(self):
+        from maybrain import allen
+        index = allen.probeIndex.load(self.subjs[0])
+        self.assertTrue(os.path.exists(os.path.join(self.subjs[0], "Probes.csv.index.npz")))
+        self.assertIs(allen.probeIndex.load(self.subjs[0]), index)
+        self.assertEqual(index.rows([3, 1, 5]).tolist(), [2, 0, -1])
+        self.assertEqual(index.geneRows("G1").tolist(), [0, 1])
+        self.assertEqual(index.geneRows("G3").tolist(), [])
+        self.assertEqual(index.search(["G2", "G1"], match="exact"), ['3', '1', '2'])
+        self.assertEqual(index.search(["G"], match="prefix"), ['1', '2', '3'])
+        self.assertEqual(index.search(["one"]), ['1', '2'])
+        self.assertEqual(index.genesOf([2, 5, 3]).tolist(), ["G1", "", "G2"])
+        self.assertRaises(TypeError, index.search, ["G1"], match="regex")
+
+        # Another session reads the cached index
+        allen.probeIndex._loaded.clear()
+        index = allen.probeIndex.load(self.subjs[0])
+        self.assertEqual(index.geneNames.tolist(), ["gene one", "gene one", "gene two"])
+
+        # The index can be cached in another directory, and it is only kept in memory if it can't be written
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        os.makedirs(cache_dir)
+        allen.probeIndex.load(self.subjs[1], cacheDir=cache_dir)
+        self.assertEqual([f[-10:] for f in os.listdir(cache_dir)], [".index.npz"])
+        self.assertFalse(os.path.exists(os.path.join(self.subjs[1], "Probes.csv.index.npz")))
+        allen.probeIndex._loaded.clear()
+        index = allen.probeIndex.load(self.subjs[1], cacheDir=os.path.join(self.tmp_dir.name, "none"))
+        self.assertEqual(index.genes.tolist(), ["G1", "G2"])
+
+    def test_allen_brain(self):
+        from maybrain import allen
+        from scipy import stats
+        brain = allen.allenBrain(self.subjs[0], self.adj_file, spatialFile=self.spatial_file)
+        brain.comparison()
+        self.assertEqual({n: brain.c.G.nodes[n]['pair'] for n in brain.c.G.nodes()}, {0: 0, 1: 1, 2: 2, 3: 3})
+        self.assertEqual(brain.a.G.nodes[2][ct.XYZ], (0., 10., 0.))
+        self.assertEqual(brain.a.G.nodes[2]['structure_acronym'], "S2")
+
+        metric = [1., 3., 2., 4.]
+        brain.probeData(dict(enumerate(metric)), probeList=["G1", "G2"], fdr=True)
+        expected = np.array([stats.pearsonr(row, metric) for row in self.expr[0]])
+        self.assertEqual(brain.probeResults['probe_id'].tolist(), ['1', '2', '3'])
+        self.assertTrue(np.allclose(brain.probeResults['r'], expected[:, 0]))
+        self.assertTrue(np.allclose(brain.probeResults['p'], expected[:, 1]))
+        self.assertTrue(np.allclose(brain.probeResults['p_fdr'], allen.fdrCorrection(expected[:, 1])))
+        with open(os.path.join(self.subjs[0], "gm.txt")) as file:
+            lines = [line.split(",") for line in file.read().splitlines()]
+        self.assertEqual(lines[0], ['probe_id', 'gene_name', 'r', 'p', 'p_fdr'])
+        self.assertEqual([line[:2] for line in lines[1:]], [['1', '"gene one"'], ['2', '"gene one"'],
+                                                              ['3', '"gene two"']])
+        self.assertTrue(np.allclose([[float(v) for v in line[2:4]] for line in lines[1:]], expected))
+
+        # Expression of each gene, normalised within each probe and averaged across its probes
+        brain.writeXMatrix(outFile="X.csv")
+        with open(self.subjs[0] + "X.csv") as file:
+            lines = [line.split() for line in file.read().splitlines()]
+        self.assertEqual(lines[0], ["Gene", "0", "1", "2", "3"])
+        self.assertEqual([line[0] for line in lines[1:]], ["G1", "G2"])
+        self.assertTrue(np.allclose([[float(v) for v in line[1:]] for line in lines[1:]],
+                                    [_zscore(self.expr[0][0]), _zscore(self.expr[0][2])]))
+
+    def test_multi_subj(self):
+        from maybrain import allen
+        # the donors are loaded, and their X matrix sums computed, in two processes
+        multi = allen.multiSubj(self.adj_file, delim=",", subjList=self.subjs, spatialFile=self.spatial_file,
+                                mirror=False, nJobs=2)
+        self.assertEqual(multi.a.G.number_of_nodes(), 8)
+        self.assertEqual(multi.samples['donor'].tolist(), [self.subjs[0]] * 4 + [self.subjs[1]] * 4)
+        self.assertEqual(multi.samples['xyz'][5].tolist(), [20., 0., 5.])
+        self.assertTrue(np.array_equal(multi.expressionMatrix([3, 9]),
+                                       [self.expr[0][2] + self.expr[1][2], [np.nan] * 8], equal_nan=True))
+        multi.comparison()
+        self.assertEqual(sorted(multi.a.G.nodes()), [0, 1, 2, 3])
+        multi.probeData(probeList=["G1", "two"])
+        for node in range(4):
+            for i, probe in enumerate(['1', '2', '3']):
+                self.assertAlmostEqual(multi.a.G.nodes[node][probe],
+                                       (self.expr[0][i][node] + self.expr[1][i][node]) / 2)
+
+        # Expression of each gene, normalised within each probe and subject and averaged across them
+        out_file = os.path.join(self.tmp_dir.name, "X.csv")
+        sd_file = os.path.join(self.tmp_dir.name, "sd.txt")
+        multi.writeXMatrix(outFile=out_file, sd=True, sdFile=sd_file)
+        x_mat = np.loadtxt(out_file, skiprows=1, usecols=range(1, 5))
+        probe_means = [(_zscore(self.expr[0][0]) + _zscore(self.expr[1][0])) / 2,
+                       _zscore(self.expr[0][1]),  # the second donor doesn't vary, so it is left out
+                       (_zscore(self.expr[0][2]) + _zscore(self.expr[1][2])) / 2]
+        self.assertTrue(np.allclose(x_mat, [(probe_means[0] + probe_means[1]) / 2, probe_means[2]]))
+        self.assertTrue(np.allclose(multi.probeMat, probe_means))
+
+        # the same, a probe at a time, with the probe means in a private scratch file
+        scratch_dir = os.path.join(self.tmp_dir.name, "scratch")
+        os.mkdir(scratch_dir)
+        multi.writeXMatrix(outFile=out_file + "2", blockSize=1, scratchDir=scratch_dir)
+        self.assertTrue(np.allclose(np.loadtxt(out_file + "2", skiprows=1, usecols=range(1, 5)), x_mat))
+        self.assertIsInstance(multi.probeMat, np.memmap)
+        self.assertTrue(np.allclose(multi.probeMat, probe_means))
+        self.assertEqual(os.listdir(scratch_dir), [])
+        sd_mat = np.loadtxt(sd_file, skiprows=1)
+        self.assertEqual(sd_mat[:5, 0].tolist(), [1, 1, 1, 1, 2])
+        self.assertTrue(np.allclose(sd_mat[:4, 2], np.abs(_zscore(self.expr[0][0]) - _zscore(self.expr[1][0])) / 2,
+                                    atol=1e-5))
+        self.assertTrue(np.allclose(sd_mat[4:8, 2], 0))
+
+        multi.comparisonAveraged()
+        self.assertEqual([multi.a.G.nodes[n]['pairNodes'] for n in range(4)], [[0], [1], [2], [3]])
+
+    def test_closest(self):
+        from maybrain import allen
+        xyz = np.array([[0., 0., 0.], [3., 0., 0.], [5000., 0., 0.]])
+        other = np.array([[1., 0., 0.], [-1., 0., 0.], [3., 0., 0.]])
+        # ties go to the first node, and nothing is matched beyond 999
+        self.assertEqual(allen._closest(xyz, ['a', 'b', 'c'], other), [('a', 1.), ('c', 0.), (None, 999.)])
+        self.assertEqual(allen._closest(other, ['a', 'b', 'c'], other, excludeSelf=True),
+                         [('b', 2.), ('a', 2.), ('a', 2.)])
+        self.assertEqual(allen._closest(xyz, [], np.zeros((0, 3))), [(None, 999.)] * 3)
+
+    def test_correlations(self):
+        from maybrain import allen
+        from scipy import stats
+        expr = np.array([[1., 2., 4., 3., 5.], [2., np.nan, 1., 0., 4.]])
+        metric = np.array([1., 2., 3., 4., 6.])
+        r, p = allen.probeCorrelations(expr, metric)
+        # the nodes with NaN are left out of the correlation of that probe
+        for i, row in enumerate(expr):
+            valid = ~np.isnan(row)
+            self.assertTrue(np.allclose([r[i], p[i]], stats.pearsonr(row[valid], metric[valid])))
+
+        self.assertTrue(np.allclose(allen.fdrCorrection([0.01, 0.04, np.nan, 0.03]), [0.03, 0.04, np.nan, 0.04],
+                                    equal_nan=True))
+
+
+class TestBraineac(unittest.TestCase):
+    """
+    Test the Braineac module with a small AAL atlas and parcellation
+    """
+
+    def setUp(self):
+        import nibabel as nb
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.rois_file = os.path.join(self.tmp_dir.name, "rois.txt")
+        with open(self.rois_file, "w") as file:
+            file.write("FAG Frontal_Sup_L 10\nHIP Hippocampus_R 20\nTEM Temporal_Mid_R 30\n")
+        self.aal_file = os.path.join(self.tmp_dir.name, "aal.nii")
+        nb.save(nb.Nifti1Image(np.array([10, 10, 20, 20, 30, 0], dtype=np.int16).reshape((6, 1, 1)), np.eye(4)),
+                self.aal_file)
+        # parcel 1 is in the frontal cortex, 2 in the hippocampus and 3 split in three
+        self.parcel_file = os.path.join(self.tmp_dir.name, "parcels.nii")
+        nb.save(nb.Nifti1Image(np.array([1, 1, 2, 3, 3, 3], dtype=np.int16).reshape((6, 1, 1)), np.eye(4)),
+                self.parcel_file)
+        self.adj_file = os.path.join(self.tmp_dir.name, "adj.txt")
+        np.savetxt(self.adj_file, np.ones((3, 3)) - np.eye(3))
+        self.spatial_file = os.path.join(self.tmp_dir.name, "xyz.txt")
+        with open(self.spatial_file, "w") as file:
+            file.write("0 10 0 0\n1 60 0 0\n2 0 0 0\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _template(self):
+        from maybrain import braineac
+        brain = braineac.braineac(AALrois=self.rois_file, braineacDir=self.tmp_dir.name)
+        brain.makeTemplate(AAL=self.aal_file, outFile=os.path.join(self.tmp_dir.name, "template.nii"),
+                           logName=os.path.join(self.tmp_dir.name, "log.txt"))
+        return brain
+
+    def test_apply_lut(self):
+        from maybrain import braineac
+        volume = np.array([[1, 2], [3, 1]])
+        self.assertEqual(braineac._applyLUT(volume, {1: 5, 3: 7}).tolist(), [[5, 0], [7, 5]])
+        self.assertEqual(braineac._applyLUT(volume, {2: 1.5}, default=-1).tolist(), [[-1, 1.5], [-1, -1]])
+
+    def test_braineac(self):
+        import nibabel as nb
+        brain = self._template()
+        self.assertEqual(brain.ROIs, {"CRBL": [], "FCTX": ["10"], "HIPP": ["20"], "OCTX": [], "PUTM": [],
+                                      "TCTX": ["30"], "THAL": []})
+        self.assertEqual(brain.regValDict[2], "FCTX")
+        template = np.asanyarray(nb.load(os.path.join(self.tmp_dir.name, "template.nii")).dataobj)
+        self.assertEqual(template.ravel().tolist(), [2, 2, 3, 3, 6, 0])
+
+        brain.comparison(self.adj_file, spatialFile=self.spatial_file, parcellation=self.parcel_file,
+                         outFile=os.path.join(self.tmp_dir.name, "nodes.txt"))
+        self.assertEqual({n: v for n, v in brain.nodeDict.items() if v["L"] or v["R"]},
+                         {2: {"L": [0], "R": []}, 3: {"L": [], "R": [1]}})
+        self.assertEqual(dict(brain.a.G.nodes(data='braineac')), {0: "FCTXL", 1: "HIPPR", 2: None})
+        with open(os.path.join(self.tmp_dir.name, "nodes.txt")) as file:
+            lines = file.read().splitlines()
+        self.assertEqual(lines[2:6], ["FCTXL 0", "FCTXR ", "HIPPL ", "HIPPR 1"])
+
+        brain.createParcellation(outFile=os.path.join(self.tmp_dir.name, "braineac_parcels.nii"))
+        parcellation = np.asanyarray(nb.load(os.path.join(self.tmp_dir.name, "braineac_parcels.nii")).dataobj)
+        self.assertEqual(parcellation.ravel().tolist(), [12, 12, 23, 0, 0, 0])
+
+    def test_region_expression(self):
+        from maybrain import braineac
+        brain = self._template()
+        # Expression of each region, with a header and missing values
+        for region in brain.regValDict.values():
+            with open(os.path.join(self.tmp_dir.name, "expr_" + region + ".txt"), "w") as file:
+                file.write("probe s1 s2 s3\n")
+                if region == "FCTX":
+                    file.write("p1 1 NA 3\np2 4 5\n")
+                elif region == "HIPP":
+                    file.write("p2 2 NA NA\np3 1 1 1\n")
+        fname = os.path.join(self.tmp_dir.name, "expr_FCTX.txt")
+        probes, expr = braineac.loadRegionExpression(fname)
+        self.assertEqual(probes.tolist(), ["p1", "p2"])
+        self.assertTrue(np.array_equal(expr, [[1, np.nan, 3], [4, 5, np.nan]], equal_nan=True))
+        self.assertTrue(os.path.exists(fname + ".npy") and os.path.exists(fname + ".probes.npy"))
+        probes, expr = braineac.loadRegionExpression(fname)
+        self.assertIsInstance(expr, np.memmap)
+        self.assertEqual(probes.tolist(), ["p1", "p2"])
+        self.assertTrue(np.array_equal(expr, [[1, np.nan, 3], [4, 5, np.nan]], equal_nan=True))
+
+        brain.braineacData(["p1", "p2", "p4"])
+        self.assertEqual(dict(brain.b.G.nodes(data=True)), {1: {"p1": 2., "p2": 4.5}, 2: {"p2": 2.}})
+
+        # The cache is rebuilt when the text file changes
+        with open(fname, "w") as file:
+            file.write("p5 7 8 9\n")
+        cache_time = os.path.getmtime(fname + ".npy")
+        os.utime(fname, (cache_time + 1, cache_time + 1))
+        probes, expr = braineac.loadRegionExpression(fname)
+        self.assertEqual(probes.tolist(), ["p5"])
+        self.assertTrue(np.array_equal(expr, [[7, 8, 9]]))
+
+        # The cache can be kept in another directory, and the file is parsed in memory if it can't be written
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        os.makedirs(cache_dir)
+        brain.braineacData(["p2"], cacheDir=cache_dir)
+        self.assertEqual(dict(brain.b.G.nodes(data=True)), {2: {"p2": 2.}})
+        self.assertEqual(len(os.listdir(cache_dir)), 2 * len(brain.regValDict))
+        fname = os.path.join(self.tmp_dir.name, "expr_HIPP.txt")
+        probes, expr = braineac.loadRegionExpression(fname, cacheDir=os.path.join(self.tmp_dir.name, "none"))
+        self.assertNotIsInstance(expr, np.memmap)
+        self.assertEqual(probes.tolist(), ["p2", "p3"])
+        self.assertTrue(np.array_equal(expr, [[2, np.nan, np.nan], [1, 1, 1]], equal_nan=True))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@ import networkx as nx
 
 from maybrain import brain as mbt
 from maybrain import resources as rt
+from maybrain import metrics as mm
 import maybrain.plotting as mpt
 import maybrain.algorithms as mba
 import maybrain.constants as ct
@@ -19,6 +20,7 @@ class TestPlottingAndAlgs(unittest.TestCase):
         self.a = mbt.Brain()
         self.SMALL_FILE = "test/data/3d_grid_adj.txt"
         self.SMALL_NEG_FILE = "test/data/3d_grid_adj_neg.txt"
+        self.MODIF_FILE = "test/data/3d_grid_adj2.txt"
         self.COORD_FILE = "test/data/3d_grid_coords.txt"
         self.PROPS_FILE = "test/data/3d_grid_properties_full.txt"
 
@@ -73,6 +75,100 @@ class TestPlottingAndAlgs(unittest.TestCase):
         self.assertEqual(sum(dict(nx.degree(rand, weight=ct.WEIGHT)).values()),
                          sum(dict(nx.degree(self.a.G, weight=ct.WEIGHT)).values()))
 
+    def test_strength_normalisation(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=40)
+        self.a.make_edges_absolute()
+
+        rand = mba.generate_rand_from_strength(self.a, n_swaps=5)
+        self.assertEqual(dict(nx.degree(rand)), dict(nx.degree(self.a.G)))
+        self.assertEqual(sorted(nx.get_edge_attributes(rand, ct.WEIGHT).values()),
+                         sorted(nx.get_edge_attributes(self.a.G, ct.WEIGHT).values()))
+        self.assertRaises(TypeError, mba.generate_rand_from_strength, self.a, sort_freq=0)
+
+        normalised = mba.normalise_node_wise(self.a,
+                                             nx.degree,
+                                             init_vals=dict(nx.degree(self.a.G)),
+                                             n_iter=3,
+                                             generator=mba.generate_rand_from_strength,
+                                             generator_kwargs={'n_swaps': 2})
+        self.assertTrue(all(i == 1 for i in normalised.values()))
+
+    def test_spatial_normalisation(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=40)
+        self.assertRaises(KeyError, mba.generate_spatial_rand, self.a)
+
+        self.a.import_node_props_from_dict(ct.XYZ, {n: (n % 3, n // 3, 0) for n in self.a.G.nodes()})
+        rand = mba.generate_spatial_rand(self.a, n_bins=1, node_attrs=[ct.XYZ])
+        self.assertEqual(dict(nx.degree(rand)), dict(nx.degree(self.a.G)))
+        self.assertEqual(rand.nodes[4][ct.XYZ], (1, 1, 0))
+
+        normalised = mba.normalise_single(self.a, nx.number_of_edges, init_val=self.a.G.number_of_edges(),
+                                          n_iter=3, generator=mba.generate_spatial_rand)
+        self.assertEqual(normalised, 1)
+
+    def test_lattice_normalisation(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=30)
+
+        lattice = mba.generate_lattice(self.a, order=list(reversed(range(15))))
+        self.assertEqual(dict(nx.degree(lattice)), dict(nx.degree(self.a.G)))
+        self.assertEqual(sorted(nx.get_edge_attributes(lattice, ct.WEIGHT).values()),
+                         sorted(nx.get_edge_attributes(self.a.G, ct.WEIGHT).values()))
+
+        # The anatomical order only needs the properties files of the resources
+        lattice = mba.generate_lattice(self.a, order="anatomical")
+        self.assertEqual(dict(nx.degree(lattice)), dict(nx.degree(self.a.G)))
+
+        normalised = mba.normalise_node_wise(self.a,
+                                             nx.degree,
+                                             init_vals=dict(nx.degree(self.a.G)),
+                                             n_iter=4,
+                                             generator=mba.generate_lattice,
+                                             n_jobs=2)
+        self.assertTrue(all(i == 1 for i in normalised.values()))
+
+    def test_metrics(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=40)
+        self.a.make_edges_absolute()
+        self.a.weight_to_distance()
+
+        for weight in [None, ct.WEIGHT]:
+            expected = nx.clustering(self.a.G, weight=weight)
+            for node, val in mm.clustering(self.a, weight=weight).items():
+                self.assertAlmostEqual(val, expected[node])
+            self.assertAlmostEqual(mm.average_clustering(self.a.G, weight=weight),
+                                   nx.average_clustering(self.a.G, weight=weight))
+        self.assertEqual(mm.degree(self.a), dict(nx.degree(self.a.G)))
+        for node, val in mm.strength(self.a).items():
+            self.assertAlmostEqual(val, self.a.G.degree(node, weight=ct.WEIGHT))
+
+        # edges without the weight attribute count as 1, as in networkx
+        graph = nx.Graph()
+        graph.add_edge(0, 1, weight=2.)
+        graph.add_edge(1, 2)
+        self.assertEqual(mm.strength(graph), {0: 2., 1: 3., 2: 1.})
+
+        # in directed graphs both in and out edges count, and selfloops count twice
+        graph = nx.DiGraph()
+        graph.add_edge(0, 1, weight=2.)
+        graph.add_edge(2, 0, weight=1.)
+        graph.add_edge(0, 0, weight=5.)
+        self.assertEqual(mm.degree(graph), dict(graph.degree()))
+        self.assertEqual(mm.strength(graph), dict(graph.degree(weight=ct.WEIGHT)))
+        self.assertEqual(mm.degree(graph.to_undirected()), dict(graph.to_undirected().degree()))
+
+        self.assertAlmostEqual(mm.global_efficiency(self.a), nx.global_efficiency(self.a.G))
+        self.assertAlmostEqual(mm.local_efficiency(self.a), nx.local_efficiency(self.a.G))
+        self.assertAlmostEqual(mm.characteristic_path_length(self.a, weight=ct.DISTANCE),
+                               nx.average_shortest_path_length(self.a.G, weight=ct.DISTANCE))
+
+        normalised = mba.normalise_node_wise(self.a, mm.degree, init_vals=mm.degree(self.a), n_iter=3,
+                                             exact_random=True)
+        self.assertTrue(all(i == 1 for i in normalised.values()))
+
     def test_connectome(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.import_spatial_info(self.COORD_FILE)